@@ -0,0 +1,2 @@
+# Microbenchmarks for the byte handling hot paths of the terminal.
+# Run with `python -m benchmarks` from the repository root, see __main__.py for the options.
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import List
+
+from .cases import CASES, cleanup
+from .corpora import CORPORA, chunked, load_cast
+
+MB = 1000 * 1000
+
+
+async def _measure(case, chunks: List[bytes], repeat: int) -> dict:
+    # best of n, the other runs are mostly noise from the rest of the machine
+    best = None
+    size = 0
+    for _ in range(repeat):
+        run = await case(chunks)
+        gc.collect()
+        start = time.perf_counter()
+        size = await run()
+        elapsed = time.perf_counter() - start
+        await cleanup()
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return dict(size=size, seconds=best, mb_per_s=size / MB / best if best else 0.0)
+
+
+async def _measure_memory(case, chunks: List[bytes]) -> dict:
+    # Python has no counter of allocations made, only of what is allocated at a point in
+    # time. so this reports the tracemalloc peak during the run and the blocks the run
+    # left allocated (net, e.g. history that was kept), both per MB of input.
+    run = await case(chunks)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        size = await run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    retained = sys.getallocatedblocks() - blocks
+    await cleanup()
+
+    megabytes = max(size / MB, 1e-9)
+    return dict(peak_kib_per_mb=peak / 1024 / megabytes, retained_blocks_per_mb=retained / megabytes)
+
+
+async def _main(args) -> List[dict]:
+    corpora = dict(CORPORA)
+    selected = set(args.corpus or [])
+    for path in args.cast or []:
+        # recorded sessions are replayed as they are, --size doesn't apply
+        corpora[os.path.basename(path)] = lambda size, path=path: load_cast(path)
+        selected.add(os.path.basename(path))
+
+    results = []
+    for corpus_name, generate in corpora.items():
+        if selected and corpus_name not in selected:
+            continue
+
+        chunks = chunked(generate(int(args.size * MB)), args.chunk_size)
+        for case_name, case in CASES.items():
+            if args.case and case_name not in args.case:
+                continue
+
+            result = dict(case=case_name, corpus=corpus_name)
+            result.update(await _measure(case, chunks, args.repeat))
+            if args.memory:
+                result.update(await _measure_memory(case, chunks))
+            results.append(result)
+
+            line = f"{case_name:<24}{corpus_name:<10}{result['mb_per_s']:>10.2f} MB/s"
+            if args.memory:
+                line += f"{result['peak_kib_per_mb']:>12.1f} KiB/MB peak{result['retained_blocks_per_mb']:>10.1f} blocks/MB retained"
+            print(line, file=sys.stderr if args.json else sys.stdout, flush=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Terminal hot path microbenchmarks")
+    parser.add_argument("--case", action="append", choices=list(CASES), help="only run this case (repeatable)")
+    parser.add_argument("--corpus", action="append", choices=list(CORPORA), help="only use this corpus (repeatable)")
+    parser.add_argument("--cast", action="append", metavar="FILE", help="also replay this asciicast recording (.cast or .cast.gz, repeatable)")
+    parser.add_argument("--size", type=float, default=2.0, help="corpus size in MB (default: 2)")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="bytes per simulated PTY read (default: 4096)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best one is reported (default: 3)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc pass")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON, e.g. to diff two releases")
+    args = parser.parse_args()
+
+    results = asyncio.run(_main(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
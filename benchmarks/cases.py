@@ -0,0 +1,154 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List
+
+from . import stub
+
+stub.install()
+
+from decky_terminal.scanner import EscapeScanner  # noqa: E402
+from decky_terminal.screen import Screen  # noqa: E402
+from decky_terminal.terminal import Terminal  # noqa: E402
+
+# A case gets the corpus split into PTY sized reads and returns the coroutine to time,
+# everything before that is setup and not measured. The coroutine returns the number
+# of bytes it handled, which is what the throughput is computed from.
+Case = Callable[[List[bytes]], Awaitable[Callable[[], Awaitable[int]]]]
+
+_SNAPSHOT_ROUNDS = 20
+_SUBSCRIBERS = 4
+
+_terminals: List[Terminal] = []
+
+
+def _terminal(**flags) -> Terminal:
+    # never started, the hot paths below don't need a process behind them
+    terminal = Terminal("bench", "/bin/sh", **flags)
+    _terminals.append(terminal)
+    return terminal
+
+
+async def cleanup():
+    while len(_terminals) > 0:
+        terminal = _terminals.pop()
+        terminal._unsubscribe_all()
+        if terminal.recorder is not None:
+            await terminal.stop_recording()
+    # let the cancelled delivery tasks finish
+    await asyncio.sleep(0)
+
+
+async def _drain(terminal: Terminal):
+    while any(subscriber.queue_size > 0 or subscriber.snapshot_pending for subscriber in terminal.subscribers.values()):
+        await asyncio.sleep(0)
+
+
+# CASES =================================================
+async def put_buffer(chunks: List[bytes]):
+    terminal = _terminal()
+
+    async def run() -> int:
+        for chunk in chunks:
+            terminal._put_buffer(chunk)
+        return sum(map(len, chunks))
+
+    return run
+
+
+async def put_buffer_raw(chunks: List[bytes]):
+    # the same without the screen model, which put_buffer only feeds when the output clears the screen
+    terminal = _terminal(screen_snapshot=False)
+
+    async def run() -> int:
+        for chunk in chunks:
+            terminal._put_buffer(chunk)
+        return sum(map(len, chunks))
+
+    return run
+
+
+async def put_buffer_recording(chunks: List[bytes]):
+    # what an active asciicast recording adds to the read path, the writing itself
+    # happens in the executor once the loop gets to it and is not part of this
+    terminal = _terminal()
+    terminal.start_recording()
+
+    async def run() -> int:
+        for chunk in chunks:
+            terminal._put_buffer(chunk)
+        return sum(map(len, chunks))
+
+    return run
+
+
+async def scan(chunks: List[bytes]):
+    # clear detection and title tracking, formerly _detect_ansi_clear_and_remove_prepends and _process_title
+    scanner = EscapeScanner()
+
+    async def run() -> int:
+        for chunk in chunks:
+            scanner.scan(chunk)
+        return sum(map(len, chunks))
+
+    return run
+
+
+async def screen_feed(chunks: List[bytes]):
+    # the screen model on its own, put_buffer only feeds it when a snapshot is taken
+    screen = Screen()
+
+    async def run() -> int:
+        for chunk in chunks:
+            screen.feed(chunk)
+        return sum(map(len, chunks))
+
+    return run
+
+
+async def send_current_buffer(chunks: List[bytes]):
+    terminal = _terminal()
+    for chunk in chunks:
+        terminal._put_buffer(chunk)
+    terminal.subscribe()
+    await _drain(terminal)
+
+    async def run() -> int:
+        size = stub.emit.size
+        for _ in range(_SNAPSHOT_ROUNDS):
+            await terminal.send_current_buffer()
+            await _drain(terminal)
+        return stub.emit.size - size
+
+    return run
+
+
+async def broadcast_subscribers(chunks: List[bytes]):
+    terminal = _terminal()
+    for index in range(_SUBSCRIBERS):
+        terminal.subscribe(str(index))
+    await _drain(terminal)
+
+    async def run() -> int:
+        seq = terminal.output_seq
+        for chunk in chunks:
+            seq += len(chunk)
+            await terminal.broadcast_subscribers(chunk, seq)
+            # what the broadcast loop does between two reads
+            await asyncio.sleep(0)
+        await _drain(terminal)
+
+        terminal.output_seq = seq
+        terminal._emitted_seq = seq
+        return sum(map(len, chunks))
+
+    return run
+
+
+CASES: Dict[str, Case] = {
+    "put_buffer": put_buffer,
+    "put_buffer_raw": put_buffer_raw,
+    "put_buffer_recording": put_buffer_recording,
+    "scan": scan,
+    "screen_feed": screen_feed,
+    "send_current_buffer": send_current_buffer,
+    "broadcast_subscribers": broadcast_subscribers,
+}
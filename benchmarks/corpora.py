@@ -0,0 +1,142 @@
+import gzip
+import json
+import random
+from typing import Callable, Dict, List
+
+# Synthetic recordings of typical terminal traffic. They are generated from a fixed
+# seed instead of checked in, so every run (and every machine) sees the same bytes.
+
+
+def ls_recursive(size: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    words = ["src", "lib", "include", "share", "doc", "test", "build", "cache", "steam", "proton", "compatdata", "shadercache"]
+    exts = ["", ".so", ".py", ".json", ".txt", ".vdf", ".dll", ".png"]
+
+    output: List[bytes] = []
+    total = 0
+    while total < size:
+        path = "/".join(rng.choice(words) for _ in range(rng.randint(1, 5)))
+        lines = [f"./{path}:"]
+        names = [f"{rng.choice(words)}_{rng.randint(0, 999)}{rng.choice(exts)}" for _ in range(rng.randint(1, 40))]
+        # ls colours directories and executables when writing to a tty
+        for i in range(0, len(names), 4):
+            row = []
+            for name in names[i:i + 4]:
+                if "." not in name:
+                    row.append(f"\x1b[01;34m{name}\x1b[0m".ljust(30))
+                elif name.endswith(".so"):
+                    row.append(f"\x1b[01;32m{name}\x1b[0m".ljust(30))
+                else:
+                    row.append(name.ljust(19))
+            lines.append("  ".join(row).rstrip())
+        lines.append("")
+
+        chunk = ("\r\n".join(lines) + "\r\n").encode()
+        output.append(chunk)
+        total += len(chunk)
+
+    return b"".join(output)[:size]
+
+
+def htop_redraws(size: int, seed: int = 2, rows: int = 40, cols: int = 120) -> bytes:
+    rng = random.Random(seed)
+    commands = ["/usr/bin/steam", "gamescope", "python3 main.py", "kwin_wayland", "pipewire", "sshd: deck", "htop", "bash"]
+
+    output: List[bytes] = [b"\x1b[?1049h\x1b[22;0;0t\x1b[1;40r\x1b[?1h\x1b=\x1b[?25l\x1b[H\x1b[2J"]
+    total = len(output[0])
+    while total < size:
+        frame = []
+        # meters at the top, partially redrawn
+        for cpu in range(4):
+            used = rng.randint(0, 40)
+            frame.append(f"\x1b[{cpu + 1};3H\x1b[1m{cpu}\x1b[0m\x1b[36m[\x1b[32m{'|' * used}\x1b[0m{' ' * (40 - used)}\x1b[36m{used * 2.5:5.1f}%\x1b[0m]")
+        frame.append(f"\x1b[6;3HMem\x1b[36m[\x1b[32m{'|' * rng.randint(10, 30)}\x1b[K")
+
+        # process list, only the rows that changed get rewritten
+        for row in sorted(rng.sample(range(8, rows), rng.randint(3, 15))):
+            pid = rng.randint(1, 65535)
+            line = f"{pid:>7} deck       20   0 {rng.randint(1000, 9999999):>7} {rng.randint(100, 999999):>6} S {rng.random() * 100:4.1f} {rng.random() * 10:4.1f}  0:{rng.randint(0, 59):02d}.{rng.randint(0, 99):02d} {rng.choice(commands)}"
+            colour = "\x1b[30;46m" if rng.random() < 0.1 else ""
+            frame.append(f"\x1b[{row};1H{colour}{line[:cols].ljust(cols)}\x1b[0m")
+
+        chunk = "".join(frame).encode()
+        output.append(chunk)
+        total += len(chunk)
+
+    return b"".join(output)[:size]
+
+
+def compiler_log(size: int, seed: int = 3) -> bytes:
+    rng = random.Random(seed)
+    dirs = ["src/core", "src/render", "src/audio", "third_party/zlib", "third_party/sdl", "tools"]
+
+    output: List[bytes] = []
+    total = 0
+    step = 0
+    while total < size:
+        step += 1
+        source = f"{rng.choice(dirs)}/module_{rng.randint(0, 500)}.c"
+        lines = [f"[{step % 1000:>3}/1000] \x1b[32mBuilding C object\x1b[0m CMakeFiles/game.dir/{source}.o"]
+        if rng.random() < 0.15:
+            line = rng.randint(1, 4000)
+            lines.append(f"\x1b[1m{source}:{line}:{rng.randint(1, 80)}: \x1b[35mwarning: \x1b[0m\x1b[1munused variable 'tmp_{rng.randint(0, 99)}' [-Wunused-variable]\x1b[0m")
+            lines.append(f" {line:>5} |     int tmp_{rng.randint(0, 99)} = compute(ctx, {rng.randint(0, 9)});")
+            lines.append("       |         \x1b[35m^~~~~~\x1b[0m")
+        if rng.random() < 0.05:
+            # ninja rewrites the status line in place
+            lines.append(f"\r\x1b[K[{step % 1000:>3}/1000] Linking C executable bin/game")
+
+        chunk = ("\r\n".join(lines) + "\r\n").encode()
+        output.append(chunk)
+        total += len(chunk)
+
+    return b"".join(output)[:size]
+
+
+def utf8_text(size: int, seed: int = 4) -> bytes:
+    rng = random.Random(seed)
+    words = [
+        "터미널", "한글", "입력", "ターミナル", "日本語", "漢字", "終端", "Überprüfung", "größe", "naïve",
+        "café", "Ωμέγα", "Привет", "мир", "🎮", "🚀", "✓", "→", "box", "drawing", "┌──┐", "│ok│", "└──┘",
+    ]
+
+    output: List[bytes] = []
+    total = 0
+    while total < size:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(3, 16)))
+        chunk = (line + "\r\n").encode()
+        output.append(chunk)
+        total += len(chunk)
+
+    data = b"".join(output)[:size]
+    # don't end on a partial code point, the decoders would carry it forever
+    return data.decode("utf-8", errors="ignore").encode("utf-8")
+
+
+CORPORA: Dict[str, Callable[[int], bytes]] = {
+    "ls-R": ls_recursive,
+    "htop": htop_redraws,
+    "compiler": compiler_log,
+    "utf8": utf8_text,
+}
+
+
+def load_cast(path: str) -> bytes:
+    # the output of an asciicast v2 recording, e.g. one made with start_terminal_recording
+    opener = gzip.open if path.endswith(".gz") else open
+    output: List[bytes] = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        next(f)  # header
+        for line in f:
+            if not line.strip():
+                continue
+            _, type, data = json.loads(line)
+            if type == "o":
+                output.append(data.encode("utf-8"))
+
+    return b"".join(output)
+
+
+def chunked(data: bytes, size: int = 4096) -> List[bytes]:
+    # roughly what a single read from the PTY hands us
+    return [data[i:i + size] for i in range(0, len(data), size)]
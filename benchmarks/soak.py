@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from . import stub
+
+decky = stub.install()
+
+from decky_terminal import DeckyTerminal  # noqa: E402
+
+# End to end load test: real PTY sessions driven through DeckyTerminal, the same way main.py does.
+# Output generators keep the reader busy while echo probes measure what a user typing would feel.
+
+_GENERATOR = """#!{python}
+import os, time
+rate = {rate}
+line = b"soak " + b"0123456789abcdef" * 4 + b"\\r\\n"
+block = line * 64
+tick = 0.01
+next_tick = time.monotonic()
+while True:
+    if rate <= 0:
+        os.write(1, block)
+        continue
+    budget = int(rate * tick)
+    while budget > 0:
+        budget -= os.write(1, block[:min(budget, len(block))])
+    next_tick += tick
+    delay = next_tick - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    else:
+        next_tick = time.monotonic()
+"""
+
+
+def _percentiles(values: List[float]) -> dict:
+    if len(values) == 0:
+        return dict(count=0)
+
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    return dict(
+        count=len(values),
+        p50=at(0.5),
+        p90=at(0.9),
+        p99=at(0.99),
+        max=values[-1],
+        mean=statistics.fmean(values),
+    )
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak instead of current, still good enough to spot growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _executor_stats(loop: asyncio.AbstractEventLoop) -> Optional[dict]:
+    executor = getattr(loop, "_default_executor", None)
+    if executor is None:
+        return None
+
+    return dict(
+        threads=len(getattr(executor, "_threads", ())),
+        max_workers=getattr(executor, "_max_workers", None),
+        queued=executor._work_queue.qsize() if hasattr(executor, "_work_queue") else None,
+    )
+
+
+class EchoProbe:
+    terminal_id: str = None
+    event: str = None
+
+    _pending: Dict[str, float] = None
+    _seen: str = ""
+
+    def __init__(self, terminal_id: str):
+        self.terminal_id = terminal_id
+        self.event = "terminal_output#" + terminal_id
+        self.latencies: List[float] = []
+        self._pending = dict()
+        self._seen = ""
+        self._counter = 0
+
+    def on_emit(self, event: str, data=None, *args):
+        if event != self.event or not isinstance(data, str):
+            return
+
+        # markers may be split across emits, keep a short tail around
+        self._seen = (self._seen + data)[-256:]
+        now = time.perf_counter()
+        for marker, sent in list(self._pending.items()):
+            if marker in self._seen:
+                self.latencies.append(now - sent)
+                del self._pending[marker]
+
+    async def run(self, decky_terminal: DeckyTerminal, interval: float, stop: asyncio.Event):
+        terminal = decky_terminal.get_terminal(self.terminal_id)
+        while not stop.is_set():
+            self._counter += 1
+            marker = f"k{self._counter:06d}"
+            self._pending[marker] = time.perf_counter()
+            await terminal.send_input(marker)
+
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+            # kill the line again, nothing should ever run
+            self._pending.pop(marker, None)
+            await terminal.send_input("\x15")
+
+    @property
+    def lost(self) -> int:
+        return self._counter - len(self.latencies)
+
+
+class Soak:
+    def __init__(self, args):
+        self.args = args
+        self.loop_lag: List[float] = []
+        self.samples: List[dict] = []
+        self.probes: List[EchoProbe] = []
+        self.generators: List[str] = []
+        self.stop = asyncio.Event()
+        self.decky_terminal: DeckyTerminal = None
+
+    # SETUP =================================================
+    def _write_config(self):
+        config = dict(__version__=1)
+        for item in self.args.config or []:
+            key, _, value = item.partition("=")
+            config[key] = json.loads(value)
+
+        os.makedirs(decky.DECKY_PLUGIN_SETTINGS_DIR, exist_ok=True)
+        with open(os.path.join(decky.DECKY_PLUGIN_SETTINGS_DIR, "config.json"), "w") as f:
+            json.dump(config, f)
+
+    def _write_generator(self, directory: str) -> str:
+        path = os.path.join(directory, "generator.py")
+        with open(path, "w") as f:
+            f.write(_GENERATOR.format(python=sys.executable, rate=self.args.rate))
+        os.chmod(path, 0o755)
+        return path
+
+    async def _start(self, directory: str):
+        self._write_config()
+        self.decky_terminal = DeckyTerminal()
+        await self.decky_terminal.initialize()
+
+        generator = self._write_generator(directory)
+        for index in range(self.args.terminals):
+            terminal_id = f"soak-gen-{index}"
+            await self.decky_terminal.create_terminal(terminal_id, generator)
+            await self.decky_terminal.subscribe(terminal_id)
+            self.generators.append(terminal_id)
+
+        for index in range(self.args.echo_terminals):
+            terminal_id = f"soak-echo-{index}"
+            await self.decky_terminal.create_terminal(terminal_id, self.args.shell)
+            await self.decky_terminal.subscribe(terminal_id)
+            probe = EchoProbe(terminal_id)
+            stub.emit.listeners.append(probe.on_emit)
+            self.probes.append(probe)
+
+    async def _stop(self):
+        stub.emit.listeners.clear()
+        await self.decky_terminal._kill_all_terminals()
+        await self.decky_terminal.shutdown()
+
+    # MEASUREMENTS ==========================================
+    async def _measure_lag(self):
+        interval = 0.01
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+    async def _sample(self):
+        loop = asyncio.get_event_loop()
+        started = time.perf_counter()
+        last_seq = {terminal_id: 0 for terminal_id in self.generators}
+        last_time = started
+
+        while not self.stop.is_set():
+            try:
+                await asyncio.wait_for(self.stop.wait(), self.args.sample_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            now = time.perf_counter()
+            rates = []
+            for terminal_id in self.generators:
+                terminal = self.decky_terminal.get_terminal(terminal_id)
+                rates.append((terminal.output_seq - last_seq[terminal_id]) / (now - last_time))
+                last_seq[terminal_id] = terminal.output_seq
+            last_time = now
+
+            sample = dict(
+                time=now - started,
+                rss=_rss(),
+                throughput=rates,
+                executor=_executor_stats(loop),
+                emits=stub.emit.count,
+            )
+            self.samples.append(sample)
+            if not self.args.json:
+                print(self._format_sample(sample), flush=True)
+
+    def _format_sample(self, sample: dict) -> str:
+        rates = sample["throughput"]
+        line = f"{sample['time']:7.1f}s  rss {sample['rss'] / 1024 / 1024:7.1f} MiB"
+        if rates:
+            line += f"  per terminal {statistics.fmean(rates) / 1e6:6.2f} MB/s (min {min(rates) / 1e6:.2f})"
+        if self.loop_lag:
+            line += f"  loop lag max {max(self.loop_lag[-100:]) * 1000:6.1f} ms"
+        executor = sample["executor"]
+        if executor is not None:
+            line += f"  executor {executor['threads']}/{executor['max_workers']} threads, {executor['queued']} queued"
+        return line
+
+    # RUN ===================================================
+    async def run(self) -> dict:
+        with tempfile.TemporaryDirectory(prefix="decky-terminal-soak-") as directory:
+            await self._start(directory)
+            tasks = [
+                asyncio.ensure_future(self._measure_lag()),
+                asyncio.ensure_future(self._sample()),
+            ]
+            tasks += [
+                asyncio.ensure_future(probe.run(self.decky_terminal, self.args.echo_interval, self.stop))
+                for probe in self.probes
+            ]
+
+            await asyncio.sleep(self.args.duration)
+            self.stop.set()
+            await asyncio.gather(*tasks)
+            await self._stop()
+
+        return self.report()
+
+    def report(self) -> dict:
+        # the first sample includes process startup, leave it out of the steady state numbers
+        steady = self.samples[1:] or self.samples
+        rates = [rate for sample in steady for rate in sample["throughput"]]
+        executors = [sample["executor"] for sample in self.samples if sample["executor"] is not None]
+
+        return dict(
+            parameters=dict(
+                terminals=self.args.terminals,
+                echo_terminals=self.args.echo_terminals,
+                rate=self.args.rate,
+                duration=self.args.duration,
+                config=self.args.config or [],
+            ),
+            echo_latency_ms={
+                key: value * 1000 if key != "count" else value
+                for key, value in _percentiles([latency for probe in self.probes for latency in probe.latencies]).items()
+            },
+            echo_lost=sum(probe.lost for probe in self.probes),
+            loop_lag_ms={
+                key: value * 1000 if key != "count" else value
+                for key, value in _percentiles(self.loop_lag).items()
+            },
+            throughput_per_terminal_mb_s=dict(
+                mean=statistics.fmean(rates) / 1e6 if rates else 0.0,
+                min=min(rates) / 1e6 if rates else 0.0,
+            ),
+            executor=dict(
+                max_threads=max((executor["threads"] for executor in executors), default=0),
+                max_queued=max((executor["queued"] or 0 for executor in executors), default=0),
+            ),
+            rss_mib=dict(
+                start=self.samples[0]["rss"] / 1024 / 1024 if self.samples else 0.0,
+                end=self.samples[-1]["rss"] / 1024 / 1024 if self.samples else 0.0,
+                growth=(steady[-1]["rss"] - steady[0]["rss"]) / 1024 / 1024 if steady else 0.0,
+            ),
+            emits=stub.emit.count,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.soak", description="PTY load and soak test")
+    parser.add_argument("--terminals", type=int, default=4, help="terminals running an output generator (default: 4)")
+    parser.add_argument("--echo-terminals", type=int, default=2, help="terminals probing keystroke echo (default: 2)")
+    parser.add_argument("--rate", type=int, default=256 * 1024, help="output bytes/s per generator, 0 for as fast as possible (default: 256 KiB/s)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run (default: 30)")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between samples (default: 1)")
+    parser.add_argument("--echo-interval", type=float, default=0.05, help="seconds between keystrokes per echo terminal (default: 0.05)")
+    parser.add_argument("--shell", default="/bin/sh", help="shell used by the echo terminals (default: /bin/sh)")
+    parser.add_argument("--config", action="append", metavar="KEY=JSON", help="config.json entry, e.g. output_budget=0 (repeatable)")
+    parser.add_argument("--json", action="store_true", help="only print the final report, as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(Soak(args).run())
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import collections
+import logging
+import os
+import sys
+import tempfile
+import types
+from typing import Callable, List
+
+# Stand-in for the modules Decky Loader injects, so the plugin can be imported outside of it.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class EmitRecorder:
+    count: int = 0
+    size: int = 0
+
+    # only the tail is kept, a benchmark run emits far too much to keep all of it
+    events: collections.deque = None
+
+    # called with every emit, e.g. to look for an echo
+    listeners: List[Callable[..., None]] = None
+
+    def __init__(self, keep: int = 64):
+        self.events = collections.deque(maxlen=keep)
+        self.listeners = []
+
+    async def __call__(self, event: str, *args):
+        self.count += 1
+        for arg in args:
+            if isinstance(arg, (str, bytes)):
+                self.size += len(arg)
+        self.events.append((event,) + args)
+
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def reset(self):
+        self.count = 0
+        self.size = 0
+        self.events.clear()
+
+
+emit = EmitRecorder()
+
+
+def install(base_dir: str = None) -> types.ModuleType:
+    if "decky" in sys.modules and getattr(sys.modules["decky"], "emit", None) is emit:
+        return sys.modules["decky"]
+
+    if base_dir is None:
+        base_dir = tempfile.mkdtemp(prefix="decky-terminal-bench-")
+
+    logger = logging.getLogger("decky")
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    decky = types.ModuleType("decky")
+    decky.logger = logger
+    decky.emit = emit
+    for name in ("SETTINGS", "RUNTIME", "LOG"):
+        path = os.path.join(base_dir, name.lower())
+        os.makedirs(path, exist_ok=True)
+        setattr(decky, f"DECKY_PLUGIN_{name}_DIR", path)
+
+    sys.modules["decky"] = decky
+    sys.modules["decky_plugin"] = decky
+
+    py_modules = os.path.join(ROOT, "py_modules")
+    if py_modules not in sys.path:
+        sys.path.insert(0, py_modules)
+
+    return decky
@@ -1,16 +1,43 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Union
 from decky_terminal import DeckyTerminal
 
 import decky
 
+# operations accepted by Plugin.batch, mapped to the plugin method they run
+BATCH_OPERATIONS = {
+    "input": "send_terminal_input",
+    "paste": "send_terminal_paste",
+    "resize": "change_terminal_window_size",
+    "title": "set_terminal_title",
+    "subscribe": "subscribe_terminal",
+    "unsubscribe": "unsubscribe_terminal",
+    "buffer": "send_terminal_buffer",
+    "resume": "resume_terminal",
+    "range": "get_terminal_buffer_range",
+    "get": "get_terminal",
+    "stats": "get_terminal_stats",
+    "search": "search_terminal",
+    "terminals": "get_terminals",
+}
+
 class Plugin:
     decky_terminal = DeckyTerminal()
 
     async def is_running(self) -> bool:
         return Plugin.decky_terminal.is_running()
 
-    async def get_terminals(self) -> List[dict]:
-        terminals = Plugin.decky_terminal.get_terminals()
+    # since_version and epoch as the client got them with its last reply. with a version
+    # from another epoch (plugin reload) or one too old to diff it gets the full list and
+    # reset, anything it knows of that isn't in there is gone
+    async def get_terminals(self, since_version: Optional[int] = None, epoch: Optional[str] = None) -> Union[List[dict], dict]:
+        reset = since_version is not None and not Plugin.decky_terminal.can_get_changes(since_version, epoch)
+        if since_version is None or reset:
+            terminals = Plugin.decky_terminal.get_terminals()
+            removed = []
+        else:
+            # only what changed since the version the client has seen
+            terminals, removed = Plugin.decky_terminal.get_changes(since_version)
+
         output = []
 
         for terminal_id, terminal in terminals.items():
@@ -18,7 +45,16 @@ class Plugin:
             result["id"] = terminal_id  # TODO: should a terminal own its ID?
             output.append(result)
 
-        return output
+        if since_version is None:
+            return output
+
+        return dict(
+            version=Plugin.decky_terminal.get_version(),
+            epoch=Plugin.decky_terminal.get_version_epoch(),
+            reset=reset,
+            terminals=output,
+            removed=removed,
+        )
 
     async def get_terminal(self, terminal_id: str) -> Optional[dict]:
         terminal = Plugin.decky_terminal.get_terminal(terminal_id)
@@ -27,11 +63,41 @@ class Plugin:
 
         return terminal.serialize()
 
-    async def set_terminal_title(self, terminal_id: str, title: str) -> bool:
-        Plugin.decky_terminal.set_terminal_title(terminal_id, title)
+    async def get_terminal_stats(self, terminal_id: str) -> Optional[dict]:
+        return Plugin.decky_terminal.get_terminal_stats(terminal_id)
+
+    async def get_stats(self) -> dict:
+        return Plugin.decky_terminal.get_stats()
+
+    async def start_profiling(self, duration: float = 10, mode: str = "sample", allocations: bool = False) -> bool:
+        # mode is "sample", "deterministic" (cProfile) or "none" for allocation tracking only
+        return Plugin.decky_terminal.start_profiling(duration, mode, allocations)
+
+    async def stop_profiling(self) -> Optional[dict]:
+        # returns the last result if the time window already ran out
+        return await Plugin.decky_terminal.stop_profiling()
 
-    async def create_terminal(self, terminal_id=None) -> bool:
-        await Plugin.decky_terminal.create_terminal(terminal_id)
+    # one-shot command without a pty, output arrives in batches on `command_output#<command_id>`
+    # as [[stream, text], ...]. returns once it exited, max_output caps what is streamed (0: no cap)
+    async def run_command(self, argv: List[str], timeout: float = 60, max_output: Optional[int] = None, command_id: Optional[str] = None) -> Optional[dict]:
+        try:
+            return await Plugin.decky_terminal.run_command(argv, timeout, max_output, command_id)
+        except Exception as e:
+            decky.logger.error("[command][ERROR][%s] Exception during run: %s", command_id, e)
+            return None
+
+    async def cancel_command(self, command_id: str) -> bool:
+        return Plugin.decky_terminal.cancel_command(command_id)
+
+    async def set_terminal_title(self, terminal_id: str, title: str) -> bool:
+        return Plugin.decky_terminal.set_terminal_title(terminal_id, title)
+
+    # rows and cols of the view it is created for, a pre-spawned shell is resized to them
+    # before it is handed out instead of redrawing once the view reports its size
+    async def create_terminal(self, terminal_id=None, rows: Optional[int] = None, cols: Optional[int] = None) -> bool:
+        if not all(isinstance(size, int) and not isinstance(size, bool) and size > 0 for size in (rows, cols)):
+            rows, cols = None, None
+        await Plugin.decky_terminal.create_terminal(terminal_id, rows=rows, cols=cols)
         return True
 
     async def remove_terminal(self, terminal_id) -> bool:
@@ -51,12 +117,23 @@ class Plugin:
         except:
             return False
 
-    async def send_terminal_buffer(self, terminal_id: str) -> bool:
+    # large inputs: written in tty sized chunks, progress is emitted on `terminal_paste#<terminal_id>`
+    async def send_terminal_paste(self, terminal_id: str, data: str, paste_id: Optional[str] = None) -> bool:
+        try:
+            terminal = Plugin.decky_terminal.get_terminal(terminal_id)
+            if terminal is not None:
+                return await terminal.paste(data, paste_id)
+            return False
+        except Exception as e:
+            decky.logger.error("[terminal][ERROR][%s] Exception during paste: %s", terminal_id, e)
+            return False
+
+    async def send_terminal_buffer(self, terminal_id: str, subscriber_id: Optional[str] = None) -> bool:
         decky.logger.info("[terminal][INFO][%s] Received request to send terminal buffer.", terminal_id)
         try:
             terminal = Plugin.decky_terminal.get_terminal(terminal_id)
             if terminal is not None:
-                await terminal.send_current_buffer()
+                await terminal.send_current_buffer(subscriber_id)
                 return True
             decky.logger.error("[terminal][ERROR][%s] Terminal not found.", terminal_id)
             return False
@@ -64,16 +141,62 @@ class Plugin:
             decky.logger.error("[terminal][ERROR][%s] Exception during send terminal buffer: %s", terminal_id, e)
             return False
         
-    async def subscribe_terminal(self, terminal_id: str) -> bool:
+    async def get_terminal_buffer_range(self, terminal_id: str, offset: int, length: int) -> Optional[dict]:
+        terminal = Plugin.decky_terminal.get_terminal(terminal_id)
+        if terminal is None:
+            return None
+
         try:
-            await Plugin.decky_terminal.subscribe(terminal_id)
-            return True
+            return terminal.get_buffer_range(offset, length)
+        except Exception as e:
+            decky.logger.error("[terminal][ERROR][%s] Exception during buffer range read: %s", terminal_id, e)
+            return None
+
+    # last_seq and epoch as the client got them with its last output (emit or get_terminal).
+    # a different epoch (plugin reload, reattach) or a seq that is gone gets a snapshot instead
+    async def resume_terminal(self, terminal_id: str, last_seq: int, epoch: Optional[str] = None) -> Optional[dict]:
+        terminal = Plugin.decky_terminal.get_terminal(terminal_id)
+        if terminal is None:
+            return None
+
+        try:
+            return terminal.resume(last_seq, epoch)
+        except Exception as e:
+            decky.logger.error("[terminal][ERROR][%s] Exception during resume: %s", terminal_id, e)
+            return None
+
+    # asciicast v2 files under <log dir>/recordings, rotated and gzipped by size
+    async def start_terminal_recording(self, terminal_id: str, record_input: bool = False) -> bool:
+        return Plugin.decky_terminal.start_recording(terminal_id, record_input)
+
+    async def stop_terminal_recording(self, terminal_id: str) -> Optional[List[str]]:
+        try:
+            return await Plugin.decky_terminal.stop_recording(terminal_id)
+        except Exception as e:
+            decky.logger.error("[terminal][ERROR][%s] Exception during recording stop: %s", terminal_id, e)
+            return None
+
+    # matches in the server side history, newest `limit` ones: line numbers count from the
+    # start of the session, start/end are offsets into the line with escape sequences removed.
+    # None for an unknown terminal, {"error": ...} for a pattern that doesn't compile
+    async def search_terminal(self, terminal_id: str, pattern: str, regex: bool = False, limit: int = 100, ignore_case: bool = False) -> Optional[dict]:
+        try:
+            return await Plugin.decky_terminal.search_terminal(terminal_id, pattern, regex, limit, ignore_case)
+        except Exception as e:
+            decky.logger.error("[terminal][ERROR][%s] Exception during search: %s", terminal_id, e)
+            return None
+
+    # subscriber_id lets several views follow the same terminal independently,
+    # their output arrives on `terminal_output#<terminal_id>#<subscriber_id>`.
+    async def subscribe_terminal(self, terminal_id: str, subscriber_id: Optional[str] = None) -> bool:
+        try:
+            return await Plugin.decky_terminal.subscribe(terminal_id, subscriber_id)
         except:
             return False
     
-    async def unsubscribe_terminal(self, terminal_id: str) -> bool:
+    async def unsubscribe_terminal(self, terminal_id: str, subscriber_id: Optional[str] = None) -> bool:
         try:
-            await Plugin.decky_terminal.unsubscribe(terminal_id)
+            await Plugin.decky_terminal.unsubscribe(terminal_id, subscriber_id)
             return True
         except:
             return False
@@ -88,6 +211,24 @@ class Plugin:
         except:
             return False
 
+    async def batch(self, ops: List[Dict[str, Any]]) -> List[dict]:
+        # runs the operations in order, e.g. [{"op": "input", "terminal_id": "...", "data": "ls\n"}]
+        results = []
+        for op in ops:
+            try:
+                params = dict(op)
+                method = BATCH_OPERATIONS.get(params.pop("op", None))
+                if method is None:
+                    results.append(dict(ok=False, error="unknown operation"))
+                    continue
+
+                result = await getattr(self, method)(**params)
+                results.append(dict(ok=True, result=result))
+            except Exception as e:
+                results.append(dict(ok=False, error=str(e)))
+
+        return results
+
     async def get_config(self) -> str:
         return await Plugin.decky_terminal.get_config()
 
@@ -104,10 +245,10 @@ class Plugin:
         return await Plugin.decky_terminal.set_default_shell(shell)
 
     async def _main(self):
-        pass
+        await Plugin.decky_terminal.initialize()
 
     async def _unload(self):
-        pass
+        await Plugin.decky_terminal.shutdown()
 
     async def _migration(self):
         pass
@@ -1,25 +1,106 @@
 import asyncio
-import json
 import os
 import platform
 import random
+import time
 import uuid
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import decky
 from decky_plugin import DECKY_PLUGIN_SETTINGS_DIR
 
-from .common import Common
+from .command import CommandRunner
+from .config import CachedFile, ConfigFile
+from .holder import HolderClient, socket_path
 from .terminal import Terminal
 from .nato import phoneticize
+from .pool import ShellPool
+from .profiler import Profiler
+from .stats import TerminalStats
 
 
 class DeckyTerminal:
     _event_loop = None
     _terminal_sessions = dict()
 
+    _config_file: ConfigFile = None
+    _shells_file: CachedFile = None
+    _shell_pool: ShellPool = None
+    _command_runner: CommandRunner = None
+    _profiler: Profiler = None
+
+    # bumped on every change of any session, lets clients ask for what changed since.
+    # it starts over with every instance, the epoch tells a client its version is stale
+    _version: int = 0
+    _version_epoch: str = ""
+    _removed_versions: Dict[str, int] = None
+    _max_removed_versions: int = 256
+    # version of the newest removal forgotten, anything up to it can't be diffed anymore
+    _removed_versions_floor: int = 0
+
+    # counters of sessions that are gone, so plugin-wide totals don't shrink
+    _removed_stats: TerminalStats = None
+    _stats_log_interval: float = 0
+    _stats_log_task: asyncio.Future = None
+
+    # unsubscribed sessions without input for this long get their buffers compressed, 0 disables it
+    _hibernate_after: float = 300
+    _hibernation_task: asyncio.Future = None
+
+    # bytes all sessions together may keep in memory, over it the least recently viewed
+    # ones are hibernated and then lose their history. 0 disables it
+    _memory_budget: int = 64 * 1024 * 1024
+    _memory_check_interval: float = 5
+    # once over the budget usage is brought down to this share of it, so the next check
+    # doesn't find it just over again. sessions with output this recent aren't hibernated,
+    # their tail fills up and wakes them right back up
+    _memory_low_watermark: float = 0.8
+    _memory_quiet_time: float = 30
+    _memory_task: asyncio.Future = None
+
+    # sessions kept alive in the holder daemon across plugin reloads, opt-in
+    _persistent_sessions: bool = False
+    _holder: Optional[HolderClient] = None
+
     def __init__(self) -> None:
         self._event_loop = asyncio.get_event_loop()
+        self._config_file = ConfigFile(self.get_config_filename())
+        self._shells_file = CachedFile("/etc/shells", self._parse_shells)
+        self._shell_pool = ShellPool()
+        self._command_runner = CommandRunner()
+        self._profiler = Profiler()
+        self._version_epoch = uuid.uuid4().hex
+        self._removed_versions = dict()
+        self._removed_stats = TerminalStats()
+
+    # LIFECYCLE =============================================
+    async def initialize(self):
+        await self._configure_persistence()
+        if self._holder is not None:
+            await self._reattach_sessions()
+        await self._configure_shell_pool()
+        self._shell_pool.refill()
+        await self._configure_stats_logging()
+        await self._configure_hibernation()
+        await self._configure_memory_budget()
+
+    async def shutdown(self):
+        self._shell_pool.invalidate()
+        self._command_runner.cancel_all()
+        if self._stats_log_task is not None:
+            self._stats_log_task.cancel()
+            self._stats_log_task = None
+        if self._profiler.is_running:
+            await self._profiler.stop()
+        if self._hibernation_task is not None:
+            self._hibernation_task.cancel()
+            self._hibernation_task = None
+        if self._memory_task is not None:
+            self._memory_task.cancel()
+            self._memory_task = None
+        if self._holder is not None:
+            await self._detach_sessions()
 
     # GET_FETCH =============================================
     def is_running(self):
@@ -31,15 +112,15 @@ class DeckyTerminal:
         if platform.system() == "Windows":
             return ["powershell", "cmd"]
         else:
-            data = await Common.read_file("/etc/shells")
-            if data is not None:
-                shells = data.splitlines()
-                shells = list(filter(self._is_unix_shell_path, shells))
-                if shells:
-                    return shells
+            shells = await self._shells_file.read()
+            if shells:
+                return list(shells)
 
             return ["/bin/sh"]
 
+    def _parse_shells(self, data: str) -> List[str]:
+        return list(filter(self._is_unix_shell_path, data.splitlines()))
+
     def _is_unix_shell_path(self, path: str) -> bool:
         return path.startswith("/")
 
@@ -58,14 +139,31 @@ class DeckyTerminal:
         return config
 
     async def append_config(self, new_config: Dict[str, Any]) -> bool:
-        prev_config = await self._get_config()
-        if prev_config is None:
-            prev_config = dict(
-                __version__=1,
-            )
+        result = await self._config_file.update(new_config)
+
+        if any(key in new_config for key in ("default_shell", "use_display", "shell_pool_size")):
+            # idle sessions were spawned for the previous shell / environment
+            await self._configure_shell_pool()
+            self._shell_pool.refill()
+
+        if "persistent_sessions" in new_config:
+            await self._configure_persistence()
+
+        if "stats_log_interval" in new_config:
+            await self._configure_stats_logging()
+
+        if "hibernate_after" in new_config:
+            await self._configure_hibernation()
+
+        if "memory_budget" in new_config:
+            await self._configure_memory_budget()
+
+        output_batching = self._get_output_batching_flags(new_config)
+        if output_batching:
+            for terminal in self._terminal_sessions.values():
+                terminal.configure_output_batching(**output_batching)
 
-        config = Common.merge_dict(prev_config, new_config)
-        return await self._write_config(config)
+        return result
 
     async def get_default_shell(self) -> str:
         config = await self.get_config()
@@ -83,33 +181,28 @@ class DeckyTerminal:
         return await self.append_config(dict(default_shell=shell))
     
     # SUBSCRIPTION ============================================
-    async def subscribe(self, terminal_id: str) -> bool:
+    async def subscribe(self, terminal_id: str, handle: Optional[str] = None) -> bool:
         term = self.get_terminal(terminal_id)         
         if term is not None:
-            return term.subscribe()
+            term.subscribe(handle)
+            return True
         
         return False
 
-    async def unsubscribe(self, terminal_id: str) -> bool:
+    async def unsubscribe(self, terminal_id: str, handle: Optional[str] = None) -> bool:
         term = self.get_terminal(terminal_id)         
         if term is not None:
-            return term.unsubscribe()
+            term.unsubscribe(handle)
         
         return True
 
     # CONFIG - INTERNAL =======================================
     async def _get_config(self) -> Optional[dict]:
-        try:
-            data = await Common.read_file(self.get_config_filename())
-            if data is None:
-                raise IOError()
-
-            return json.loads(data)
-        except IOError:
-            return None
+        # cached, only re-read when the file changed on disk
+        return await self._config_file.read()
 
     async def _write_config(self, config: dict) -> bool:
-        return await Common.write_file(self.get_config_filename(), json.dumps(config))
+        return await self._config_file.write(config)
 
     async def _get_terminal_flags(self) -> dict:
         flags = dict()
@@ -121,10 +214,350 @@ class DeckyTerminal:
                 if isinstance(use_display, bool):
                     flags["use_display"] = use_display
 
+            scrollback_size = config.get("scrollback_size")
+            if isinstance(scrollback_size, int) and not isinstance(scrollback_size, bool) and scrollback_size > 0:
+                flags["scrollback_size"] = scrollback_size
+
+            scrollback_lines = config.get("scrollback_lines")
+            if isinstance(scrollback_lines, int) and not isinstance(scrollback_lines, bool) and scrollback_lines >= 0:
+                flags["scrollback_lines"] = scrollback_lines
+
+            screen_snapshot = config.get("screen_snapshot")
+            if isinstance(screen_snapshot, bool):
+                flags["screen_snapshot"] = screen_snapshot
+
+            disk_scrollback = config.get("disk_scrollback")
+            if isinstance(disk_scrollback, bool):
+                flags["disk_scrollback"] = disk_scrollback
+
+            output_budget = config.get("output_budget")
+            if isinstance(output_budget, int) and not isinstance(output_budget, bool) and output_budget >= 0:
+                flags["output_budget"] = output_budget
+
+            subscriber_queue_size = config.get("subscriber_queue_size")
+            if isinstance(subscriber_queue_size, int) and not isinstance(subscriber_queue_size, bool) and subscriber_queue_size > 0:
+                flags["subscriber_queue_size"] = subscriber_queue_size
+
+            search_lines = config.get("search_lines")
+            if isinstance(search_lines, int) and not isinstance(search_lines, bool) and search_lines >= 0:
+                flags["search_lines"] = search_lines
+
+            disk_scrollback_size = config.get("disk_scrollback_size")
+            if isinstance(disk_scrollback_size, int) and not isinstance(disk_scrollback_size, bool) and disk_scrollback_size > 0:
+                flags["disk_scrollback_size"] = disk_scrollback_size
+
+            output_batching = self._get_output_batching_flags(config)
+            if output_batching:
+                flags["output_batching"] = output_batching
+
+            recording = self._get_recording_flags(config)
+            if recording:
+                flags["recording"] = recording
+
+        return flags
+
+    def _get_recording_flags(self, config: dict) -> dict:
+        flags = dict()
+        for key, flag in (
+            ("recording_max_size", "max_size"),
+            ("recording_max_files", "max_files"),
+        ):
+            value = config.get(key)
+            if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+                flags[flag] = value
+
+        return flags
+
+    def _get_output_batching_flags(self, config: dict) -> dict:
+        flags = dict()
+        for key, flag in (
+            ("output_bulk_threshold", "bulk_threshold"),
+            ("output_batch_interval", "batch_interval"),
+            ("output_batch_size", "batch_size"),
+        ):
+            value = config.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                flags[flag] = value
+
         return flags
 
+    # SHELL POOL ============================================
+    async def _configure_shell_pool(self):
+        config = await self._get_config()
+        size = 0
+        if config is not None:
+            shell_pool_size = config.get("shell_pool_size")
+            if isinstance(shell_pool_size, int) and not isinstance(shell_pool_size, bool):
+                size = shell_pool_size
+
+        self._shell_pool.configure(size, await self.get_default_shell(), await self._get_terminal_flags())
+
+    # COMMANDS ==============================================
+    async def run_command(self, argv: List[str], timeout: float = 60, max_output: Optional[int] = None, command_id: Optional[str] = None) -> dict:
+        await self._configure_command_runner()
+        return await self._command_runner.run(argv, timeout, max_output, command_id)
+
+    def cancel_command(self, command_id: str) -> bool:
+        return self._command_runner.cancel(command_id)
+
+    async def _configure_command_runner(self):
+        config = await self._get_config()
+        max_concurrent = CommandRunner.max_concurrent
+        flags = dict()
+        if config is not None:
+            command_concurrency = config.get("command_concurrency")
+            if isinstance(command_concurrency, int) and not isinstance(command_concurrency, bool) and command_concurrency > 0:
+                max_concurrent = command_concurrency
+
+            output_batching = self._get_output_batching_flags(config)
+            if output_batching:
+                flags["output_batching"] = output_batching
+
+        self._command_runner.configure(max_concurrent, flags)
+
+    # PERSISTENCE ===========================================
+    async def _configure_persistence(self):
+        config = await self._get_config()
+        enabled = False
+        if config is not None:
+            persistent_sessions = config.get("persistent_sessions")
+            if isinstance(persistent_sessions, bool):
+                enabled = persistent_sessions
+
+        # leftovers from an earlier run are picked up even if it was switched off since
+        if self._holder is None and (enabled or os.path.exists(socket_path())):
+            holder = HolderClient(socket_path())
+            if await holder.connect(spawn=enabled):
+                self._holder = holder
+
+        self._persistent_sessions = enabled and self._holder is not None
+        holder = self._holder if self._persistent_sessions else None
+        if self._shell_pool.holder is not holder:
+            # idle sessions live on the wrong side now
+            self._shell_pool.invalidate()
+            self._shell_pool.holder = holder
+
+    async def _reattach_sessions(self):
+        try:
+            sessions = await self._holder.list()
+        except (ConnectionError, RuntimeError) as e:
+            decky.logger.error("[terminal][ERROR] Unable to list held sessions: %s", e)
+            return
+
+        flags = await self._get_terminal_flags()
+        for session in sessions:
+            terminal_id = session["id"]
+            try:
+                if terminal_id.startswith("pool-") or terminal_id in self._terminal_sessions:
+                    # idle pool shells are cheap to spawn again
+                    await self._holder.close_session(terminal_id)
+                    continue
+
+                _, master_fd, buffer, process = await self._holder.attach(terminal_id)
+                terminal = Terminal(terminal_id, session["cmdline"], **flags)
+                terminal.holder = self._holder
+                self._add_terminal(terminal_id, terminal)
+                await terminal.reattach(master_fd, process, buffer, session.get("title"))
+            except Exception as e:
+                decky.logger.exception("[terminal][EXCEPTION][%s] Exception during reattach: %s", terminal_id, e)
+
+        if len(sessions) > 0:
+            decky.logger.info("[terminal][INFO] Reattached to %d held sessions.", len(self._terminal_sessions))
+
+    async def _detach_sessions(self):
+        for terminal in self._terminal_sessions.values():
+            if terminal.held:
+                await terminal.detach()
+
+        self._holder.close()
+        self._holder = None
+
+    # SEARCH ================================================
+    async def search_terminal(self, terminal_id: str, pattern: str, regex: bool = False, limit: int = 100, ignore_case: bool = False) -> Optional[dict]:
+        term = self.get_terminal(terminal_id)
+        if term is not None:
+            return await term.search(pattern, regex, limit, ignore_case)
+
+        return None
+
+    # RECORDING =============================================
+    def start_recording(self, terminal_id: str, record_input: bool = False) -> bool:
+        term = self.get_terminal(terminal_id)
+        if term is not None:
+            return term.start_recording(record_input)
+
+        return False
+
+    async def stop_recording(self, terminal_id: str) -> Optional[List[str]]:
+        term = self.get_terminal(terminal_id)
+        if term is not None:
+            return await term.stop_recording()
+
+        return None
+
+    # STATS =================================================
+    def get_terminal_stats(self, terminal_id: str) -> Optional[dict]:
+        term = self.get_terminal(terminal_id)
+        if term is not None:
+            return term.get_stats()
+
+        return None
+
+    def get_stats(self) -> dict:
+        totals = TerminalStats()
+        totals.merge(self._removed_stats)
+        for terminal in self._terminal_sessions.values():
+            totals.merge(terminal.stats)
+
+        data = totals.serialize()
+        data["terminals"] = len(self._terminal_sessions)
+        data["throttled"] = sum(1 for terminal in self._terminal_sessions.values() if terminal.throttled is not None)
+        data["pool_idle"] = self._shell_pool.idle_size
+
+        usage = {terminal_id: terminal.memory_usage() for terminal_id, terminal in self._terminal_sessions.items()}
+        data["memory"] = dict(
+            budget=self._memory_budget,
+            used=sum(terminal["total"] for terminal in usage.values()),
+            terminals=usage,
+        )
+        return data
+
+    # PROFILING =============================================
+    def start_profiling(self, duration: float = 10, mode: str = "sample", allocations: bool = False) -> bool:
+        return self._profiler.start(duration, mode, allocations)
+
+    async def stop_profiling(self) -> Optional[dict]:
+        return await self._profiler.stop()
+
+    async def _configure_stats_logging(self):
+        config = await self._get_config()
+        interval = 0
+        if config is not None:
+            stats_log_interval = config.get("stats_log_interval")
+            if isinstance(stats_log_interval, (int, float)) and not isinstance(stats_log_interval, bool):
+                interval = max(0, stats_log_interval)
+
+        self._stats_log_interval = interval
+        if self._stats_log_task is not None:
+            self._stats_log_task.cancel()
+            self._stats_log_task = None
+        if interval > 0:
+            self._stats_log_task = asyncio.ensure_future(self._log_stats_loop())
+
+    async def _log_stats_loop(self):
+        while self._stats_log_interval > 0:
+            await asyncio.sleep(self._stats_log_interval)
+            try:
+                stats = self.get_stats()
+                decky.logger.info(
+                    "[terminal][STATS] terminals=%d read=%d written=%d reads=%d emits=%d snapshots=%d "
+                    "emit_latency_p50=%dus emit_latency_p99=%dus dropped_input=%d throttled=%d",
+                    stats["terminals"], stats["bytes_read"], stats["bytes_written"], stats["reads"],
+                    stats["emits"], stats["snapshots"], stats["emit_latency_us"]["p50"],
+                    stats["emit_latency_us"]["p99"], stats["dropped_input"], stats["throttled"],
+                )
+            except Exception as e:
+                # one bad round must not end the logging for good
+                decky.logger.exception("[terminal][EXCEPTION] Exception during stats logging: %s", e)
+
+    # HIBERNATION ===========================================
+    async def _configure_hibernation(self):
+        config = await self._get_config()
+        hibernate_after = DeckyTerminal._hibernate_after
+        if config is not None:
+            value = config.get("hibernate_after")
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                hibernate_after = max(0, value)
+
+        self._hibernate_after = hibernate_after
+        # restart, the running loop may be asleep for the old interval
+        if self._hibernation_task is not None:
+            self._hibernation_task.cancel()
+            self._hibernation_task = None
+        if hibernate_after > 0:
+            self._hibernation_task = asyncio.ensure_future(self._hibernation_loop())
+
+    async def _hibernation_loop(self):
+        while self._hibernate_after > 0:
+            await asyncio.sleep(max(1, min(30, self._hibernate_after / 4)))
+            self._hibernate_idle_terminals()
+
+    def _hibernate_idle_terminals(self):
+        if self._hibernate_after <= 0:
+            return
+
+        deadline = time.monotonic() - self._hibernate_after
+        for terminal in self._terminal_sessions.values():
+            if not terminal.hibernated and not terminal.is_subscribed and terminal.last_activity < deadline:
+                try:
+                    terminal.hibernate()
+                except Exception as e:
+                    decky.logger.exception("[terminal][EXCEPTION][%s] Exception during hibernation: %s", terminal.id, e)
+
+    # MEMORY BUDGET =========================================
+    async def _configure_memory_budget(self):
+        config = await self._get_config()
+        memory_budget = DeckyTerminal._memory_budget
+        if config is not None:
+            value = config.get("memory_budget")
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                memory_budget = max(0, int(value))
+
+        self._memory_budget = memory_budget
+        if self._memory_task is not None:
+            self._memory_task.cancel()
+            self._memory_task = None
+        if memory_budget > 0:
+            self._memory_task = asyncio.ensure_future(self._memory_loop())
+
+    async def _memory_loop(self):
+        while self._memory_budget > 0:
+            await asyncio.sleep(self._memory_check_interval)
+            self._enforce_memory_budget()
+
+    def _enforce_memory_budget(self):
+        if self._memory_budget <= 0:
+            return
+
+        usage = {terminal.id: terminal.memory_usage()["total"] for terminal in self._terminal_sessions.values()}
+        used = sum(usage.values())
+        if used <= self._memory_budget:
+            return
+
+        # whatever somebody is looking at is left alone, of the rest the one viewed longest
+        # ago goes first. hibernating keeps everything, so all of them get that before any
+        # of them loses history
+        candidates = sorted(
+            (terminal for terminal in self._terminal_sessions.values() if not terminal.is_subscribed),
+            key=lambda terminal: terminal.last_subscribed,
+        )
+        target = int(self._memory_budget * self._memory_low_watermark)
+        quiet_since = time.monotonic() - self._memory_quiet_time
+        for action in ("hibernate", "drop_history"):
+            for terminal in candidates:
+                if used <= target:
+                    return
+                if action == "hibernate" and terminal.last_output > quiet_since:
+                    continue
+
+                try:
+                    getattr(terminal, action)()
+                except Exception as e:
+                    decky.logger.exception("[terminal][EXCEPTION][%s] Exception during %s: %s", terminal.id, action, e)
+                    continue
+
+                total = terminal.memory_usage()["total"]
+                if total < usage[terminal.id]:
+                    decky.logger.info(
+                        "[terminal][INFO][%s] Over the memory budget (%d of %d bytes), %s freed %d bytes.",
+                        terminal.id, used, self._memory_budget, action, usage[terminal.id] - total,
+                    )
+                    used -= usage[terminal.id] - total
+                    usage[terminal.id] = total
+
     # TERMINAL CREATION =====================================
-    async def create_terminal(self, terminal_id: str = None, cmdline: Optional[str] = None):
+    async def create_terminal(self, terminal_id: str = None, cmdline: Optional[str] = None, rows: Optional[int] = None, cols: Optional[int] = None):
+        use_pool = cmdline is None
         if cmdline is None:
             cmdline = await self.get_default_shell()
 
@@ -134,15 +567,52 @@ class DeckyTerminal:
             terminal_id = str(uuid.uuid4())
 
         if self._terminal_sessions.get(terminal_id) is None:
-            self._terminal_sessions[terminal_id] = Terminal(terminal_id, cmdline, **flags)
-            self._terminal_sessions[terminal_id].title = phoneticize(terminal_id[0:4])
-            await self._terminal_sessions[terminal_id].start()
+            terminal = None
+            if use_pool:
+                await self._configure_shell_pool()
+                terminal = self._shell_pool.acquire(terminal_id, rows, cols)
+
+            if terminal is None:
+                terminal = Terminal(terminal_id, cmdline, **flags)
+                if rows is not None and cols is not None:
+                    terminal.rows, terminal.cols = rows, cols
+                if self._persistent_sessions:
+                    terminal.holder = self._holder
+                self._add_terminal(terminal_id, terminal)
+                await terminal.start()
+            else:
+                self._add_terminal(terminal_id, terminal)
+
+            if use_pool:
+                self._shell_pool.refill()
+
+    def _add_terminal(self, terminal_id: str, terminal: Terminal):
+        self._removed_versions.pop(terminal_id, None)
+        self._terminal_sessions[terminal_id] = terminal
+        terminal.on_change = self._on_terminal_change
+        if not terminal.title:
+            # a pre-spawned shell may have set one already
+            terminal.title = phoneticize(terminal_id[0:4])
+        self._on_terminal_change(terminal)
+
+    def _on_terminal_change(self, terminal: Terminal):
+        self._version += 1
+        terminal.version = self._version
 
     async def remove_terminal(self, terminal_id: str):
         if self._terminal_sessions.get(terminal_id) is not None:
             terminal: Terminal = self._terminal_sessions[terminal_id]
             await terminal.shutdown()
             del self._terminal_sessions[terminal_id]
+            self._removed_stats.merge(terminal.stats)
+            self._mark_removed(terminal_id)
+
+    def _mark_removed(self, terminal_id: str):
+        self._version += 1
+        self._removed_versions[terminal_id] = self._version
+        while len(self._removed_versions) > self._max_removed_versions:
+            oldest = next(iter(self._removed_versions))
+            self._removed_versions_floor = self._removed_versions.pop(oldest)
 
     def get_terminal(self, terminal_id) -> Optional[Terminal]:
         return self._terminal_sessions.get(terminal_id)
@@ -150,18 +620,47 @@ class DeckyTerminal:
     def get_terminal_ids(self) -> List[str]:
         return self._terminal_sessions.keys()
 
-    def set_terminal_title(self, terminal_id, title):
+    def set_terminal_title(self, terminal_id, title) -> bool:
         term = self.get_terminal(terminal_id)
         if term is not None:
             term.title = title
+            return True
+
+        return False
 
     def get_terminals(self) -> Dict[str, Terminal]:
         return self._terminal_sessions
 
+    def get_version(self) -> int:
+        return self._version
+
+    def get_version_epoch(self) -> str:
+        return self._version_epoch
+
+    def can_get_changes(self, since_version: int, epoch: Optional[str]) -> bool:
+        # false when removals since then may have been forgotten or the version is
+        # from another instance, the client needs the full list
+        return epoch == self._version_epoch and self._removed_versions_floor <= since_version <= self._version
+
+    def get_changes(self, since_version: int) -> Tuple[Dict[str, Terminal], List[str]]:
+        changed = {
+            terminal_id: terminal
+            for terminal_id, terminal in self._terminal_sessions.items()
+            if terminal.version > since_version
+        }
+        removed = [
+            terminal_id
+            for terminal_id, version in self._removed_versions.items()
+            if version > since_version
+        ]
+        return changed, removed
+
     # TERMINAL CONTROL ======================================
     async def _kill_all_terminals(self):
-        for _terminal in self._terminal_sessions.values():
+        for terminal_id, _terminal in self._terminal_sessions.items():
             terminal: Terminal = _terminal
             await terminal.shutdown()
+            self._removed_stats.merge(terminal.stats)
+            self._mark_removed(terminal_id)
 
         self._terminal_sessions = dict()
@@ -0,0 +1,62 @@
+import time
+
+
+class OutputBatcher:
+    # bytes within one batch interval that switch the batcher into bulk mode,
+    # below that every chunk is flushed right away (interactive mode)
+    bulk_threshold: int = 16384
+
+    # seconds between two flushes while in bulk mode (~ one frame)
+    batch_interval: float = 0.016
+
+    # flush early once this many bytes are pending, even in bulk mode
+    batch_size: int = 65536
+
+    is_bulk: bool = False
+
+    _window_start: float = 0.0
+    _window_bytes: int = 0
+    _last_flush: float = 0.0
+
+    def __init__(self, **kwargs):
+        self.configure(**kwargs)
+
+    def configure(
+        self,
+        bulk_threshold: int = None,
+        batch_interval: float = None,
+        batch_size: int = None,
+    ):
+        if isinstance(bulk_threshold, int) and bulk_threshold > 0:
+            self.bulk_threshold = bulk_threshold
+
+        # configured in milliseconds
+        if isinstance(batch_interval, (int, float)) and batch_interval > 0:
+            self.batch_interval = batch_interval / 1000
+
+        if isinstance(batch_size, int) and batch_size > 0:
+            self.batch_size = batch_size
+
+    def record(self, size: int):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+
+        if elapsed >= self.batch_interval:
+            # stay in bulk mode only while the previous window was saturated
+            # and the output kept coming right after it.
+            self.is_bulk = self._window_bytes >= self.bulk_threshold and elapsed < self.batch_interval * 2
+            self._window_start = now
+            self._window_bytes = 0
+
+        self._window_bytes += size
+        if self._window_bytes >= self.bulk_threshold:
+            self.is_bulk = True
+
+    def flush_delay(self, pending: int) -> float:
+        if not self.is_bulk or pending >= self.batch_size:
+            return 0
+
+        return max(0, self._last_flush + self.batch_interval - time.monotonic())
+
+    def flushed(self):
+        self._last_flush = time.monotonic()
@@ -0,0 +1,234 @@
+import asyncio
+import codecs
+import os
+import signal
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import decky
+
+from .batcher import OutputBatcher
+
+
+def get_command_env() -> dict:
+    result = dict(os.environ)
+
+    # same as for terminals, see Terminal.get_terminal_env
+    if "LD_LIBRARY_PATH" in result:
+        del result["LD_LIBRARY_PATH"]
+
+    return result
+
+
+# One-shot command on plain pipes: no pty, no screen model, no ring buffer. Output is
+# streamed as it comes through the same batching the terminals use, on
+# `command_output#<command_id>` as a list of [stream, text] pairs in read order.
+class Command:
+    encoding = "utf-8"
+    _read_size: int = 65536
+    _drain_timeout: float = 1.0
+
+    id: str = None
+    argv: List[str] = None
+    process: asyncio.subprocess.Process = None
+
+    timed_out: bool = False
+    cancelled: bool = False
+    truncated: bool = False
+    output_size: int = 0
+
+    _pending: List[list] = None
+    _pending_size: int = 0
+    _event: asyncio.Event = None
+    _closed: bool = False
+
+    def __init__(self, id: str, argv: List[str], timeout: float, max_output: int, **kwargs):
+        self.id = id
+        self.argv = argv
+        self.timeout = timeout
+        self.max_output = max_output
+        self._pending = []
+        self._event = asyncio.Event()
+        self._decoders = dict(
+            stdout=codecs.getincrementaldecoder(self.encoding)(errors="replace"),
+            stderr=codecs.getincrementaldecoder(self.encoding)(errors="replace"),
+        )
+        self._batcher = OutputBatcher(**kwargs.get("output_batching", dict()))
+
+    async def run(self) -> dict:
+        started = time.monotonic()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=get_command_env(),
+            cwd=os.getenv("HOME"),
+            # own process group, a timeout takes everything it started along
+            start_new_session=True,
+        )
+
+        flusher = asyncio.ensure_future(self._flush_loop())
+        readers = asyncio.gather(
+            self._read(self.process.stdout, "stdout"),
+            self._read(self.process.stderr, "stderr"),
+        )
+        try:
+            await asyncio.wait_for(asyncio.shield(readers), self.timeout if self.timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            await self._kill_and_drain(readers)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            await self._kill_and_drain(readers)
+
+        returncode = await self.process.wait()
+        self._closed = True
+        self._event.set()
+        await flusher
+
+        return dict(
+            id=self.id,
+            returncode=returncode,
+            timed_out=self.timed_out,
+            cancelled=self.cancelled,
+            truncated=self.truncated,
+            output_size=self.output_size,
+            duration=time.monotonic() - started,
+        )
+
+    async def _kill_and_drain(self, readers: asyncio.Future):
+        self.kill()
+        try:
+            # something that left the process group may still hold the pipes open
+            await asyncio.wait_for(readers, self._drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    async def _read(self, stream: asyncio.StreamReader, name: str):
+        while True:
+            data = await stream.read(self._read_size)
+            if len(data) == 0:
+                break
+
+            # keep draining past the limit, a blocked writer would never exit
+            remaining = self.max_output - self.output_size
+            if self.max_output > 0 and len(data) > remaining:
+                self.truncated = True
+                data = data[:max(0, remaining)]
+            if len(data) == 0:
+                continue
+
+            self.output_size += len(data)
+            text = self._decoders[name].decode(data)
+            if len(self._pending) > 0 and self._pending[-1][0] == name:
+                self._pending[-1][1] += text
+            else:
+                self._pending.append([name, text])
+            self._pending_size += len(data)
+            self._batcher.record(len(data))
+            self._event.set()
+
+        text = self._decoders[name].decode(b"", True)
+        if text:
+            self._pending.append([name, text])
+            self._event.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+
+            delay = self._batcher.flush_delay(self._pending_size)
+            while delay > 0 and not self._closed:
+                try:
+                    await asyncio.wait_for(self._event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._event.clear()
+                delay = self._batcher.flush_delay(self._pending_size)
+
+            if len(self._pending) > 0:
+                pending = self._pending
+                self._pending = []
+                self._pending_size = 0
+                self._batcher.flushed()
+                try:
+                    await decky.emit("command_output#" + self.id, pending)
+                except Exception as e:
+                    decky.logger.exception("[command][EXCEPTION][%s] Exception during output emit: %s", self.id, e)
+
+            if self._closed and len(self._pending) == 0:
+                break
+
+
+class CommandRunner:
+    max_concurrent: int = 4
+    max_output: int = 1024 * 1024
+
+    flags: dict = None
+
+    _semaphore: asyncio.Semaphore = None
+    _commands: Dict[str, asyncio.Future] = None
+
+    def __init__(self):
+        self.flags = dict()
+        self._commands = dict()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+    def configure(self, max_concurrent: int, flags: dict):
+        max_concurrent = max(1, max_concurrent)
+        if max_concurrent != self.max_concurrent:
+            # running commands keep the slots of the old semaphore
+            self.max_concurrent = max_concurrent
+            self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.flags = dict(flags)
+
+    async def run(self, argv: List[str], timeout: float = 60, max_output: Optional[int] = None, command_id: Optional[str] = None) -> dict:
+        if not isinstance(argv, list) or len(argv) == 0 or not all(isinstance(arg, str) for arg in argv):
+            raise ValueError("argv must be a non-empty list of strings")
+
+        if command_id is None:
+            command_id = str(uuid.uuid4())
+        if command_id in self._commands:
+            raise ValueError(f"command {command_id} is already running")
+        if max_output is None:
+            max_output = self.max_output
+
+        command = Command(command_id, argv, timeout, max_output, **self.flags)
+        task = asyncio.ensure_future(self._run(command))
+        self._commands[command_id] = task
+        task.add_done_callback(lambda _: self._commands.pop(command_id, None))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            # cancelled before it got a slot
+            return dict(id=command_id, returncode=None, timed_out=False, cancelled=True, truncated=False, output_size=0, duration=0)
+
+    async def _run(self, command: Command) -> dict:
+        # queued commands wait here, started ones are counted against the limit
+        async with self._semaphore:
+            decky.logger.info("[command][INFO][%s] Running %s.", command.id, command.argv[0])
+            return await command.run()
+
+    def cancel(self, command_id: str) -> bool:
+        task = self._commands.get(command_id)
+        if task is None or task.done():
+            return False
+
+        task.cancel()
+        return True
+
+    def cancel_all(self):
+        for task in self._commands.values():
+            task.cancel()
@@ -1,5 +1,8 @@
 import asyncio
+import os
+import tempfile
 from typing import Callable, Dict, Optional, TypeVar
+from urllib.parse import quote
 
 # Why does the Python generic work this way?
 _T = TypeVar("_T")
@@ -26,14 +29,45 @@ class Common:
     @classmethod
     async def write_file(cls, filename: str, content: str) -> bool:
         try:
-            f = await cls._run_async(open, filename, "w+")
-            await cls._run_async(f.write, content)
-            f.close()
+            await cls._run_async(cls._write_file_atomic, filename, content)
             return True
         except Exception as e:
             print("exception", e)
             return False
 
+    @classmethod
+    def _write_file_atomic(cls, filename: str, content: str):
+        # write next to the target and rename over it, so a crash never leaves a truncated file
+        fd, temp_filename = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(filename) or ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            try:
+                os.chmod(temp_filename, os.stat(filename).st_mode & 0o777)
+            except FileNotFoundError:
+                os.chmod(temp_filename, 0o644)
+
+            os.replace(temp_filename, filename)
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def escape_filename(cls, name: str) -> str:
+        # ids come from the client, escaped they can only name a single entry of the
+        # directory they are joined to. quote() leaves "." alone, so "." and ".." need extra care,
+        # and % never survives quote(), so "%00" can't collide with a real name
+        name = quote(name, safe="")
+        if name.startswith("."):
+            name = "%2E" + name[1:]
+        return name or "%00"
+
     @classmethod
     def merge_dict(cls, prev: Dict[_T, _U], new: Dict[_T, _U]) -> Dict[_T, _U]:
         for i, v in new.items():
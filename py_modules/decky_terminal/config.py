@@ -0,0 +1,112 @@
+import asyncio
+import copy
+import json
+import os
+from typing import Any, Callable, Dict, Optional
+
+from .common import Common
+
+_NOT_LOADED = object()
+
+
+class CachedFile:
+    filename: str = None
+
+    _parse: Callable[[str], Any] = None
+    _value: Any = _NOT_LOADED
+    _key: Optional[tuple] = None
+
+    def __init__(self, filename: str, parse: Callable[[str], Any]):
+        self.filename = filename
+        self._parse = parse
+        self._value = _NOT_LOADED
+        self._key = None
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.filename)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    async def read(self) -> Any:
+        # a stat is all it takes as long as nobody else touched the file. callers get a
+        # copy, changing it doesn't change what the next one reads
+        return copy.deepcopy(await self._read())
+
+    async def _read(self) -> Any:
+        key = self._stat()
+        if self._value is not _NOT_LOADED and key == self._key:
+            return self._value
+
+        data = await Common.read_file(self.filename)
+        value = None
+        if data is not None:
+            try:
+                value = self._parse(data)
+            except ValueError:
+                value = None
+
+        self._value = value
+        self._key = key
+        return value
+
+    def invalidate(self):
+        self._value = _NOT_LOADED
+        self._key = None
+
+
+class ConfigFile(CachedFile):
+    write_delay: float = 0.05
+
+    _pending_write: Optional[asyncio.Future] = None
+    # what the pending write is made of: a whole config to replace the file with, or
+    # None to start from the file as it is at the time of writing, and updates merged in
+    _pending_config: Optional[Dict[str, Any]] = None
+    _pending_updates: Dict[str, Any] = None
+
+    def __init__(self, filename: str):
+        super().__init__(filename, json.loads)
+        self._pending_write = None
+        self._pending_config = None
+        self._pending_updates = dict()
+
+    async def write(self, config: Dict[str, Any]) -> bool:
+        self._pending_config = copy.deepcopy(config)
+        self._pending_updates = dict()
+        return await self._schedule_write()
+
+    async def update(self, new_config: Dict[str, Any]) -> bool:
+        Common.merge_dict(self._pending_updates, copy.deepcopy(new_config))
+        return await self._schedule_write()
+
+    async def _schedule_write(self) -> bool:
+        # bursts of updates (e.g. a settings page saving every field) end up in a single write
+        if self._pending_write is None:
+            self._pending_write = asyncio.get_event_loop().create_future()
+            asyncio.get_event_loop().call_later(self.write_delay, lambda: asyncio.ensure_future(self._flush()))
+
+        return await asyncio.shield(self._pending_write)
+
+    async def _flush(self):
+        future = self._pending_write
+        config, updates = self._pending_config, self._pending_updates
+        self._pending_write = None
+        self._pending_config = None
+        self._pending_updates = dict()
+
+        if config is None:
+            # read right before writing, so edits made to the file meanwhile are kept
+            config = await self.read()
+            if config is None:
+                config = dict(
+                    __version__=1,
+                )
+        config = Common.merge_dict(config, updates)
+
+        # the cache only changes once the file did
+        result = await Common.write_file(self.filename, json.dumps(config))
+        if result:
+            self._value = config
+            self._key = self._stat()
+        future.set_result(result)
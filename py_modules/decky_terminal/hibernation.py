@@ -0,0 +1,84 @@
+import zlib
+from typing import List, Optional
+
+from .scanner import EscapeScanner, ScanResult
+
+
+# What is left of a terminal's buffers while nobody looks at it: the ring buffer and the
+# screen model compressed, plus the raw output that arrived since, to be replayed on wakeup.
+# The tail is only scanned for what serialize() reports (title, modes), with a scanner of its
+# own so the terminal's one picks up exactly where it stopped when the tail is replayed.
+class Hibernation:
+    level: int = 6
+    max_tail_size: int = 64 * 1024
+
+    buffer: bytes = b""
+    buffer_size: int = 0
+    screen: Optional[bytes] = None
+
+    # whether the tail starts out on the alternate screen
+    alt_screen: bool = False
+
+    tail: List[bytes] = None
+    tail_size: int = 0
+    _scanner: EscapeScanner = None
+    # whether each chunk of the tail goes into the line index when replayed, as decided
+    # by the alternate screen when it arrived
+    _indexed: List[bool] = None
+    _tail_alt_screen: bool = False
+
+    def __init__(self, buffer: bytes, screen: Optional[bytes], alt_screen: bool, level: int = None, encoding: str = "utf-8"):
+        if level is not None:
+            self.level = level
+        self.alt_screen = alt_screen
+
+        self.buffer = zlib.compress(buffer, self.level)
+        self.buffer_size = len(buffer)
+        if screen is not None:
+            self.screen = zlib.compress(screen, self.level)
+
+        self.tail = []
+        self.tail_size = 0
+        self._scanner = EscapeScanner(encoding)
+        self._indexed = []
+        self._tail_alt_screen = alt_screen
+
+    @property
+    def size(self) -> int:
+        # memory held in place of the original buffers
+        return len(self.buffer) + (len(self.screen) if self.screen is not None else 0) + self.tail_size
+
+    @property
+    def is_tail_full(self) -> bool:
+        return self.tail_size >= self.max_tail_size
+
+    def drop_buffer(self) -> int:
+        # under memory pressure the raw history goes, the screen alone still makes a snapshot
+        if self.screen is None:
+            return 0
+
+        freed = len(self.buffer)
+        self.buffer = zlib.compress(b"", self.level)
+        self.buffer_size = 0
+        return freed - len(self.buffer)
+
+    def append(self, data: bytes) -> ScanResult:
+        self.tail.append(bytes(data))
+        self.tail_size += len(data)
+        scan = self._scanner.scan(data)
+        self._indexed.append(not (self._tail_alt_screen and scan.alt_screen is not False))
+        if scan.alt_screen is not None:
+            self._tail_alt_screen = scan.alt_screen
+        return scan
+
+    def indexed_tail(self) -> List[bytes]:
+        # what the line index gets of the tail, to search it without waking up
+        return [chunk for chunk, indexed in zip(self.tail, self._indexed) if indexed]
+
+    def restore_buffer(self) -> bytes:
+        return zlib.decompress(self.buffer)
+
+    def restore_screen(self) -> Optional[bytes]:
+        if self.screen is None:
+            return None
+        return zlib.decompress(self.screen)
@@ -0,0 +1,699 @@
+import asyncio
+import base64
+import collections
+import errno
+import fcntl
+import json
+import os
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import termios
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import decky
+
+from .ringbuffer import RingBuffer
+
+# A detached process that owns the PTY sessions, so they survive a plugin reload.
+#
+# While the plugin is connected it reads and writes the PTYs itself through the master fds
+# (passed over the socket with SCM_RIGHTS), the holder only spawns and reaps. Once the
+# connection drops, the holder starts reading every session into its own ring buffer so
+# the processes never block, and hands buffer and fd back on the next attach.
+#
+# Protocol: one JSON object per line in both directions. Requests carry "op" and "rid",
+# responses echo "rid", events carry "event". "fds" says how many fds came along.
+
+SOCKET_NAME = "holder.sock"
+
+_MAX_FDS = 16
+
+
+def socket_path() -> str:
+    return os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, SOCKET_NAME)
+
+
+# HOLDER ====================================================
+class _Session:
+    def __init__(self, id: str, pid: int, master_fd: int, cmdline: str, buffer_size: int):
+        self.id = id
+        self.pid = pid
+        self.master_fd = master_fd
+        self.cmdline = cmdline
+        self.returncode: Optional[int] = None
+        self.attached = True
+        self.reading = False
+        self.title = ""
+        self.buffer = RingBuffer(buffer_size)
+
+    def describe(self) -> dict:
+        return dict(
+            id=self.id,
+            pid=self.pid,
+            cmdline=self.cmdline,
+            returncode=self.returncode,
+            title=self.title,
+            buffered=len(self.buffer),
+        )
+
+
+class Holder:
+    buffer_size: int = 262144
+    # how long to stay around without sessions and without the plugin
+    idle_timeout: float = 5.0
+
+    def __init__(self, path: str, log_path: Optional[str] = None):
+        self.path = path
+        self.log_path = log_path
+        self.sessions: Dict[str, _Session] = dict()
+        self._closed_pids = set()
+        self.selector = selectors.DefaultSelector()
+        self.client: Optional[socket.socket] = None
+        self._client_buffer = bytearray()
+        self._client_fds: collections.deque = collections.deque()
+        self._idle_since = time.monotonic()
+        self._running = True
+
+    def _log(self, message: str, *args):
+        if self.log_path is None:
+            return
+        try:
+            with open(self.log_path, "a") as f:
+                f.write(time.strftime("[%Y-%m-%d %H:%M:%S] ") + (message % args) + "\n")
+        except OSError:
+            pass
+
+    # LIFECYCLE =============================================
+    def serve(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(4)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, ("listener", None))
+
+        # SIGCHLD wakes the selector up through the pipe, reaping happens in the loop
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args: self._stop())
+        self.selector.register(wakeup_read, selectors.EVENT_READ, ("wakeup", None))
+
+        self._log("Holder started (pid %d).", os.getpid())
+        try:
+            while self._running:
+                for key, _ in self.selector.select(1.0):
+                    kind, value = key.data
+                    if kind == "listener":
+                        self._accept(listener)
+                    elif kind == "client":
+                        self._on_client_readable()
+                    elif kind == "session":
+                        self._on_session_readable(value)
+                    elif kind == "wakeup":
+                        try:
+                            os.read(wakeup_read, 4096)
+                        except BlockingIOError:
+                            pass
+
+                self._reap()
+                self._check_idle()
+        finally:
+            self._log("Holder exiting.")
+            for session in list(self.sessions.values()):
+                self._close_session(session, kill=True)
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _stop(self):
+        self._running = False
+
+    def _check_idle(self):
+        if self.client is not None or len(self.sessions) > 0 or len(self._closed_pids) > 0:
+            self._idle_since = time.monotonic()
+        elif time.monotonic() - self._idle_since > self.idle_timeout:
+            self._running = False
+
+    # CLIENT ================================================
+    def _accept(self, listener: socket.socket):
+        try:
+            connection, _ = listener.accept()
+        except BlockingIOError:
+            return
+
+        # only the user running the plugin may talk to us
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", credentials)
+        if uid != os.getuid():
+            self._log("Rejected connection from uid %d.", uid)
+            connection.close()
+            return
+
+        if self.client is not None:
+            # a new plugin instance while the old connection is still half open
+            self._drop_client()
+
+        connection.setblocking(True)
+        self.client = connection
+        self._client_buffer = bytearray()
+        self._client_fds.clear()
+        self.selector.register(connection, selectors.EVENT_READ, ("client", None))
+        self._log("Plugin connected.")
+
+    def _drop_client(self):
+        self.selector.unregister(self.client)
+        self.client.close()
+        self.client = None
+        for fd in self._client_fds:
+            os.close(fd)
+        self._client_fds.clear()
+
+        # nobody reads the sessions anymore, do it ourselves
+        for session in self.sessions.values():
+            session.attached = False
+            self._start_reading(session)
+        self._log("Plugin disconnected, holding %d sessions.", len(self.sessions))
+
+    def _on_client_readable(self):
+        try:
+            data, fds, _, _ = socket.recv_fds(self.client, 65536, _MAX_FDS)
+        except OSError:
+            data, fds = b"", []
+
+        self._client_fds.extend(fds)
+        if len(data) == 0:
+            self._drop_client()
+            return
+
+        self._client_buffer += data
+        while self.client is not None:
+            index = self._client_buffer.find(b"\n")
+            if index == -1:
+                break
+
+            line = bytes(self._client_buffer[:index])
+            del self._client_buffer[:index + 1]
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("not an object")
+            except ValueError as e:
+                # nothing after it can be trusted, the plugin reconnects and the sessions stay
+                self._log("Malformed request from the plugin, dropping the connection: %s", e)
+                self._drop_client()
+                return
+            self._handle(request)
+
+    def _send(self, message: dict, fds: List[int] = ()):
+        if self.client is None:
+            return
+
+        data = (json.dumps(message) + "\n").encode()
+        try:
+            if fds:
+                message["fds"] = len(fds)
+                data = (json.dumps(message) + "\n").encode()
+                sent = socket.send_fds(self.client, [data], list(fds))
+                data = data[sent:]
+            if data:
+                self.client.sendall(data)
+        except OSError as e:
+            self._log("Unable to reach the plugin: %s", e)
+            self._drop_client()
+
+    def _handle(self, request: dict):
+        op = request.get("op")
+        fds = [self._client_fds.popleft() for _ in range(min(request.get("fds", 0), len(self._client_fds)))]
+        response: Dict[str, Any] = dict(rid=request.get("rid"))
+        send_fds: List[int] = []
+
+        try:
+            if op == "spawn":
+                response.update(self._spawn(request, fds))
+                fds = []
+            elif op == "list":
+                response["sessions"] = [session.describe() for session in self.sessions.values()]
+            elif op == "attach":
+                session = self.sessions.get(request.get("id"))
+                if session is None:
+                    response["error"] = "unknown session"
+                else:
+                    response.update(self._attach(session))
+                    send_fds = [session.master_fd]
+            elif op == "detach":
+                session = self.sessions.get(request.get("id"))
+                if session is not None:
+                    self._detach(session, request)
+            elif op == "rename":
+                session = self.sessions.pop(request.get("id"), None)
+                if session is not None:
+                    session.id = request.get("new_id")
+                    self.sessions[session.id] = session
+            elif op == "close":
+                session = self.sessions.get(request.get("id"))
+                if session is not None:
+                    self._close_session(session, kill=request.get("kill", True))
+            else:
+                response["error"] = f"unknown op {op}"
+        except Exception as e:
+            self._log("Request %s failed: %s", op, e)
+            response["error"] = str(e)
+        finally:
+            # fds the request brought along but nobody took over
+            for fd in fds:
+                os.close(fd)
+
+        self._send(response, send_fds)
+
+    # SESSIONS ==============================================
+    def _spawn(self, request: dict, fds: List[int]) -> dict:
+        if len(fds) != 2:
+            raise ValueError("spawn needs the master and slave fd")
+
+        master_fd, slave_fd = fds
+
+        def preexec():
+            os.setsid()
+            fcntl.ioctl(slave_fd, termios.TIOCSCTTY, 0)
+
+        try:
+            process = subprocess.Popen(
+                request["argv"],
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd,
+                env=request.get("env"),
+                cwd=request.get("cwd"),
+                preexec_fn=preexec,
+                close_fds=True,
+                restore_signals=True,
+            )
+        except BaseException:
+            os.close(master_fd)
+            os.close(slave_fd)
+            raise
+        os.close(slave_fd)
+
+        session = _Session(request["id"], process.pid, master_fd, request["argv"][0], request.get("buffer_size", self.buffer_size))
+        # Popen would otherwise try to reap it as well
+        process.returncode = 0
+        self.sessions[session.id] = session
+        self._log("Spawned %s (pid %d) for %s.", session.cmdline, session.pid, session.id)
+        return dict(pid=session.pid)
+
+    def _attach(self, session: _Session) -> dict:
+        self._stop_reading(session)
+        session.attached = True
+        buffer = session.buffer.snapshot()
+        session.buffer.clear()
+
+        response = session.describe()
+        response["buffer"] = base64.b64encode(buffer).decode("ascii")
+        return response
+
+    def _detach(self, session: _Session, request: dict):
+        # what the plugin had on screen, output from here on gets appended by us
+        session.buffer.clear()
+        session.buffer.append(base64.b64decode(request.get("buffer", "")))
+        session.title = request.get("title") or ""
+        session.attached = False
+        self._start_reading(session)
+
+    def _start_reading(self, session: _Session):
+        if session.reading or session.master_fd is None:
+            return
+        os.set_blocking(session.master_fd, False)
+        self.selector.register(session.master_fd, selectors.EVENT_READ, ("session", session))
+        session.reading = True
+
+    def _stop_reading(self, session: _Session):
+        if session.reading:
+            self.selector.unregister(session.master_fd)
+            session.reading = False
+
+    def _on_session_readable(self, session: _Session):
+        try:
+            data = os.read(session.master_fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno != errno.EIO:
+                self._log("Read from %s failed: %s", session.id, e)
+            data = b""
+
+        if len(data) == 0:
+            # every slave handle is gone, the process exited
+            self._stop_reading(session)
+            return
+
+        session.buffer.append(data)
+
+    def _reap(self):
+        for pid in list(self._closed_pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            self._closed_pids.discard(pid)
+
+        for session in list(self.sessions.values()):
+            if session.returncode is not None:
+                continue
+
+            try:
+                pid, status = os.waitpid(session.pid, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = session.pid, 0
+            if pid == 0:
+                continue
+
+            session.returncode = os.waitstatus_to_exitcode(status)
+            self._log("Session %s exited with %d.", session.id, session.returncode)
+            if session.attached:
+                self._send(dict(event="exit", id=session.id, returncode=session.returncode))
+
+    def _close_session(self, session: _Session, kill: bool = True):
+        self._stop_reading(session)
+        if kill and session.returncode is None:
+            try:
+                os.kill(session.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        if session.master_fd is not None:
+            os.close(session.master_fd)
+            session.master_fd = None
+
+        self.sessions.pop(session.id, None)
+        if session.returncode is None:
+            # reaped with the next pass, nobody wants to hear about the exit anymore
+            self._closed_pids.add(session.pid)
+
+
+def spawn_holder(path: str, log_path: Optional[str] = None):
+    # a fresh interpreter in a session of its own, so it neither inherits the plugin's
+    # threads and locks nor goes away with its process group. a frozen Decky Loader
+    # can't run modules, the system python is used then.
+    interpreter = sys.executable
+    if getattr(sys, "frozen", False) or not interpreter:
+        interpreter = shutil.which("python3")
+    if not interpreter:
+        raise OSError("no python interpreter to run the session holder")
+
+    # whatever the plugin can import, the holder can as well
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(entry for entry in sys.path if entry)
+
+    argv = [interpreter, "-m", "decky_terminal.holder", path]
+    if log_path is not None:
+        argv.append(log_path)
+    subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        cwd="/",
+        start_new_session=True,
+    )
+
+
+# CLIENT ====================================================
+class HeldProcess:
+    # stands in for asyncio.subprocess.Process for sessions spawned by the holder
+
+    def __init__(self, pid: int, returncode: Optional[int] = None):
+        self.pid = pid
+        self.returncode = returncode
+        self._exited = asyncio.Event()
+        if returncode is not None:
+            self._exited.set()
+
+    def _set_returncode(self, returncode: int):
+        if self.returncode is None:
+            self.returncode = returncode
+            self._exited.set()
+
+    async def wait(self) -> int:
+        await self._exited.wait()
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class HolderClient:
+    path: str = None
+    connect_timeout: float = 2.0
+    # a holder that doesn't answer in time counts as gone, callers fall back to local processes
+    request_timeout: float = 5.0
+
+    on_disconnect: Optional[Callable[[], None]] = None
+
+    _sock: socket.socket = None
+    _rid: int = 0
+    _pending: Dict[int, asyncio.Future] = None
+    _processes: Dict[str, HeldProcess] = None
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pending = dict()
+        self._processes = dict()
+        self._buffer = bytearray()
+        self._fds = collections.deque()
+        self._send_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    # CONNECTION ============================================
+    async def connect(self, spawn: bool = True) -> bool:
+        if self.connected:
+            return True
+
+        if self._try_connect():
+            return True
+        if not spawn:
+            return False
+
+        log_path = os.path.join(decky.DECKY_PLUGIN_LOG_DIR, "holder.log")
+        try:
+            spawn_holder(self.path, log_path)
+        except OSError as e:
+            decky.logger.error("[holder][ERROR] Unable to start the session holder: %s", e)
+            return False
+
+        deadline = time.monotonic() + self.connect_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            if self._try_connect():
+                decky.logger.info("[holder][INFO] Started the session holder.")
+                return True
+
+        decky.logger.error("[holder][ERROR] Session holder did not come up.")
+        return False
+
+    def _try_connect(self) -> bool:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            return False
+
+        sock.setblocking(False)
+        self._sock = sock
+        asyncio.get_event_loop().add_reader(sock.fileno(), self._on_readable)
+        return True
+
+    def close(self):
+        if self._sock is None:
+            return
+
+        asyncio.get_event_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("session holder connection closed"))
+        self._pending.clear()
+        while len(self._fds) > 0:
+            os.close(self._fds.popleft())
+
+    def _on_readable(self):
+        while self._sock is not None:
+            try:
+                data, fds, _, _ = socket.recv_fds(self._sock, 65536, _MAX_FDS)
+            except BlockingIOError:
+                break
+            except OSError:
+                data, fds = b"", []
+
+            self._fds.extend(fds)
+            if len(data) == 0:
+                decky.logger.error("[holder][ERROR] Lost the connection to the session holder.")
+                self.close()
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+                return
+
+            self._buffer += data
+            while True:
+                index = self._buffer.find(b"\n")
+                if index == -1:
+                    break
+                line = bytes(self._buffer[:index])
+                del self._buffer[:index + 1]
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError("not an object")
+                except ValueError as e:
+                    # the holder keeps the sessions, they are reattached on the next connect
+                    decky.logger.error("[holder][ERROR] Malformed message from the session holder, disconnecting: %s", e)
+                    self.close()
+                    if self.on_disconnect is not None:
+                        self.on_disconnect()
+                    return
+                self._dispatch(message)
+
+    def _dispatch(self, message: dict):
+        fds = [self._fds.popleft() for _ in range(min(message.get("fds", 0), len(self._fds)))]
+
+        if message.get("event") == "exit":
+            process = self._processes.pop(message.get("id"), None)
+            if process is not None:
+                process._set_returncode(message.get("returncode"))
+            return
+
+        future = self._pending.pop(message.get("rid"), None)
+        if future is None or future.done():
+            for fd in fds:
+                os.close(fd)
+            return
+        future.set_result((message, fds))
+
+    # REQUESTS ==============================================
+    async def _request(self, op: str, fds: List[int] = (), **kwargs) -> Tuple[dict, List[int]]:
+        if not self.connected:
+            raise ConnectionError("not connected to the session holder")
+
+        self._rid += 1
+        rid = self._rid
+        message = dict(op=op, rid=rid, **kwargs)
+        if fds:
+            message["fds"] = len(fds)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[rid] = future
+
+        try:
+            response, response_fds = await asyncio.wait_for(self._exchange(message, fds, future), self.request_timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(rid, None)
+            decky.logger.error("[holder][ERROR] Session holder did not answer %s in time, disconnecting.", op)
+            # a half sent request leaves the stream unusable anyway
+            self.close()
+            if self.on_disconnect is not None:
+                self.on_disconnect()
+            raise ConnectionError("session holder did not answer")
+
+        if "error" in response:
+            for fd in response_fds:
+                os.close(fd)
+            raise RuntimeError(response["error"])
+        return response, response_fds
+
+    async def _exchange(self, message: dict, fds: List[int], future: asyncio.Future) -> Tuple[dict, List[int]]:
+        data = (json.dumps(message) + "\n").encode()
+        loop = asyncio.get_event_loop()
+        async with self._send_lock:
+            if fds:
+                # the fds ride along with the first byte of the message
+                while True:
+                    try:
+                        sent = socket.send_fds(self._sock, [data], list(fds))
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(0.001)
+                data = data[sent:]
+            if data:
+                await loop.sock_sendall(self._sock, data)
+
+        return await future
+
+    async def spawn(self, id: str, argv: List[str], env: dict, cwd: Optional[str], master_fd: int, slave_fd: int, buffer_size: int = None) -> HeldProcess:
+        kwargs = dict(id=id, argv=argv, env=env, cwd=cwd)
+        if buffer_size is not None:
+            kwargs["buffer_size"] = buffer_size
+        response, _ = await self._request("spawn", [master_fd, slave_fd], **kwargs)
+
+        process = HeldProcess(response["pid"])
+        self._processes[id] = process
+        return process
+
+    async def list(self) -> List[dict]:
+        response, _ = await self._request("list")
+        return response["sessions"]
+
+    async def attach(self, id: str) -> Tuple[dict, int, bytes, HeldProcess]:
+        response, fds = await self._request("attach", id=id)
+        if len(fds) != 1:
+            raise RuntimeError("session holder did not pass the pty")
+
+        process = HeldProcess(response["pid"], response.get("returncode"))
+        if process.returncode is None:
+            self._processes[id] = process
+        return response, fds[0], base64.b64decode(response.get("buffer", "")), process
+
+    async def detach(self, id: str, buffer: bytes, title: str = ""):
+        self._processes.pop(id, None)
+        await self._request("detach", id=id, buffer=base64.b64encode(buffer).decode("ascii"), title=title)
+
+    async def rename(self, id: str, new_id: str):
+        process = self._processes.pop(id, None)
+        if process is not None:
+            self._processes[new_id] = process
+        await self._request("rename", id=id, new_id=new_id)
+
+    async def close_session(self, id: str):
+        process = self._processes.pop(id, None)
+        await self._request("close", id=id)
+        if process is not None:
+            # killed and reaped by the holder, no exit event follows
+            process._set_returncode(-signal.SIGKILL)
+
+
+if __name__ == "__main__":
+    # started by spawn_holder(): python -m decky_terminal.holder <socket path> [<log path>]
+    Holder(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None).serve()
@@ -0,0 +1,189 @@
+import codecs
+import collections
+import copy
+import re
+import zlib
+from typing import List, Optional
+
+# OSC (title, hyperlinks, ...) up to BEL or ST, CSI, then any other escape sequence
+_ESCAPE = re.compile(
+    r"\x1b(?:"
+    r"\][^\x07\x1b]*(?:\x07|\x1b\\)?"
+    r"|\[[0-?]*[ -/]*[@-~]"
+    r"|[ -/]*[0-~])"
+)
+# text redrawn in place (progress output): only what follows the last \r stays visible
+_REDRAW = re.compile(r"^[^\n]*\r(?=[^\r\n])", re.MULTILINE)
+# C0 controls except tab and newline. on ASCII text str.translate beats the regex by far,
+# on anything else it is several times slower.
+_CONTROL = re.compile(r"[\x00-\x08\x0b-\x1f\x7f]")
+_CONTROLS = dict.fromkeys([*range(0x00, 0x09), *range(0x0b, 0x20), 0x7f])
+
+
+# Plain text of every output line, stripped once when the line is complete, so a search
+# only runs the pattern over ready strings instead of decoding and parsing raw bytes again.
+class LineIndex:
+    # bounds on the stripped text kept, whatever limit is hit first drops the oldest lines.
+    # they are kept by whole blocks, so up to one read worth of lines more than this stays around
+    max_lines: int = 5000
+    max_size: int = 1024 * 1024
+    # a line without newline is cut at this length
+    max_line_length: int = 4096
+    max_text_length: int = 512
+
+    # number of the oldest line still kept, lines are counted from the start of the session
+    start: int = 0
+    count: int = 0
+    size: int = 0
+
+    # the lines completed by one feed() stay together and are dropped together
+    _blocks: collections.deque = None
+    # the blocks while the session hibernates: lines joined by \n, blocks by \0, neither
+    # survives stripping. expanded again by the next feed() or search()
+    _compressed: Optional[bytes] = None
+
+    _partial: List[str] = None
+    _partial_size: int = 0
+
+    def __init__(self, max_lines: Optional[int] = None, encoding: str = "utf-8"):
+        if max_lines is not None:
+            self.max_lines = max_lines
+
+        self._blocks = collections.deque()
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._partial = []
+        self._partial_size = 0
+
+    @property
+    def end(self) -> int:
+        # number of the line currently being written
+        return self.start + self.count
+
+    @property
+    def is_compressed(self) -> bool:
+        return self._compressed is not None
+
+    @property
+    def compressed_size(self) -> int:
+        return len(self._compressed) if self._compressed is not None else 0
+
+    def compress(self, level: int = 6):
+        if self._compressed is not None or len(self._blocks) == 0:
+            return
+
+        text = "\0".join("\n".join(lines) for lines, _ in self._blocks)
+        self._compressed = zlib.compress(text.encode("utf-8", "surrogatepass"), level)
+        self._blocks = collections.deque()
+
+    def decompress(self):
+        if self._compressed is None:
+            return
+
+        text = zlib.decompress(self._compressed).decode("utf-8", "surrogatepass")
+        self._compressed = None
+        self._blocks = collections.deque((lines, sum(map(len, lines))) for lines in (block.split("\n") for block in text.split("\0")))
+
+    def feed(self, data: bytes):
+        self.decompress()
+        text = self._decoder.decode(data)
+        index = text.rfind("\n")
+        if index == -1:
+            # most reads of interactive output, nothing to strip yet
+            self._partial.append(text)
+            self._partial_size += len(text)
+            if self._partial_size > self.max_line_length:
+                self._complete("".join(self._partial))
+                self._partial = []
+                self._partial_size = 0
+            return
+
+        # everything up to the last newline is stripped in one pass, not line by line
+        self._partial.append(text[:index])
+        self._complete("".join(self._partial))
+        self._partial = [text[index + 1:]]
+        self._partial_size = len(text) - index - 1
+
+    def snapshot(self) -> "LineIndex":
+        # a copy to search away from the event loop while feeding goes on. complete
+        # blocks never change, only the deque holding them is copied
+        index = copy.copy(self)
+        index._blocks = collections.deque(self._blocks)
+        index._decoder = copy.copy(self._decoder)
+        index._decoder.setstate(self._decoder.getstate())
+        index._partial = list(self._partial)
+        return index
+
+    def clear(self):
+        # forget the complete lines, numbering carries on where it was
+        self._blocks.clear()
+        self._compressed = None
+        self.start += self.count
+        self.count = 0
+        self.size = 0
+
+    def _complete(self, text: str):
+        lines = self._strip(text).split("\n")
+        size = sum(map(len, lines))
+        self._blocks.append((lines, size))
+        self.count += len(lines)
+        self.size += size
+
+        while len(self._blocks) > 1:
+            oldest, oldest_size = self._blocks[0]
+            if self.count - len(oldest) < self.max_lines and self.size - oldest_size < self.max_size:
+                break
+
+            self._blocks.popleft()
+            self.count -= len(oldest)
+            self.size -= oldest_size
+            self.start += len(oldest)
+
+    def _strip(self, text: str) -> str:
+        if "\x1b" in text:
+            text = _ESCAPE.sub("", text)
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+            if "\r" in text:
+                text = _REDRAW.sub("", text)
+
+        if text.isascii():
+            return text.translate(_CONTROLS)
+        return _CONTROL.sub("", text)
+
+    def search(self, pattern: "re.Pattern", limit: int = 100) -> dict:
+        # newest matches first, so the limit keeps the ones closest to the prompt
+        self.decompress()
+        matches = []
+        truncated = False
+        for number, line in self._newest_first():
+            found = [match.span() for match in pattern.finditer(line) if match.end() > match.start()]
+            if len(found) == 0:
+                continue
+
+            if len(matches) + len(found) > limit:
+                found = found[:limit - len(matches)]
+                truncated = True
+
+            text = line[:self.max_text_length]
+            for start, end in reversed(found):
+                matches.append(dict(line=number, start=start, end=end, text=text))
+            if truncated:
+                break
+
+        matches.reverse()
+        return dict(
+            start=self.start,
+            end=self.end,
+            matches=matches,
+            truncated=truncated,
+        )
+
+    def _newest_first(self):
+        if self._partial_size > 0:
+            yield self.end, self._strip("".join(self._partial))
+
+        number = self.end
+        for lines, _ in reversed(self._blocks):
+            for line in reversed(lines):
+                number -= 1
+                yield number, line
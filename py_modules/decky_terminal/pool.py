@@ -0,0 +1,87 @@
+import asyncio
+import uuid
+from typing import List, Optional
+
+import decky
+
+from .holder import HolderClient
+from .terminal import Terminal
+
+
+class ShellPool:
+    size: int = 0
+    max_size: int = 8
+
+    cmdline: Optional[str] = None
+    flags: dict = None
+    holder: Optional[HolderClient] = None
+
+    _idle: List[Terminal] = None
+    _filling: bool = False
+    _generation: int = 0
+
+    def __init__(self):
+        self._idle = []
+        self.flags = dict()
+
+    @property
+    def idle_size(self) -> int:
+        return len(self._idle)
+
+    def configure(self, size: int, cmdline: str, flags: dict):
+        size = max(0, min(size, self.max_size))
+        if cmdline != self.cmdline or flags != self.flags:
+            # sessions spawned for another shell or environment are of no use anymore
+            self.invalidate()
+
+        self.size = size
+        self.cmdline = cmdline
+        self.flags = dict(flags)
+
+        while len(self._idle) > self.size:
+            self._shutdown(self._idle.pop())
+
+    def acquire(self, terminal_id: str, rows: Optional[int] = None, cols: Optional[int] = None) -> Optional[Terminal]:
+        while len(self._idle) > 0:
+            terminal = self._idle.pop(0)
+            if terminal._is_process_alive():
+                terminal.adopt(terminal_id, rows, cols)
+                return terminal
+
+            self._shutdown(terminal)
+
+        return None
+
+    def refill(self):
+        if not self._filling and len(self._idle) < self.size:
+            asyncio.ensure_future(self._fill())
+
+    def invalidate(self):
+        self._generation += 1
+        idle = self._idle
+        self._idle = []
+        for terminal in idle:
+            self._shutdown(terminal)
+
+    async def _fill(self):
+        self._filling = True
+        try:
+            while len(self._idle) < self.size:
+                generation = self._generation
+                terminal = Terminal(f"pool-{uuid.uuid4()}", self.cmdline, **self.flags)
+                terminal.holder = self.holder
+                await terminal.start()
+
+                if generation != self._generation or len(self._idle) >= self.size:
+                    # invalidated or shrunk while we were spawning
+                    await terminal.shutdown()
+                    continue
+
+                self._idle.append(terminal)
+        except Exception as e:
+            decky.logger.exception("[terminal][EXCEPTION] Exception during shell pool refill: %s", e)
+        finally:
+            self._filling = False
+
+    def _shutdown(self, terminal: Terminal):
+        asyncio.ensure_future(terminal.shutdown())
@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import decky
+
+from .common import Common
+
+
+# Samples the stack of the event loop thread from a helper thread. Unlike cProfile it
+# doesn't hook every call, so the overhead stays flat no matter how busy the loop is.
+class StackSampler:
+    interval: float = 0.005
+
+    samples: int = 0
+
+    _thread: threading.Thread = None
+    _stop: threading.Event = None
+    _target: int = 0
+    _stacks: collections.Counter = None
+
+    def __init__(self, interval: Optional[float] = None):
+        if interval is not None:
+            self.interval = interval
+
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="decky-terminal-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        # "frame;frame;frame count" per line, what flamegraph.pl and speedscope read
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def top(self, limit: int) -> List[dict]:
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self._stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+
+        return [
+            dict(function=function, samples=count, total_samples=total[function])
+            for function, count in own.most_common(limit)
+        ]
+
+
+class Profiler:
+    max_duration: float = 300
+    top_limit: int = 20
+    traceback_limit: int = 16
+
+    mode: Optional[str] = None
+    started: float = 0
+    last_result: Optional[dict] = None
+
+    _profile: cProfile.Profile = None
+    _sampler: StackSampler = None
+    _allocations: bool = False
+    _timer: asyncio.TimerHandle = None
+    _stopping: Optional[asyncio.Future] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, duration: float = 10, mode: str = "sample", allocations: bool = False) -> bool:
+        if self.is_running or mode not in ("sample", "deterministic", "none"):
+            return False
+        if mode == "none" and not allocations:
+            return False
+
+        # nothing is hooked in until here, a disabled profiler costs nothing
+        if mode == "deterministic":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif mode == "sample":
+            self._sampler = StackSampler()
+            self._sampler.start()
+
+        self._allocations = allocations and not tracemalloc.is_tracing()
+        if self._allocations:
+            tracemalloc.start(self.traceback_limit)
+
+        self.mode = mode
+        self.started = time.monotonic()
+
+        duration = max(0.1, min(duration, self.max_duration))
+        self._timer = asyncio.get_event_loop().call_later(duration, lambda: asyncio.ensure_future(self.stop()))
+        decky.logger.info("[profiler][INFO] Profiling started (mode: %s, allocations: %s, %.1fs).", mode, self._allocations, duration)
+        return True
+
+    async def stop(self) -> Optional[dict]:
+        if not self.is_running:
+            # stopped by the timer already, hand out what it collected
+            if self._stopping is not None:
+                return await asyncio.shield(self._stopping)
+            return self.last_result
+
+        self._stopping = asyncio.get_event_loop().create_future()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # collect everything right away, writing the files can happen at leisure
+        profile, sampler, snapshot = self._profile, self._sampler, None
+        if profile is not None:
+            profile.disable()
+        if sampler is not None:
+            sampler.stop()
+        if self._allocations:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        result = dict(mode=self.mode, duration=time.monotonic() - self.started, files=[])
+        self.mode = None
+        self._profile = None
+        self._sampler = None
+
+        try:
+            await self._write_results(result, profile, sampler, snapshot)
+        except Exception as e:
+            decky.logger.exception("[profiler][EXCEPTION] Exception while writing profile: %s", e)
+            result["error"] = str(e)
+
+        self.last_result = result
+        self._stopping.set_result(result)
+        self._stopping = None
+        decky.logger.info("[profiler][INFO] Profiling stopped, results in %s", result["files"])
+        return result
+
+    # RESULTS ===============================================
+    async def _write_results(self, result: dict, profile: Optional[cProfile.Profile], sampler: Optional[StackSampler], snapshot: Optional[tracemalloc.Snapshot]):
+        directory = os.path.join(decky.DECKY_PLUGIN_LOG_DIR, "profiles")
+        await Common._run_async(os.makedirs, directory, 0o755, True)
+        prefix = os.path.join(directory, time.strftime("%Y%m%d-%H%M%S"))
+
+        if profile is not None:
+            filename = prefix + ".pstats"
+            await Common._run_async(profile.dump_stats, filename)
+            result["files"].append(filename)
+            result["functions"] = self._top_functions(profile)
+
+        if sampler is not None:
+            filename = prefix + ".collapsed"
+            await Common._run_async(self._write_text, filename, sampler.collapsed())
+            result["files"].append(filename)
+            result["samples"] = sampler.samples
+            result["functions"] = sampler.top(self.top_limit)
+
+        if snapshot is not None:
+            filename = prefix + ".tracemalloc"
+            await Common._run_async(snapshot.dump, filename)
+            result["files"].append(filename)
+            result["allocations"] = await Common._run_async(self._top_allocations, snapshot)
+
+    def _top_functions(self, profile: cProfile.Profile) -> List[dict]:
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        # own time, cumulative time is topped by the event loop itself
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+
+        return [
+            dict(
+                function=f"{name} ({os.path.basename(filename)}:{line})",
+                calls=calls,
+                tottime=tottime,
+                cumtime=cumtime,
+            )
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in entries[:self.top_limit]
+        ]
+
+    def _top_allocations(self, snapshot: tracemalloc.Snapshot) -> List[dict]:
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+        allocations: List[Dict] = []
+        for stat in snapshot.statistics("lineno")[:self.top_limit]:
+            frame = stat.traceback[0]
+            allocations.append(dict(site=f"{frame.filename}:{frame.lineno}", size=stat.size, count=stat.count))
+
+        return allocations
+
+    def _write_text(self, filename: str, content: str):
+        with open(filename, "w") as f:
+            f.write(content)
@@ -0,0 +1,197 @@
+import asyncio
+import codecs
+import gzip
+import json
+import os
+import shutil
+import time
+from typing import List, Optional, TextIO, Tuple
+
+import decky
+
+from .common import Common
+
+
+# Records a terminal as asciicast v2 (https://docs.asciinema.org/manual/asciicast/v2/).
+#
+# The read path only appends (time, type, bytes) to a list. Decoding, JSON encoding,
+# writing, rotating and compressing all happen in the executor, one flush at a time.
+class Recorder:
+    encoding = "utf-8"
+
+    # flush once this much is pending, or after flush_interval at the latest
+    flush_size: int = 65536
+    flush_interval: float = 0.5
+
+    # a file past max_size is closed, gzipped and followed by a new one.
+    # only the newest max_files of a recording are kept.
+    max_size: int = 8 * 1024 * 1024
+    max_files: int = 5
+
+    record_input: bool = False
+    files: List[str] = None
+
+    _started: float = 0.0
+    _pending: List[Tuple[float, str, bytes]] = None
+    _pending_size: int = 0
+    _timer: asyncio.TimerHandle = None
+    _flushing: Optional[asyncio.Future] = None
+    _closed: bool = False
+
+    _file: Optional[TextIO] = None
+    _file_size: int = 0
+    _file_started: float = 0.0
+    _file_count: int = 0
+
+    def __init__(self, prefix: str, cols: int, rows: int, record_input: bool = False, env: Optional[dict] = None, **kwargs):
+        self.prefix = prefix
+        self.cols = cols
+        self.rows = rows
+        self.record_input = record_input
+        self.env = env or dict()
+        for key in ("flush_size", "flush_interval", "max_size", "max_files"):
+            if kwargs.get(key) is not None:
+                setattr(self, key, kwargs[key])
+
+        self.files = []
+        self._pending = []
+        self._started = time.monotonic()
+        self._decoders = dict(
+            o=codecs.getincrementaldecoder(self.encoding)(errors="replace"),
+            i=codecs.getincrementaldecoder(self.encoding)(errors="replace"),
+        )
+
+    @property
+    def path(self) -> Optional[str]:
+        return self.files[-1] if len(self.files) > 0 else None
+
+    # RECORDING =============================================
+    def record_output(self, data: bytes):
+        self._record("o", bytes(data))
+
+    def record_input_data(self, data: bytes):
+        if self.record_input:
+            self._record("i", bytes(data))
+
+    def record_resize(self, rows: int, cols: int):
+        self._record("r", f"{cols}x{rows}".encode())
+
+    def _record(self, type: str, data: bytes):
+        if self._closed:
+            return
+
+        self._pending.append((time.monotonic() - self._started, type, data))
+        self._pending_size += len(data)
+        if self._pending_size >= self.flush_size:
+            self._flush_soon(0)
+        elif self._timer is None:
+            self._flush_soon(self.flush_interval)
+
+    def _flush_soon(self, delay: float):
+        if self._flushing is not None:
+            # picked up again when the running flush is done
+            return
+
+        if self._timer is not None:
+            if delay > 0:
+                return
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        if self._flushing is None and len(self._pending) > 0:
+            self._flushing = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        try:
+            while len(self._pending) > 0:
+                events = self._pending
+                self._pending = []
+                self._pending_size = 0
+                await Common._run_async(self._write, events)
+        except Exception as e:
+            decky.logger.exception("[recorder][EXCEPTION] Exception during recording write, stopping it: %s", e)
+            self._closed = True
+            self._pending = []
+        finally:
+            self._flushing = None
+
+    async def stop(self) -> List[str]:
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            await self._flushing
+
+        # whatever arrived while the last flush was running
+        if len(self._pending) > 0:
+            await self._flush()
+        await Common._run_async(self._close)
+        return list(self.files)
+
+    # WRITER (executor) =====================================
+    def _write(self, events: List[Tuple[float, str, bytes]]):
+        lines = []
+        for elapsed, type, data in events:
+            if type == "r":
+                self.cols, self.rows = (int(value) for value in data.decode().split("x"))
+                text = data.decode()
+            else:
+                text = self._decoders[type].decode(data)
+                if not text:
+                    continue
+
+            if self._file is None:
+                self._open(elapsed)
+
+            line = json.dumps([round(elapsed - self._file_started, 6), type, text], ensure_ascii=False)
+            lines.append(line)
+            self._file_size += len(line) + 1
+            if self._file_size >= self.max_size:
+                self._file.write("\n".join(lines) + "\n")
+                lines = []
+                self._rotate()
+
+        if len(lines) > 0:
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+
+    def _open(self, elapsed: float):
+        path = f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{self._file_count}.cast"
+        self._file_count += 1
+        os.makedirs(os.path.dirname(path), 0o755, True)
+
+        # every file is a complete recording of its own, times are relative to its start
+        header = dict(
+            version=2,
+            width=self.cols,
+            height=self.rows,
+            timestamp=int(time.time()),
+            env=self.env,
+        )
+        self._file = open(path, "w", encoding=self.encoding)
+        self._file.write(json.dumps(header) + "\n")
+        self._file_size = 0
+        self._file_started = elapsed
+        self.files.append(path)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        self._close()
+        path = self.files[-1]
+        with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.unlink(path)
+        self.files[-1] = path + ".gz"
+
+        while len(self.files) >= self.max_files:
+            try:
+                os.unlink(self.files.pop(0))
+            except OSError:
+                pass
@@ -0,0 +1,66 @@
+from typing import Optional
+
+
+class RingBuffer:
+    capacity: int = 0
+
+    _data: bytearray = None
+    _start: int = 0
+    _size: int = 0
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self):
+        self._start = 0
+        self._size = 0
+
+    def append(self, data):
+        length = len(data)
+        if length == 0:
+            return
+
+        view = memoryview(data)
+        if length >= self.capacity:
+            # only the tail survives, store it unwrapped
+            self._data[:] = view[length - self.capacity:]
+            self._start = 0
+            self._size = self.capacity
+            return
+
+        end = (self._start + self._size) % self.capacity
+        first = min(length, self.capacity - end)
+        self._data[end:end + first] = view[:first]
+        if first < length:
+            self._data[:length - first] = view[first:]
+
+        self._size += length
+        if self._size > self.capacity:
+            self._start = (self._start + self._size - self.capacity) % self.capacity
+            self._size = self.capacity
+
+    # offset is relative to the oldest byte still in the buffer
+    def snapshot(self, offset: int = 0, length: Optional[int] = None) -> bytes:
+        offset = max(0, min(offset, self._size))
+        if length is None or length > self._size - offset:
+            length = self._size - offset
+
+        if length <= 0:
+            return b""
+
+        begin = (self._start + offset) % self.capacity
+        end = begin + length
+        if end <= self.capacity:
+            return bytes(self._data[begin:end])
+
+        view = memoryview(self._data)
+        return b"".join((view[begin:], view[:end - self.capacity]))
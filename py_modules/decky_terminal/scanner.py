@@ -0,0 +1,96 @@
+import re
+from typing import Optional
+
+# Only the sequences the terminal itself cares about, everything else is left to the client.
+_SEQUENCE = re.compile(
+    rb"\x1b(?:"
+    rb"\[([0-?]*)[ -/]*([@-~])"             # 1,2: CSI params, final
+    rb"|\]([^\x07\x1b]*)(?:\x07|\x1b\\)"    # 3: OSC payload
+    rb"|(c)"                                # 4: RIS (full reset)
+    rb")"
+)
+
+# Prefixes of the sequences above which may complete in the next read.
+_PARTIAL = re.compile(rb"\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?")
+_PARTIAL_LIMIT = 4096
+
+# The last ESC and everything after it. Chunks may be memoryviews, which have no rfind().
+_LAST_ESCAPE = re.compile(rb"\x1b[^\x1b]*\Z")
+
+_TITLE_COMMANDS = (b"0", b"1", b"2")
+_ALT_SCREEN_MODES = (b"47", b"1047", b"1049")
+_BRACKETED_PASTE_MODE = b"2004"
+
+
+class ScanResult:
+    __slots__ = ("data", "clear_index", "title", "alt_screen", "bracketed_paste")
+
+    def __init__(self, data):
+        # data is the scanned chunk, prefixed with the carried over bytes of the previous read
+        self.data = data
+        self.clear_index: int = -1
+        self.title: Optional[str] = None
+        self.alt_screen: Optional[bool] = None
+        self.bracketed_paste: Optional[bool] = None
+
+
+class EscapeScanner:
+    encoding: str = "utf-8"
+
+    _carry: bytes = b""
+
+    def __init__(self, encoding: str = "utf-8"):
+        self.encoding = encoding
+        self._carry = b""
+
+    @property
+    def carry_size(self) -> int:
+        return len(self._carry)
+
+    def scan(self, chunk) -> ScanResult:
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+
+        result = ScanResult(data)
+        end = 0
+        home_end = -1
+        home_start = -1
+
+        for match in _SEQUENCE.finditer(data):
+            start = match.start()
+            end = match.end()
+            final = match.group(2)
+
+            if final is not None:
+                params = match.group(1)
+                if final == b"H" and not params:
+                    home_start, home_end = start, end
+                    continue
+
+                if final == b"J" and params in (b"2", b"3"):
+                    # keep the cursor home that goes along with the clear
+                    result.clear_index = home_start if home_end == start else start
+                elif final in b"hl" and params[:1] == b"?":
+                    for mode in params[1:].split(b";"):
+                        if mode in _ALT_SCREEN_MODES:
+                            result.alt_screen = final == b"h"
+                        elif mode == _BRACKETED_PASTE_MODE:
+                            result.bracketed_paste = final == b"h"
+            elif match.group(3) is not None:
+                command, _, title = match.group(3).partition(b";")
+                if command in _TITLE_COMMANDS:
+                    result.title = title.decode(self.encoding, errors="replace")
+            elif match.group(4) is not None:
+                result.clear_index = start
+                result.alt_screen = False
+                result.bracketed_paste = False
+
+        # carry an unfinished sequence at the end of the chunk over to the next read
+        last = _LAST_ESCAPE.search(data, end)
+        if last is not None:
+            tail = last.start()
+            if len(data) - tail < _PARTIAL_LIMIT and _PARTIAL.fullmatch(data, tail):
+                # a copy, the chunk may be a view of a buffer that is about to be reused
+                self._carry = bytes(data[tail:])
+
+        return result
@@ -0,0 +1,882 @@
+import codecs
+import collections
+import re
+import unicodedata
+from typing import List, Optional
+
+# Tokens we understand. Anything in between two matches is either printable text or
+# an escape sequence that has not been fully received yet.
+# Dispatch happens on Match.lastindex, keep the group numbers below in sync with feed_text.
+_TOKEN = re.compile(
+    r"([^\x00-\x1f\x1b\x7f-\x9f]+)(\r\n)?"     # 1: printable text, 2: followed by a new line
+    r"|\x1b\[([0-?]*)([ -/]*)([@-~])"           # 3,4,5: CSI params, intermediates, final
+    r"|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)"       # OSC (handled by the scanner)
+    r"|\x1b[P^_][^\x1b]*\x1b\\"                 # DCS / PM / APC, ignored
+    r"|\x1b([ -/]+)([0-~])"                     # 6,7: ESC with intermediates (charsets, ...)
+    r"|\x1b([0-OQ-Z\\`-~])"                       # 8: two character ESC sequences
+    r"|(\r\n)"                                  # 9: new line
+    r"|([\x00-\x1a\x1c-\x1f\x7f-\x9f])"           # 10: C0 / C1 controls
+)
+_TEXT, _TEXT_NEWLINE, _CSI, _ESC_INTERMEDIATE, _ESC, _NEWLINE, _CONTROL = 1, 2, 5, 7, 8, 9, 10
+
+# Prefixes of the sequences above, used to tell "incomplete" apart from "invalid".
+_PARTIAL = re.compile(
+    r"\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[P^_][^\x1b]*\x1b?|[ -/]*)?"
+)
+_PARTIAL_LIMIT = 4096
+
+# private modes that change how the client talks to the application,
+# they have to be restored on the client when it attaches.
+_REPLAYED_MODES = (1, 7, 12, 25, 1000, 1002, 1003, 1004, 1005, 1006, 1015, 2004)
+_DEFAULT_MODES = {7, 25}
+
+# sequences that end a pending wrap: cursor movement, erasing, editing and modes.
+# SGR, OSC, charsets and the like leave it alone, the next character still wraps.
+_CSI_WRAP_RESETS = frozenset("ABCDEFGHJKLMPX@`adefhlr")
+_ESC_WRAP_RESETS = frozenset("DEMc")
+
+_SGR_FLAGS = {1: "1", 2: "2", 3: "3", 4: "4", 5: "5", 7: "7", 8: "8", 9: "9"}
+_SGR_FLAG_RESETS = {22: ("1", "2"), 23: ("3",), 24: ("4",), 25: ("5",), 27: ("7",), 28: ("8",), 29: ("9",)}
+
+
+class _Line:
+    __slots__ = ("chars", "attrs", "wrapped")
+
+    def __init__(self, cols: int, attr: str = ""):
+        self.chars: List[str] = [" "] * cols
+        self.attrs: List[str] = [attr] * cols
+        self.wrapped: bool = False
+
+    def resize(self, cols: int):
+        length = len(self.chars)
+        if cols < length:
+            del self.chars[cols:]
+            del self.attrs[cols:]
+        elif cols > length:
+            self.chars.extend([" "] * (cols - length))
+            self.attrs.extend([""] * (cols - length))
+
+    def render(self, trim: bool = True) -> str:
+        end = len(self.chars)
+        if trim:
+            while end > 0 and self.chars[end - 1] == " " and self.attrs[end - 1] == "":
+                end -= 1
+
+        output = []
+        current = ""
+        for i in range(end):
+            char = self.chars[i]
+            if char == "":
+                # right half of a wide character
+                continue
+
+            attr = self.attrs[i]
+            if attr != current:
+                output.append(f"\x1b[0;{attr}m" if attr else "\x1b[0m")
+                current = attr
+            output.append(char)
+
+        if current:
+            output.append("\x1b[0m")
+
+        return "".join(output)
+
+
+class Screen:
+    rows: int = 24
+    cols: int = 80
+    scrollback_lines: int = 1000
+
+    x: int = 0
+    y: int = 0
+
+    alt_screen: bool = False
+    keypad_application: bool = False
+
+    _lines: List[_Line] = None
+    _main_lines: Optional[List[_Line]] = None
+    scrollback: collections.deque = None
+
+    _top: int = 0
+    _bottom: int = 23
+    _wrap_pending: bool = False
+    _saved_cursor: tuple = None
+    _main_saved_cursor: tuple = None
+
+    _attr: str = ""
+    _attr_flags: set = None
+    _attr_fg: str = ""
+    _attr_bg: str = ""
+
+    _modes: set = None
+    _carry: str = ""
+    _blank_row: List[str] = []
+
+    def __init__(self, rows: int = 24, cols: int = 80, scrollback_lines: int = 1000):
+        self.rows = max(1, rows)
+        self.cols = max(1, cols)
+        self.scrollback_lines = scrollback_lines
+        self.scrollback = collections.deque(maxlen=scrollback_lines)
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.reset()
+
+    def reset(self):
+        self._lines = [_Line(self.cols) for _ in range(self.rows)]
+        self._main_lines = None
+        self.alt_screen = False
+        self.keypad_application = False
+        self.x = 0
+        self.y = 0
+        self._top = 0
+        self._bottom = self.rows - 1
+        self._wrap_pending = False
+        self._modes = set(_DEFAULT_MODES)
+        self._reset_attr()
+        self._save_cursor()
+        self._main_saved_cursor = self._saved_cursor
+
+    # INPUT =================================================
+    def feed(self, data: bytes):
+        self.feed_text(self._decoder.decode(data))
+
+    def pending_bytes(self) -> bytes:
+        # fed, but not applied yet: a split character or an unfinished escape sequence
+        return self._carry.encode("utf-8") + self._decoder.getstate()[0]
+
+    def feed_text(self, text: str):
+        if self._carry:
+            text = self._carry + text
+            self._carry = ""
+
+        pos = 0
+        length = len(text)
+        while pos < length:
+            match = _TOKEN.match(text, pos)
+            if match is None:
+                # a lone ESC: either the rest of the sequence is still in flight or it is garbage
+                rest = text[pos:]
+                if len(rest) < _PARTIAL_LIMIT and _PARTIAL.fullmatch(rest):
+                    self._carry = rest
+                    return
+                pos += 1
+                continue
+
+            pos = match.end()
+            kind = match.lastindex
+            if kind == _TEXT:
+                self._print(match.group(1))
+            elif kind == _TEXT_NEWLINE:
+                self._print(match.group(1))
+                self._newline()
+            elif kind == _NEWLINE:
+                self._newline()
+            elif kind == _CSI:
+                final = match.group(5)
+                if final in _CSI_WRAP_RESETS:
+                    self._wrap_pending = False
+                self._csi(match.group(3), match.group(4), final)
+            elif kind == _ESC:
+                final = match.group(8)
+                if final in _ESC_WRAP_RESETS:
+                    self._wrap_pending = False
+                self._esc(final)
+            elif kind == _CONTROL:
+                self._control(match.group(10))
+            # OSC, DCS, charset designation and friends, nothing to track
+
+    # TEXT ==================================================
+    def _print(self, text: str):
+        if text.isascii():
+            self._print_run(text)
+            return
+
+        run_start = 0
+        for i, char in enumerate(text):
+            if char.isascii():
+                continue
+
+            width = self._char_width(char)
+            if width == 1:
+                continue
+
+            if run_start < i:
+                self._print_run(text[run_start:i])
+            run_start = i + 1
+
+            if width == 0:
+                self._combine(char)
+            else:
+                self._print_wide(char)
+
+        if run_start < len(text):
+            self._print_run(text[run_start:])
+
+    def _char_width(self, char: str) -> int:
+        if unicodedata.combining(char) or char == "\u200b":
+            return 0
+        if unicodedata.east_asian_width(char) in ("W", "F"):
+            return 2
+        return 1
+
+    def _print_run(self, text: str):
+        length = len(text)
+        x = self.x
+        if not self._wrap_pending and x + length < self.cols:
+            # fast path: fits on the current line
+            line = self._lines[self.y]
+            self._split_wide(line, x, x + length)
+            line.chars[x:x + length] = text
+            line.attrs[x:x + length] = [self._attr] * length
+            self.x = x + length
+            return
+
+        pos = 0
+        while pos < length:
+            if self._wrap_pending:
+                self._wrap()
+
+            line = self._lines[self.y]
+            count = min(self.cols - self.x, length - pos)
+            end = self.x + count
+            self._split_wide(line, self.x, end)
+            line.chars[self.x:end] = text[pos:pos + count]
+            line.attrs[self.x:end] = [self._attr] * count
+            pos += count
+
+            if end >= self.cols:
+                self.x = self.cols - 1
+                if 7 in self._modes:
+                    self._wrap_pending = True
+                elif pos < length:
+                    # no autowrap: the rest keeps overwriting the last column
+                    line.chars[self.x] = text[length - 1]
+                    return
+            else:
+                self.x = end
+
+    def _print_wide(self, char: str):
+        if self._wrap_pending:
+            self._wrap()
+
+        if self.x >= self.cols - 1:
+            if 7 not in self._modes or self.cols < 2:
+                return
+            # padding like the right half, it isn't part of the text when reflowing
+            line = self._lines[self.y]
+            self._split_wide(line, self.x, self.x + 1)
+            line.chars[self.x] = ""
+            line.attrs[self.x] = self._attr_bg
+            self._wrap()
+
+        line = self._lines[self.y]
+        self._split_wide(line, self.x, self.x + 2)
+        line.chars[self.x] = char
+        line.chars[self.x + 1] = ""
+        line.attrs[self.x] = self._attr
+        line.attrs[self.x + 1] = self._attr
+
+        if self.x + 2 >= self.cols:
+            self.x = self.cols - 1
+            self._wrap_pending = 7 in self._modes
+        else:
+            self.x += 2
+
+    def _split_wide(self, line: _Line, start: int, end: int):
+        # cells [start, end) are about to be overwritten. a wide character cut in half
+        # by that loses its other half as well, like on a real terminal
+        if 0 < start < len(line.chars) and line.chars[start] == "" and self._char_width(line.chars[start - 1][:1] or " ") == 2:
+            line.chars[start - 1] = " "
+            line.chars[start] = " "
+        if 0 < end < len(line.chars) and line.chars[end] == "" and self._char_width(line.chars[end - 1][:1] or " ") == 2:
+            line.chars[end] = " "
+
+    def _combine(self, char: str):
+        line = self._lines[self.y]
+        x = self.x if self._wrap_pending else self.x - 1
+        while x > 0 and line.chars[x] == "":
+            x -= 1
+        if x >= 0:
+            line.chars[x] += char
+
+    def _wrap(self):
+        self._wrap_pending = False
+        self._lines[self.y].wrapped = True
+        self.x = 0
+        self._index()
+
+    # CONTROLS ==============================================
+    def _newline(self):
+        self.x = 0
+        self._wrap_pending = False
+        self._index()
+
+    def _control(self, char: str):
+        if char == "\r":
+            self.x = 0
+            self._wrap_pending = False
+        elif char in "\n\x0b\x0c":
+            self._wrap_pending = False
+            self._index()
+        elif char == "\b":
+            if self._wrap_pending:
+                self._wrap_pending = False
+            elif self.x > 0:
+                self.x -= 1
+        elif char == "\t":
+            self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+        elif char == "\x84":
+            self._index()
+        elif char == "\x85":
+            self.x = 0
+            self._index()
+        elif char == "\x8d":
+            self._reverse_index()
+
+    def _esc(self, final: str):
+        if final == "7":
+            self._save_cursor()
+        elif final == "8":
+            self._restore_cursor()
+        elif final == "D":
+            self._index()
+        elif final == "E":
+            self.x = 0
+            self._index()
+        elif final == "M":
+            self._reverse_index()
+        elif final == "c":
+            self.reset()
+        elif final == "=":
+            self.keypad_application = True
+        elif final == ">":
+            self.keypad_application = False
+
+    def _csi(self, params: str, intermediates: str, final: str):
+        private = ""
+        if params and params[0] in "<=>?":
+            private = params[0]
+            params = params[1:]
+
+        if intermediates:
+            # DECSCUSR, DECSTR and friends
+            if intermediates == "!" and final == "p":
+                self._soft_reset()
+            return
+
+        args = []
+        for arg in params.split(";") if params else ():
+            arg = arg.split(":")[0]
+            args.append(int(arg) if arg.isdigit() else 0)
+
+        def arg(index: int = 0, default: int = 1) -> int:
+            if index < len(args) and args[index] != 0:
+                return args[index]
+            return default
+
+        if private == "?":
+            if final == "h":
+                self._set_private_modes(args, True)
+            elif final == "l":
+                self._set_private_modes(args, False)
+            elif final == "J":
+                self._erase_display(arg(0, 0))
+            elif final == "K":
+                self._erase_line(arg(0, 0))
+            return
+
+        if private:
+            return
+
+        if final == "m":
+            self._sgr(args)
+        elif final == "A":
+            self.y = max(self._top if self.y >= self._top else 0, self.y - arg())
+        elif final in "Be":
+            self.y = min(self._bottom if self.y <= self._bottom else self.rows - 1, self.y + arg())
+        elif final in "Ca":
+            self.x = min(self.cols - 1, self.x + arg())
+        elif final == "D":
+            self.x = max(0, self.x - arg())
+        elif final == "E":
+            self.y = min(self.rows - 1, self.y + arg())
+            self.x = 0
+        elif final == "F":
+            self.y = max(0, self.y - arg())
+            self.x = 0
+        elif final in "G`":
+            self.x = min(self.cols - 1, arg() - 1)
+        elif final in "Hf":
+            self.y = min(self.rows - 1, arg(0) - 1)
+            self.x = min(self.cols - 1, arg(1) - 1)
+        elif final == "d":
+            self.y = min(self.rows - 1, arg() - 1)
+        elif final == "J":
+            self._erase_display(arg(0, 0))
+        elif final == "K":
+            self._erase_line(arg(0, 0))
+        elif final == "L":
+            self._insert_lines(arg())
+        elif final == "M":
+            self._delete_lines(arg())
+        elif final == "@":
+            self._insert_chars(arg())
+        elif final == "P":
+            self._delete_chars(arg())
+        elif final == "X":
+            self._erase_chars(arg())
+        elif final == "S":
+            self._scroll_up(arg())
+        elif final == "T":
+            self._scroll_down(arg())
+        elif final == "r":
+            top = arg(0) - 1
+            bottom = arg(1, self.rows) - 1
+            if 0 <= top < bottom < self.rows:
+                self._top = top
+                self._bottom = bottom
+                self.x = 0
+                self.y = 0
+        elif final == "s":
+            self._save_cursor()
+        elif final == "u":
+            self._restore_cursor()
+
+    # MODES =================================================
+    def _set_private_modes(self, modes: List[int], enabled: bool):
+        for mode in modes:
+            if mode in (47, 1047, 1049):
+                if mode == 1049 and enabled:
+                    self._save_cursor()
+                self._switch_screen(enabled, clear=mode != 47)
+                if mode == 1049 and not enabled:
+                    self._restore_cursor()
+            elif mode == 1048:
+                if enabled:
+                    self._save_cursor()
+                else:
+                    self._restore_cursor()
+            elif enabled:
+                self._modes.add(mode)
+            else:
+                self._modes.discard(mode)
+
+    def _switch_screen(self, alt: bool, clear: bool = True):
+        if alt == self.alt_screen:
+            return
+
+        if alt:
+            self._main_lines = self._lines
+            self._main_saved_cursor = self._saved_cursor
+            self._lines = [_Line(self.cols) for _ in range(self.rows)]
+        else:
+            self._lines = self._main_lines
+            self._main_lines = None
+            self._saved_cursor = self._main_saved_cursor
+
+        self.alt_screen = alt
+        self._wrap_pending = False
+
+    def _save_cursor(self):
+        self._saved_cursor = (self.x, self.y, self._attr, set(self._attr_flags), self._attr_fg, self._attr_bg)
+
+    def _restore_cursor(self):
+        self.x, self.y, self._attr, flags, self._attr_fg, self._attr_bg = self._saved_cursor
+        self._attr_flags = set(flags)
+        self.x = min(self.x, self.cols - 1)
+        self.y = min(self.y, self.rows - 1)
+        self._wrap_pending = False
+
+    def _soft_reset(self):
+        self._modes = set(_DEFAULT_MODES)
+        self.keypad_application = False
+        self._top = 0
+        self._bottom = self.rows - 1
+        self._reset_attr()
+
+    # SGR ===================================================
+    def _reset_attr(self):
+        self._attr = ""
+        self._attr_flags = set()
+        self._attr_fg = ""
+        self._attr_bg = ""
+
+    def _sgr(self, args: List[int]):
+        if not args:
+            args = [0]
+
+        i = 0
+        while i < len(args):
+            code = args[i]
+            if code == 0:
+                self._attr_flags.clear()
+                self._attr_fg = ""
+                self._attr_bg = ""
+            elif code in _SGR_FLAGS:
+                self._attr_flags.add(_SGR_FLAGS[code])
+            elif code in _SGR_FLAG_RESETS:
+                self._attr_flags.difference_update(_SGR_FLAG_RESETS[code])
+            elif 30 <= code <= 37 or 90 <= code <= 97:
+                self._attr_fg = str(code)
+            elif 40 <= code <= 47 or 100 <= code <= 107:
+                self._attr_bg = str(code)
+            elif code == 39:
+                self._attr_fg = ""
+            elif code == 49:
+                self._attr_bg = ""
+            elif code in (38, 48) and i + 1 < len(args):
+                if args[i + 1] == 5 and i + 2 < len(args):
+                    color = f"{code};5;{args[i + 2]}"
+                    i += 2
+                elif args[i + 1] == 2 and i + 4 < len(args):
+                    color = f"{code};2;{args[i + 2]};{args[i + 3]};{args[i + 4]}"
+                    i += 4
+                else:
+                    color = None
+                    i += 1
+
+                if color is not None:
+                    if code == 38:
+                        self._attr_fg = color
+                    else:
+                        self._attr_bg = color
+            i += 1
+
+        parts = sorted(self._attr_flags)
+        if self._attr_fg:
+            parts.append(self._attr_fg)
+        if self._attr_bg:
+            parts.append(self._attr_bg)
+        self._attr = ";".join(parts)
+
+    # SCROLLING =============================================
+    def _blank_line(self) -> _Line:
+        # erased cells keep the current background (bce)
+        return _Line(self.cols, self._attr_bg)
+
+    def _index(self):
+        if self.y == self._bottom:
+            self._scroll_up(1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _reverse_index(self):
+        if self.y == self._top:
+            self._scroll_down(1)
+        elif self.y > 0:
+            self.y -= 1
+
+    def _scroll_up(self, count: int):
+        count = min(count, self._bottom - self._top + 1)
+        keep_history = self._top == 0 and not self.alt_screen
+        for _ in range(count):
+            line = self._lines.pop(self._top)
+            blank = None
+            if keep_history:
+                if len(self.scrollback) == self.scrollback.maxlen and self.scrollback.maxlen > 0:
+                    # recycle the line that falls out of the history instead of allocating
+                    blank = self._recycle_line(self.scrollback.popleft())
+                self.scrollback.append(line)
+            elif not self.alt_screen or self._top != 0:
+                blank = self._recycle_line(line)
+
+            self._lines.insert(self._bottom, blank if blank is not None else self._blank_line())
+
+    def _recycle_line(self, line: _Line) -> Optional[_Line]:
+        if len(line.chars) != self.cols:
+            return None
+
+        line.chars[:] = self._blank_chars()
+        line.attrs[:] = [self._attr_bg] * self.cols
+        line.wrapped = False
+        return line
+
+    def _blank_chars(self) -> List[str]:
+        if len(self._blank_row) != self.cols:
+            self._blank_row = [" "] * self.cols
+        return self._blank_row
+
+    def _scroll_down(self, count: int):
+        count = min(count, self._bottom - self._top + 1)
+        for _ in range(count):
+            self._lines.pop(self._bottom)
+            self._lines.insert(self._top, self._blank_line())
+
+    def _insert_lines(self, count: int):
+        if not self._top <= self.y <= self._bottom:
+            return
+        count = min(count, self._bottom - self.y + 1)
+        for _ in range(count):
+            self._lines.pop(self._bottom)
+            self._lines.insert(self.y, self._blank_line())
+        self.x = 0
+
+    def _delete_lines(self, count: int):
+        if not self._top <= self.y <= self._bottom:
+            return
+        count = min(count, self._bottom - self.y + 1)
+        for _ in range(count):
+            self._lines.pop(self.y)
+            self._lines.insert(self._bottom, self._blank_line())
+        self.x = 0
+
+    # ERASING ===============================================
+    def _erase_display(self, mode: int):
+        if mode == 0:
+            self._erase_line(0)
+            for y in range(self.y + 1, self.rows):
+                self._lines[y] = self._blank_line()
+        elif mode == 1:
+            self._erase_line(1)
+            for y in range(0, self.y):
+                self._lines[y] = self._blank_line()
+        elif mode == 2:
+            self._lines = [self._blank_line() for _ in range(self.rows)]
+        elif mode == 3:
+            self.scrollback.clear()
+
+    def _erase_line(self, mode: int):
+        line = self._lines[self.y]
+        if mode == 0:
+            start, end = self.x, self.cols
+            line.wrapped = False
+        elif mode == 1:
+            start, end = 0, self.x + 1
+        else:
+            start, end = 0, self.cols
+            line.wrapped = False
+
+        self._split_wide(line, start, end)
+        line.chars[start:end] = [" "] * (end - start)
+        line.attrs[start:end] = [self._attr_bg] * (end - start)
+
+    def _erase_chars(self, count: int):
+        line = self._lines[self.y]
+        end = min(self.cols, self.x + count)
+        self._split_wide(line, self.x, end)
+        line.chars[self.x:end] = [" "] * (end - self.x)
+        line.attrs[self.x:end] = [self._attr_bg] * (end - self.x)
+
+    def _insert_chars(self, count: int):
+        line = self._lines[self.y]
+        count = min(count, self.cols - self.x)
+        self._split_wide(line, self.x, self.x)
+        line.chars[self.x:self.x] = [" "] * count
+        line.attrs[self.x:self.x] = [self._attr_bg] * count
+        del line.chars[self.cols:]
+        del line.attrs[self.cols:]
+        if line.chars[-1] != "" and self._char_width(line.chars[-1][:1] or " ") == 2:
+            # pushed off the edge with its right half gone
+            line.chars[-1] = " "
+
+    def _delete_chars(self, count: int):
+        line = self._lines[self.y]
+        count = min(count, self.cols - self.x)
+        self._split_wide(line, self.x, self.x + count)
+        if count > 0 and self._ends_in_padding(line):
+            # moved away from the edge it's just a blank
+            line.chars[-1] = " "
+        del line.chars[self.x:self.x + count]
+        del line.attrs[self.x:self.x + count]
+        line.chars.extend([" "] * count)
+        line.attrs.extend([self._attr_bg] * count)
+
+    # RESIZE ================================================
+    def resize(self, rows: int, cols: int):
+        rows = max(1, rows)
+        cols = max(1, cols)
+        if rows == self.rows and cols == self.cols:
+            return
+
+        if cols != self.cols:
+            self._reflow(cols)
+
+        screens = [self._lines]
+        if self._main_lines is not None:
+            screens.append(self._main_lines)
+
+        main_lines = self._main_lines if self.alt_screen else self._lines
+        for lines in screens:
+            for line in lines:
+                line.resize(cols)
+
+            if rows < self.rows:
+                # drop blank lines below the cursor first, then push the rows above the
+                # cursor into history. whatever is still too much below it is cut off (xterm)
+                cursor_y = self.y if lines is self._lines else self._main_saved_cursor[1]
+                excess = self.rows - rows
+                while excess > 0 and len(lines) - 1 > cursor_y and self._is_blank(lines[-1]):
+                    lines.pop()
+                    excess -= 1
+
+                moved = min(excess, cursor_y)
+                for _ in range(moved):
+                    line = lines.pop(0)
+                    if lines is main_lines:
+                        self.scrollback.append(line)
+                del lines[rows:]
+
+                if lines is self._lines:
+                    self.y -= moved
+                else:
+                    self._main_saved_cursor = (self._main_saved_cursor[0], cursor_y - moved) + self._main_saved_cursor[2:]
+
+            while len(lines) < rows:
+                lines.append(_Line(cols))
+
+        self.rows = rows
+        self.cols = cols
+        self._top = 0
+        self._bottom = rows - 1
+        self.x = min(self.x, cols - 1)
+        self.y = max(0, min(self.y, rows - 1))
+        self._wrap_pending = False
+
+    def _reflow(self, cols: int):
+        # rewrap history and main screen to the new width the way the client does, so
+        # soft-wrapped lines stay joined. only the primary screen, whether shown or saved:
+        # the alternate screen is just cut or padded by resize(), its app redraws it.
+        main_lines = self._main_lines if self.alt_screen else self._lines
+        if self.alt_screen:
+            x, y = self._main_saved_cursor[0], self._main_saved_cursor[1]
+        else:
+            # with a wrap pending the cursor is already past the last column
+            x, y = self.x + (1 if self._wrap_pending else 0), self.y
+
+        lines = list(self.scrollback) + main_lines
+        cursor_row = len(self.scrollback) + y
+        reflowed: List[_Line] = []
+        new_cursor = (0, 0)
+
+        first = 0
+        for index, line in enumerate(lines):
+            if line.wrapped and index != len(lines) - 1:
+                continue
+
+            # the text of the logical line without padding (right halves of wide characters,
+            # the cell left empty when one didn't fit at the end of a row), they're laid out anew
+            cells = []
+            offset = -1
+            for row in range(first, index + 1):
+                part = lines[row]
+                if row == cursor_row:
+                    offset = len(cells) + sum(1 for char in part.chars[:x] if char != "")
+                cells.extend(cell for cell in zip(part.chars, part.attrs) if cell[0] != "")
+
+            end = len(cells)
+            while end > max(0, offset) and cells[end - 1] == (" ", ""):
+                end -= 1
+
+            line = _Line(cols)
+            column = 0
+            for position in range(end):
+                char, attr = cells[position]
+                width = 2 if cols > 1 and self._char_width(char[0]) == 2 else 1
+                if column + width > cols:
+                    if column < cols:
+                        line.chars[column] = ""
+                    line.wrapped = True
+                    reflowed.append(line)
+                    line = _Line(cols)
+                    column = 0
+
+                if position == offset:
+                    new_cursor = (column, len(reflowed))
+                line.chars[column] = char
+                line.attrs[column] = attr
+                if width == 2:
+                    line.chars[column + 1] = ""
+                    line.attrs[column + 1] = attr
+                column += width
+
+            if offset >= end:
+                # right after the text, at the end of a full row that's a pending wrap
+                new_cursor = (min(column, cols - 1), len(reflowed))
+            reflowed.append(line)
+
+            first = index + 1
+
+        x, cursor_row = new_cursor
+        # blank lines below the cursor are just unused screen, not content to keep
+        while len(reflowed) > cursor_row + 1 and self._is_blank(reflowed[-1]):
+            reflowed.pop()
+
+        top = min(max(0, len(reflowed) - self.rows), cursor_row)
+        main_lines[:] = reflowed[top:top + self.rows]
+        while len(main_lines) < self.rows:
+            main_lines.append(_Line(cols))
+
+        self.scrollback.clear()
+        self.scrollback.extend(reflowed[:top])
+
+        if self.alt_screen:
+            self._main_saved_cursor = (x, cursor_row - top) + self._main_saved_cursor[2:]
+        else:
+            self.x, self.y = x, cursor_row - top
+        self._saved_cursor = (min(self._saved_cursor[0], cols - 1),) + self._saved_cursor[1:]
+
+    def _ends_in_padding(self, line: _Line) -> bool:
+        # the cell skipped by a wide character, not the right half of one
+        if line.chars[-1] != "" or len(line.chars) < 2:
+            return False
+        return line.chars[-2] == "" or self._char_width(line.chars[-2][:1] or " ") != 2
+
+    def _is_blank(self, line: _Line) -> bool:
+        return all(char == " " for char in line.chars) and all(attr == "" for attr in line.attrs)
+
+    # SERIALIZE =============================================
+    def serialize(self) -> str:
+        output = ["\x1b[0m\x1b[H\x1b[2J\x1b[3J"]
+
+        main_lines = self._main_lines if self.alt_screen else self._lines
+        output.append(self._render_lines(list(self.scrollback) + main_lines))
+
+        if self.alt_screen:
+            output.append("\x1b[?1049h\x1b[H")
+            output.append(self._render_lines(self._lines))
+
+        if self._top != 0 or self._bottom != self.rows - 1:
+            output.append(f"\x1b[{self._top + 1};{self._bottom + 1}r")
+
+        for mode in _REPLAYED_MODES:
+            enabled = mode in self._modes
+            if enabled != (mode in _DEFAULT_MODES):
+                output.append(f"\x1b[?{mode}{'h' if enabled else 'l'}")
+
+        if self.keypad_application:
+            output.append("\x1b=")
+
+        output.append(f"\x1b[{self.y + 1};{self.x + 1}H")
+        if self._attr:
+            output.append(f"\x1b[0;{self._attr}m")
+
+        return "".join(output)
+
+    def _render_lines(self, lines: List[_Line]) -> str:
+        output = []
+        last = len(lines) - 1
+        joined = False
+        for i, line in enumerate(lines):
+            text = line.render(trim=not (line.wrapped and i != last))
+            if joined and not text:
+                # the wrap only happens once something is printed, a blank does the same
+                text = " "
+            output.append(text)
+            if joined and not (line.wrapped and i != last) and (
+                (line.chars[-1] == " " and line.attrs[-1] == "") or self._ends_in_padding(line)
+            ):
+                # the wrap scrolled this line in with the background of whatever came next
+                # (or a placeholder is left on it), the trimmed blanks have to be erased
+                output.append("\x1b[K")
+
+            # soft-wrapped lines are printed in full and rely on autowrap, so the client
+            # keeps them joined even when they end in blanks
+            joined = line.wrapped and i != last
+            if joined and self._ends_in_padding(line):
+                # only a wide character that doesn't fit leaves the last cell empty. a
+                # placeholder does that, the next line is printed over it
+                attr = line.attrs[-1]
+                output.append(f"\x1b[0;{attr}m\u3000\x1b[0m\r" if attr else "\u3000\r")
+            if i != last and not joined:
+                output.append("\r\n")
+
+        return "".join(output)
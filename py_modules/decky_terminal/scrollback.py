@@ -0,0 +1,132 @@
+import mmap
+import os
+import shutil
+from typing import List, Optional
+
+import decky
+
+
+class _Segment:
+    __slots__ = ("start", "path", "fd", "size", "map")
+
+    def __init__(self, start: int, path: str):
+        self.start = start
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o600)
+        self.size = 0
+        self.map: Optional[mmap.mmap] = None
+
+    @property
+    def end(self) -> int:
+        return self.start + self.size
+
+    def read(self, offset: int, length: int) -> bytes:
+        # the active segment keeps growing, remap once the mapping is too short
+        if self.map is None or len(self.map) < offset + length:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+        return self.map[offset:offset + length]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        os.close(self.fd)
+
+
+# Append-only scrollback on disk, split into segments that are read through mmap.
+# Only the segment list lives in memory, the history itself stays in the page cache.
+class ScrollbackStore:
+    path: str = None
+    segment_size: int = 4 * 1024 * 1024
+    max_size: int = 64 * 1024 * 1024
+
+    _segments: List[_Segment] = None
+    _end: int = 0
+
+    def __init__(self, path: str, max_size: int = None, segment_size: int = None):
+        self.path = path
+        if max_size is not None:
+            self.max_size = max_size
+        if segment_size is not None:
+            self.segment_size = segment_size
+
+        self._segments = []
+        self._end = 0
+
+    # PROPERTIES ============================================
+    @property
+    def start(self) -> int:
+        if len(self._segments) == 0:
+            return self._end
+        return self._segments[0].start
+
+    @property
+    def end(self) -> int:
+        return self._end
+
+    # LIFECYCLE =============================================
+    def open(self):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self._new_segment()
+
+    def close(self, remove: bool = True):
+        for segment in self._segments:
+            try:
+                segment.close()
+            except OSError as e:
+                decky.logger.error("[scrollback][ERROR] Unable to close segment %s: %s", segment.path, e)
+
+        self._segments = []
+        if remove:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    # WRITE =================================================
+    def append(self, data: bytes):
+        if len(self._segments) == 0 or len(data) == 0:
+            return
+
+        # page cache writes are cheap enough to do inline, an executor
+        # round trip per chunk would cost more than the write itself.
+        segment = self._segments[-1]
+        written = os.write(segment.fd, data)
+        segment.size += written
+        self._end += written
+
+        if segment.size >= self.segment_size:
+            self._new_segment()
+        self._evict()
+
+    def _new_segment(self):
+        path = os.path.join(self.path, f"{self._end:016x}.log")
+        self._segments.append(_Segment(self._end, path))
+
+    def _evict(self):
+        while len(self._segments) > 1 and self._end - self._segments[0].start > self.max_size:
+            segment = self._segments.pop(0)
+            segment.close()
+            try:
+                os.unlink(segment.path)
+            except OSError:
+                pass
+
+    # READ ==================================================
+    def read(self, offset: int, length: int) -> bytes:
+        offset = max(offset, self.start)
+        end = min(offset + max(length, 0), self._end)
+
+        output = []
+        for segment in self._segments:
+            if segment.end <= offset or segment.size == 0:
+                continue
+            if segment.start >= end:
+                break
+
+            begin = max(offset, segment.start) - segment.start
+            finish = min(end, segment.end) - segment.start
+            output.append(segment.read(begin, finish - begin))
+
+        return b"".join(output)
@@ -0,0 +1,144 @@
+import collections
+import time
+from typing import Dict, List, Optional
+
+
+# Power of two buckets: recording is a bit_length() and an increment,
+# cheap enough to stay enabled on every read.
+class Histogram:
+    buckets: int = 32
+
+    count: int = 0
+    total: int = 0
+    max: int = 0
+
+    _counts: List[int] = None
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._counts = [0] * self.buckets
+
+    def record(self, value: int):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self._counts[min(value.bit_length(), self.buckets - 1)] += 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for index, count in enumerate(other._counts):
+            self._counts[index] += count
+
+    def percentile(self, fraction: float) -> int:
+        # upper bound of the bucket the percentile falls into
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count > 0 and seen >= target:
+                return min((1 << index) - 1, self.max)
+        return self.max
+
+    def serialize(self) -> dict:
+        return dict(
+            count=self.count,
+            sum=self.total,
+            max=self.max,
+            mean=self.total / self.count if self.count > 0 else 0,
+            p50=self.percentile(0.5),
+            p99=self.percentile(0.99),
+            # bucket upper bound (inclusive) -> count, empty buckets left out
+            buckets={str((1 << index) - 1): count for index, count in enumerate(self._counts) if count > 0},
+        )
+
+
+class TerminalStats:
+    bytes_read: int = 0
+    bytes_written: int = 0
+    dropped_input: int = 0
+    emits: int = 0
+    snapshots: int = 0
+
+    read_sizes: Histogram = None
+    batch_sizes: Histogram = None
+    emit_sizes: Histogram = None
+    # microseconds from os.read to the first emit carrying the data
+    emit_latency: Histogram = None
+
+    _max_unemitted: int = 1024
+    _unemitted: collections.deque = None
+
+    def __init__(self):
+        self.read_sizes = Histogram()
+        self.batch_sizes = Histogram()
+        self.emit_sizes = Histogram()
+        self.emit_latency = Histogram()
+        self._unemitted = collections.deque(maxlen=self._max_unemitted)
+
+    @property
+    def reads(self) -> int:
+        return self.read_sizes.count
+
+    # RECORDING =============================================
+    def record_read(self, size: int, seq: int):
+        self.bytes_read += size
+        self.read_sizes.record(size)
+        self._unemitted.append((seq, time.monotonic()))
+
+    def record_write(self, size: int):
+        self.bytes_written += size
+
+    def record_batch(self, size: int):
+        self.batch_sizes.record(size)
+
+    def record_dropped_input(self, size: int):
+        self.dropped_input += size
+
+    def record_emit(self, size: int, seq: int, snapshot: bool = False):
+        self.emits += 1
+        self.emit_sizes.record(size)
+        if snapshot:
+            self.snapshots += 1
+
+        now = time.monotonic()
+        while len(self._unemitted) > 0 and self._unemitted[0][0] <= seq:
+            _, read_time = self._unemitted.popleft()
+            # a snapshot covers reads nobody was waiting for, they'd only skew the latency
+            if not snapshot:
+                self.emit_latency.record(int((now - read_time) * 1000000))
+
+    # AGGREGATION ===========================================
+    def merge(self, other: "TerminalStats"):
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.dropped_input += other.dropped_input
+        self.emits += other.emits
+        self.snapshots += other.snapshots
+        self.read_sizes.merge(other.read_sizes)
+        self.batch_sizes.merge(other.batch_sizes)
+        self.emit_sizes.merge(other.emit_sizes)
+        self.emit_latency.merge(other.emit_latency)
+
+    def serialize(self, occupancy: Optional[Dict[str, int]] = None) -> dict:
+        data = dict(
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            reads=self.reads,
+            read_sizes=self.read_sizes.serialize(),
+            batch_sizes=self.batch_sizes.serialize(),
+            emits=self.emits,
+            emit_sizes=self.emit_sizes.serialize(),
+            emit_latency_us=self.emit_latency.serialize(),
+            snapshots=self.snapshots,
+            dropped_input=self.dropped_input,
+        )
+
+        if occupancy is not None:
+            data["occupancy"] = occupancy
+
+        return data
@@ -0,0 +1,142 @@
+import asyncio
+import codecs
+import collections
+from typing import Callable, Optional, Tuple
+
+import decky
+
+from .stats import TerminalStats
+
+# a chunk as the terminal decoded it once for everybody: the decoder state it started
+# from, the text and the state it ended in
+Decoded = Tuple[Tuple[bytes, int], str, Tuple[bytes, int]]
+
+
+class Subscriber:
+    handle: str = ""
+    event: str = ""
+    epoch: str = ""
+    encoding: str = "utf-8"
+
+    # sequence number up to which output has been delivered. emits are tagged with the
+    # position of the last complete character, which can trail it by a split character.
+    cursor: int = 0
+
+    # set when the subscriber fell too far behind, it gets a snapshot instead of the backlog
+    snapshot_pending: bool = False
+
+    max_queue_size: int = 1024 * 1024
+
+    _queue: collections.deque = None
+    _queue_size: int = 0
+    _wakeup: asyncio.Event = None
+    _task: asyncio.Future = None
+
+    def __init__(
+        self,
+        handle: str,
+        event: str,
+        cursor: int,
+        snapshot: Callable[[], Tuple[bytes, int]],
+        epoch: str = "",
+        encoding: str = "utf-8",
+        max_queue_size: int = None,
+        on_drain: Optional[Callable[[], None]] = None,
+        stats: Optional[TerminalStats] = None,
+    ):
+        self.handle = handle
+        self.event = event
+        self.cursor = cursor
+        self.epoch = epoch
+        self.encoding = encoding
+        if max_queue_size is not None:
+            self.max_queue_size = max_queue_size
+
+        self._snapshot = snapshot
+        self._on_drain = on_drain
+        self._stats = stats
+        self._queue = collections.deque()
+        self._queue_size = 0
+        # a multibyte character can be split across reads, only decode it once it's complete
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._deliver())
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue_size
+
+    @property
+    def is_saturated(self) -> bool:
+        return self._queue_size >= self.max_queue_size // 2
+
+    def push(self, data: bytes, seq: int, decoded: Optional[Decoded] = None):
+        if self.snapshot_pending:
+            # the snapshot will cover this as well
+            return
+
+        if self._queue_size + len(data) > self.max_queue_size:
+            decky.logger.info("[terminal][INFO][%s] Subscriber fell behind, switching to snapshot.", self.event)
+            self.request_snapshot()
+            return
+
+        self._queue.append((data, seq, decoded))
+        self._queue_size += len(data)
+        self._wakeup.set()
+
+    def request_snapshot(self):
+        self._queue.clear()
+        self._queue_size = 0
+        self.snapshot_pending = True
+        self._wakeup.set()
+
+    def close(self):
+        self._queue.clear()
+        self._queue_size = 0
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _deliver(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self.snapshot_pending or len(self._queue) > 0:
+                snapshot = self.snapshot_pending
+                decoded = None
+                if snapshot:
+                    self.snapshot_pending = False
+                    self._decoder.reset()
+                    data, seq = self._snapshot()
+                else:
+                    data, seq, decoded = self._queue.popleft()
+                    self._queue_size -= len(data)
+
+                    # skip what an earlier snapshot already covered
+                    start = seq - len(data)
+                    if seq <= self.cursor:
+                        continue
+                    if start < self.cursor:
+                        data = data[self.cursor - start:]
+                        decoded = None
+
+                if decoded is not None and decoded[0] == self._decoder.getstate():
+                    # in step with the terminal's decoder, its text is what we'd get
+                    text = decoded[1]
+                    self._decoder.setstate(decoded[2])
+                else:
+                    text = self._decoder.decode(data)
+                self.cursor = seq
+                if not text and not snapshot:
+                    continue
+
+                try:
+                    await decky.emit(self.event, text, seq - len(self._decoder.getstate()[0]), self.epoch)
+                    if self._stats is not None:
+                        self._stats.record_emit(len(data), seq, snapshot)
+                except Exception as e:
+                    decky.logger.exception("[terminal][EXCEPTION][%s] Exception during delivery: %s", self.event, e)
+
+            if self._on_drain is not None:
+                self._on_drain()
@@ -1,15 +1,41 @@
 import asyncio
-import collections
+import codecs
 import os
 import pty
-import signal
+import re
 import struct
 import termios
+import time
 import decky
 import uuid
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
+from .batcher import OutputBatcher
 from .common import Common
+from .hibernation import Hibernation
+from .holder import HeldProcess, HolderClient
+from .lineindex import LineIndex
+from .recorder import Recorder
+from .ringbuffer import RingBuffer
+from .scanner import EscapeScanner, ScanResult
+from .screen import Screen
+from .scrollback import ScrollbackStore
+from .stats import TerminalStats
+from .subscriber import Subscriber
+
+def _incomplete_tail(data, start: int = 0) -> int:
+    # number of bytes at the end of data that are an unfinished UTF-8 sequence
+    for i in range(1, min(4, len(data) - start) + 1):
+        byte = data[-i]
+        if (byte & 0xC0) == 0xC0:
+            # lead byte: keep it only if its sequence is complete
+            needed = 4 if byte >= 0xF0 else 3 if byte >= 0xE0 else 2
+            return i if needed > i else 0
+        if (byte & 0x80) == 0:
+            break
+
+    return 0
+
 
 class Terminal:
     id: str = str(uuid.uuid4())
@@ -23,31 +49,128 @@ class Terminal:
     master_fd: int
     slave_fd: int
 
-    buffer: collections.deque = None
-    stdin_buffer: collections.deque = None
+    # with a holder the process lives in the holder daemon and survives a plugin reload,
+    # we only get its pty master passed over
+    holder: Optional[HolderClient] = None
+    held: bool = False
+
+    buffer: RingBuffer = None
+    # the screen model is only brought up to date when something needs it (snapshots,
+    # resizes, hibernation), until then the output just sits in the ring buffer.
+    # _screen_seq is the output_seq it has been fed up to.
+    screen: Screen = None
+    _screen_seq: int = 0
+    scrollback: Optional[ScrollbackStore] = None
+    line_index: Optional[LineIndex] = None
+    recorder: Optional[Recorder] = None
 
     cols: int = 80
     rows: int = 24
 
     flags: dict = dict()
-    is_subscribed: bool = False
+    subscribers: Dict[str, Subscriber] = None
+
+    _title: str = ""
+    alt_screen: bool = False
+    bracketed_paste: bool = False
+
+    # bumped by the owner whenever something serialize() reports has changed
+    version: int = 0
+    on_change: Optional[Callable[["Terminal"], None]] = None
 
-    title: str = ""
-    _title_cache: bytes = b""
+    # last input, subscription change or wakeup, what the hibernation policy looks at
+    last_activity: float = 0.0
+    # when a view last subscribed or went away, the memory budget evicts the oldest first
+    last_subscribed: float = 0.0
+    # last read from the process, a busy session would only wake up again right away
+    last_output: float = 0.0
+    _hibernation: Optional[Hibernation] = None
+
+    # total bytes read from the process, every emitted chunk is tagged with it.
+    # it starts over with every instance (plugin reload, holder reattach), the epoch
+    # tells those apart so a last_seq from before never resumes at the wrong bytes
+    output_seq: int = 0
+    epoch: str = ""
+    _emitted_seq: int = 0
+    _scanner: EscapeScanner = None
+    # decodes every broadcast chunk once, the subscribers share the text
+    _output_decoder: codecs.IncrementalDecoder = None
 
     _optimize_clears: bool = True
-    _baud_rate: int = 38400
+    _scrollback_size: int = 262144
+    _scrollback_lines: int = 1000
+    _max_range_size: int = 1024 * 1024
+    _max_search_results: int = 1000
+
+    # rough python object overhead for the memory estimate: a screen cell is a slot in
+    # the chars and the attrs list, an indexed line a str object
+    _screen_cell_size: int = 16
+    _line_overhead: int = 49
+
+    _output_reader_registered: bool = False
+    _output_closed: bool = False
+    # read output waiting for the broadcast loop, handed over to the subscribers as is
+    _output_pending: bytearray = None
+    _output_batcher: OutputBatcher = None
+    _output_event: asyncio.Event = None
+    _max_read_per_wakeup: int = 65536
+
+    # every read lands in the same buffer, the stages after it only get views
+    _read_buffer: bytearray = None
+    _read_view: memoryview = None
+    _read_buffer_size: int = 65536
+
+    # flow control: stop reading (and let the kernel block the producer) when
+    # the output budget is spent or nobody downstream keeps up.
+    throttled: Optional[str] = None
+    _output_budget: int = 4 * 1024 * 1024
+    _output_budget_interval: float = 0.1
+    _output_budget_tokens: float = 0.0
+    _output_budget_updated: float = 0.0
+    _output_high_water: int = 1024 * 1024
+    _throttle_timer: asyncio.TimerHandle = None
+
+    _nonblocking_io: bool = False
+    _stdin_pending: bytearray = None
+    _stdin_writer_registered: bool = False
+    _stdin_drained: asyncio.Event = None
+    _stdin_lock: asyncio.Lock = None
+    _stdin_high_water: int = 65536
+
+    _paste_chunk_size: int = 1024
+    _paste_progress_interval: float = 0.1
+
+    # resize requests settle for this long before the last one is applied,
+    # a continuous stream of them still gets through every _max_resize_delay
+    _resize_delay: float = 0.05
+    _max_resize_delay: float = 0.25
+    _resize_timer: asyncio.TimerHandle = None
+    _resize_requested: float = 0.0
+    _requested_size: Optional[Tuple[int, int]] = None
 
     def __init__(self, id: str, cmdline: str, is_shell: bool = True, **kwargs):
         self.id = id
         self.cmdline = cmdline  # TODO: maybe raise ValueError? cmdline can't meaningfully be None or undefined since it must be available for _start_process
 
         self.is_shell = is_shell
-        self.buffer = collections.deque([], maxlen=self._baud_rate)
-        self.stdin_buffer = collections.deque([], maxlen=self._baud_rate)
-        self.is_subscribed = False
+        self.epoch = uuid.uuid4().hex
+        self.last_activity = time.monotonic()
+        self.last_subscribed = self.last_activity
+        self._stdin_pending = bytearray()
+        self.subscribers = dict()
 
         self.flags = kwargs
+        self.stats = TerminalStats()
+        self._output_budget = self.flags.get("output_budget", self._output_budget)
+        self._scanner = EscapeScanner(self.encoding)
+        self._output_decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        self.buffer = RingBuffer(self.flags.get("scrollback_size", self._scrollback_size))
+        if self.flags.get("screen_snapshot", True):
+            self.screen = self._new_screen()
+        search_lines = self.flags.get("search_lines", LineIndex.max_lines)
+        if search_lines > 0:
+            self.line_index = LineIndex(search_lines, self.encoding)
+        self._output_batcher = OutputBatcher(**self.flags.get("output_batching", dict()))
         decky.logger.info("[terminal][INFO][%s] New terminal instance created.", self.id)
 
     def _calculate_sync_size(self):
@@ -59,14 +182,281 @@ class Terminal:
         
     # INPUT HANDLER ========================================
     async def send_input(self, data: str):
-        self.stdin_buffer.append(bytes(data, self.encoding))
+        # waits when the process is not consuming its input fast enough,
+        # so the caller gets backpressure instead of silently losing input.
+        await self._write_stdin(bytes(data, self.encoding))
         
+    def configure_output_batching(self, **kwargs):
+        self._output_batcher.configure(**kwargs)
+
+    @property
+    def title(self) -> str:
+        return self._title
+
+    @title.setter
+    def title(self, title: str):
+        if title != self._title:
+            self._title = title
+            self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    # HIBERNATION ==========================================
+    @property
+    def hibernated(self) -> bool:
+        return self._hibernation is not None
+
+    def hibernate(self) -> bool:
+        if self._hibernation is not None or self.is_subscribed:
+            return False
+
+        screen = None
+        if self._update_screen() is not None:
+            # the serialized screen rebuilds an identical model when fed back in,
+            # what it couldn't apply yet has to go along
+            screen = self.screen.serialize().encode(self.encoding) + self.screen.pending_bytes()
+
+        hibernation = Hibernation(self.buffer.snapshot(), screen, self.alt_screen, encoding=self.encoding)
+        size = hibernation.size
+        if self.line_index is not None:
+            # a search expands a copy of it, the session stays asleep
+            self.line_index.compress(hibernation.level)
+            size += self.line_index.compressed_size
+        decky.logger.info("[terminal][INFO][%s] Hibernating, buffers compressed to %d bytes.", self.id, size)
+        self._hibernation = hibernation
+        self.buffer = None
+        self.screen = None
+        self._changed()
+        return True
+
+    def _thaw(self):
+        hibernation = self._hibernation
+        if hibernation is None:
+            return
+
+        self._hibernation = None
+        self.buffer = RingBuffer(self.flags.get("scrollback_size", self._scrollback_size))
+        self.buffer.append(hibernation.restore_buffer())
+
+        screen = hibernation.restore_screen()
+        if screen is not None:
+            self.screen = self._new_screen()
+            self.screen.feed(screen)
+            # the tail below is fed to it the next time it is needed
+            self._screen_seq = self.output_seq - hibernation.tail_size
+
+        # replay what was printed while asleep as if it was read just now,
+        # it's already counted in output_seq. the line index looks at alt_screen as it was then
+        if self.line_index is not None:
+            self.line_index.decompress()
+        self.alt_screen = hibernation.alt_screen
+        end = self.output_seq
+        self.output_seq -= hibernation.tail_size
+        try:
+            for chunk in hibernation.tail:
+                self.output_seq += len(chunk)
+                self._store_output(chunk)
+        finally:
+            self.output_seq = end
+
+        decky.logger.info("[terminal][INFO][%s] Woke up from hibernation.", self.id)
+        self.last_activity = time.monotonic()
+        self._changed()
+
+    # MEMORY ===============================================
+    def memory_usage(self) -> dict:
+        # estimate in bytes of what this session holds in memory, the disk scrollback not included
+        usage = dict(
+            buffer=self.buffer.capacity if self.buffer is not None else 0,
+            screen=0,
+            search=0,
+            hibernated=self._hibernation.size if self._hibernation is not None else 0,
+            queues=len(self._stdin_pending) + sum(subscriber.queue_size for subscriber in self.subscribers.values()),
+        )
+        if self._output_pending is not None:
+            usage["queues"] += len(self._output_pending)
+        if self.screen is not None:
+            lines = self.screen.rows * (2 if self.screen.alt_screen else 1) + len(self.screen.scrollback)
+            usage["screen"] = lines * self.screen.cols * self._screen_cell_size
+        if self.line_index is not None and self.line_index.is_compressed:
+            usage["search"] = self.line_index.compressed_size
+        elif self.line_index is not None:
+            usage["search"] = self.line_index.size + self.line_index.count * self._line_overhead
+
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def drop_history(self):
+        # frees the history kept for scrolling and searching, what is on screen stays.
+        # the raw output is only dropped when the screen model can stand in for it in snapshots
+        if self.line_index is not None:
+            self.line_index.clear()
+
+        if self._hibernation is not None:
+            self._hibernation.drop_buffer()
+        elif self._update_screen() is not None:
+            self.screen.scrollback.clear()
+            self.buffer.clear()
+
+    # HISTORY ==============================================
+    def get_buffer_range(self, offset: int, length: int) -> dict:
+        self._thaw()
+        length = max(0, min(length, self._max_range_size))
+
+        if self.scrollback is not None:
+            start, end = self.scrollback.start, self.scrollback.end
+            data = self.scrollback.read(offset, length)
+            offset = max(offset, start)
+        else:
+            start, end = 0, len(self.buffer)
+            offset = max(0, offset)
+            data = self.buffer.snapshot(offset, length)
+
+        # don't hand out split multibyte characters, the next page picks them up
+        skip = 0
+        while skip < min(3, len(data)) and (data[skip] & 0xC0) == 0x80:
+            skip += 1
+
+        cut = len(data) - _incomplete_tail(data, skip)
+
+        return dict(
+            epoch=self.epoch,
+            start=start,
+            end=end,
+            offset=offset + skip,
+            length=max(0, cut - skip),
+            data=data[skip:cut].decode(self.encoding, errors="replace"),
+        )
+
+    def resume(self, last_seq: int, epoch: Optional[str] = None) -> dict:
+        # bytes the client has not seen yet, as long as we still have them.
+        # a seq from another epoch counts for nothing, it gets a snapshot
+        self._thaw()
+        end = self._emitted_seq
+        data = None
+        if epoch == self.epoch and 0 <= last_seq <= end:
+            buffer_start = self.output_seq - len(self.buffer)
+            if last_seq >= buffer_start:
+                data = self.buffer.snapshot(last_seq - buffer_start, end - last_seq)
+            elif self.scrollback is not None and last_seq >= self.scrollback.start:
+                data = self.scrollback.read(last_seq, end - last_seq)
+
+        snapshot = data is None
+        if snapshot:
+            data, end = self._snapshot()
+
+        # a split character at the end is left for the next emit, seq says where that starts
+        cut = _incomplete_tail(data)
+        return dict(
+            epoch=self.epoch,
+            seq=end - cut,
+            snapshot=snapshot,
+            data=data[:len(data) - cut].decode(self.encoding, errors="replace"),
+        )
+
+    async def search(self, pattern: str, regex: bool = False, limit: int = 100, ignore_case: bool = False) -> Optional[dict]:
+        if self.line_index is None:
+            return None
+
+        try:
+            compiled = re.compile(pattern if regex else re.escape(pattern), re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            return dict(error=f"invalid pattern: {e}")
+
+        # the pattern runs in the executor on a copy, output keeps coming in meanwhile.
+        # a hibernated session stays asleep, what piled up since only goes into the copy
+        index = self.line_index.snapshot()
+        tail = self._hibernation.indexed_tail() if self._hibernation is not None else []
+        return await Common._run_async(self._search_index, index, tail, compiled, max(1, min(limit, self._max_search_results)))
+
+    @staticmethod
+    def _search_index(index: LineIndex, tail: List[bytes], pattern: "re.Pattern", limit: int) -> dict:
+        for chunk in tail:
+            index.feed(chunk)
+        return index.search(pattern, limit)
+
+    async def paste(self, data: str, paste_id: Optional[str] = None) -> bool:
+        payload = bytes(data, self.encoding)
+        if self.bracketed_paste:
+            # the payload must not be able to end the paste early
+            payload = b"\x1b[200~" + payload.replace(b"\x1b[201~", b"") + b"\x1b[201~"
+
+        total = len(payload)
+        written = 0
+        last_progress = time.monotonic()
+        view = memoryview(payload)
+
+        # small chunks, each one only after the previous one went through the tty,
+        # so the line discipline is never flooded and nothing gets lost.
+        while written < total:
+            if not self._is_process_alive():
+                await self._emit_paste_progress(paste_id, written, total, False)
+                return False
+
+            chunk = view[written:written + self._paste_chunk_size]
+            await self._write_stdin(bytes(chunk))
+            await self._drain_stdin()
+            written += len(chunk)
+
+            now = time.monotonic()
+            if now - last_progress >= self._paste_progress_interval and written < total:
+                last_progress = now
+                await self._emit_paste_progress(paste_id, written, total, False)
+
+        await self._emit_paste_progress(paste_id, written, total, True)
+        return True
+
+    async def _emit_paste_progress(self, paste_id: Optional[str], written: int, total: int, done: bool):
+        await decky.emit("terminal_paste#" + self.id, paste_id, written, total, done)
+
     # SUBSCRIPTION =========================================
-    def subscribe(self):
-        self.is_subscribed = True
+    # Every view of the terminal subscribes with its own handle and gets its own
+    # event, delivery cursor and queue. The legacy handle "" uses the plain event name.
+    @property
+    def is_subscribed(self) -> bool:
+        return len(self.subscribers) > 0
+
+    def subscribe(self, handle: Optional[str] = None) -> str:
+        if handle is None:
+            handle = ""
+
+        self._thaw()
+        self.last_activity = time.monotonic()
+        self.last_subscribed = self.last_activity
+        if handle not in self.subscribers:
+            event = "terminal_output#" + self.id
+            if handle:
+                event += "#" + handle
 
-    def unsubscribe(self):
-        self.is_subscribed = False
+            self.subscribers[handle] = Subscriber(
+                handle,
+                event,
+                self._emitted_seq,
+                self._snapshot,
+                epoch=self.epoch,
+                encoding=self.encoding,
+                max_queue_size=self.flags.get("subscriber_queue_size"),
+                on_drain=self._update_throttle,
+                stats=self.stats,
+            )
+            self._changed()
+
+        return handle
+
+    def unsubscribe(self, handle: Optional[str] = None):
+        subscriber = self.subscribers.pop(handle or "", None)
+        if subscriber is not None:
+            self.last_activity = time.monotonic()
+            self.last_subscribed = self.last_activity
+            subscriber.close()
+            self._changed()
+
+    def _unsubscribe_all(self):
+        for subscriber in self.subscribers.values():
+            subscriber.close()
+        self.subscribers = dict()
 
     # SERIALIZE ============================================
     def serialize(self) -> dict:
@@ -85,58 +475,206 @@ class Terminal:
         if self.title is not None and self.title.strip():
             data["title"] = self.title
 
+        data["alt_screen"] = self.alt_screen
+        data["epoch"] = self.epoch
+        data["seq"] = self.output_seq
+        data["subscribers"] = len(self.subscribers)
+        data["throttled"] = self.throttled
+        data["hibernated"] = self.hibernated
+        data["recording"] = self.recorder is not None
+
         return data
 
+    def get_stats(self) -> dict:
+        occupancy = dict(
+            pending_output=len(self._output_pending) if self._output_pending is not None else 0,
+            pending_input=len(self._stdin_pending),
+            subscriber_queues=sum(subscriber.queue_size for subscriber in self.subscribers.values()),
+        )
+        if self.buffer is not None:
+            occupancy["buffer"] = len(self.buffer)
+            occupancy["buffer_capacity"] = self.buffer.capacity
+        if self.screen is not None:
+            occupancy["screen_scrollback_lines"] = len(self.screen.scrollback)
+        if self._hibernation is not None:
+            occupancy["buffer"] = self._hibernation.buffer_size
+            occupancy["hibernated_size"] = self._hibernation.size
+        if self.scrollback is not None:
+            occupancy["disk_scrollback"] = self.scrollback.end - self.scrollback.start
+        occupancy["memory"] = self.memory_usage()["total"]
+
+        return self.stats.serialize(occupancy)
+
     # CONTROL ==============================================
     async def start(self):
         decky.logger.info("[terminal][INFO][%s] Starting shell.", self.id)
+        self._open_scrollback()
         await self._start_process()
 
+    def adopt(self, id: str, rows: Optional[int] = None, cols: Optional[int] = None):
+        # hand a pre-spawned session over to its real owner, at the size its view has
+        decky.logger.info("[terminal][INFO][%s] Adopted pre-spawned session as %s.", self.id, id)
+        if self.held and self.holder.connected:
+            asyncio.ensure_future(self.holder.rename(self.id, id))
+        self.id = id
+        if rows is not None and cols is not None and (rows, cols) != (self.rows, self.cols):
+            self._change_pty_size(rows, cols)
+
+    async def reattach(self, master_fd: int, process: HeldProcess, buffer: bytes, title: str = ""):
+        # pick a session up again that the holder kept running while the plugin was gone
+        decky.logger.info("[terminal][INFO][%s] Reattaching to held session (pid %d).", self.id, process.pid)
+        self.master_fd = master_fd
+        self.slave_fd = None
+        self.process = process
+        self.held = True
+        self._open_scrollback()
+
+        try:
+            import fcntl
+            rows, cols, _, _ = struct.unpack("HHHH", fcntl.ioctl(master_fd, termios.TIOCGWINSZ, b"\0" * 8))
+            if rows > 0 and cols > 0:
+                self.rows, self.cols = rows, cols
+                if self._update_screen() is not None:
+                    self.screen.resize(rows, cols)
+        except OSError:
+            pass
+
+        # the screen as we left it plus whatever came in since
+        self._put_buffer(buffer)
+        self._emitted_seq = self.output_seq
+        if title:
+            self.title = title
+
+        self._changed()
+        if not self._start_output_reader():
+            asyncio.ensure_future(self._read_output_loop())
+        asyncio.ensure_future(self._watch_process())
+
+    async def detach(self) -> bool:
+        # leave the process to the holder, it keeps reading until someone reattaches
+        if not self.held or not self.holder.connected:
+            return False
+
+        self._stop_output_reader()
+        self._stop_input_writer()
+        data, _ = self._snapshot()
+        try:
+            await self.holder.detach(self.id, data, self.title)
+        except (ConnectionError, RuntimeError) as e:
+            decky.logger.error("[terminal][ERROR][%s] Unable to detach from holder: %s", self.id, e)
+            return False
+
+        self._unsubscribe_all()
+        self._close_pty()
+        self.held = False
+        return True
+
     async def shutdown(self):
+        if self._resize_timer is not None:
+            self._resize_timer.cancel()
+            self._resize_timer = None
         self._kill_process()
+        self._unsubscribe_all()
+        self._hibernation = None
+        if self.recorder is not None:
+            await self.stop_recording()
+
+        if self.held:
+            self.held = False
+            try:
+                await self.holder.close_session(self.id)
+            except (ConnectionError, RuntimeError) as e:
+                decky.logger.error("[terminal][ERROR][%s] Unable to release held session: %s", self.id, e)
+
+        if self.scrollback is not None:
+            self.scrollback.close()
+            self.scrollback = None
+
+    # RECORDING ============================================
+    def start_recording(self, record_input: bool = False) -> bool:
+        if self.recorder is not None:
+            return False
+
+        self.recorder = Recorder(
+            os.path.join(decky.DECKY_PLUGIN_LOG_DIR, "recordings", Common.escape_filename(self.id)),
+            self.cols,
+            self.rows,
+            record_input,
+            env=dict(TERM="xterm-256color", SHELL=self.cmdline),
+            **self.flags.get("recording", dict()),
+        )
+        # the recording starts out with what is on screen right now
+        self.recorder.record_output(self._snapshot()[0])
+        decky.logger.info("[terminal][INFO][%s] Recording started.", self.id)
+        self._changed()
+        return True
+
+    async def stop_recording(self) -> Optional[List[str]]:
+        recorder = self.recorder
+        if recorder is None:
+            return None
+
+        self.recorder = None
+        self._changed()
+        files = await recorder.stop()
+        decky.logger.info("[terminal][INFO][%s] Recording stopped, files: %s", self.id, files)
+        return files
+
+    def _open_scrollback(self):
+        if not self.flags.get("disk_scrollback"):
+            return
+
+        store = ScrollbackStore(
+            os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "scrollback", Common.escape_filename(self.id)),
+            max_size=self.flags.get("disk_scrollback_size"),
+        )
+        try:
+            store.open()
+            self.scrollback = store
+        except OSError as e:
+            decky.logger.error("[terminal][ERROR][%s] Unable to open disk scrollback, keeping it in memory: %s", self.id, e)
 
     async def change_window_size(self, rows: int, cols: int):
-        if self._is_process_alive():
-            await self._change_pty_size(rows, cols)
-            await self.process.send_signal(signal.SIGWINCH)
-            await self._write_stdin(f"\x1b[8;{rows};{cols}t".encode(self.encoding))
+        # layout passes send bursts of these, only the size they settle on is applied
+        now = time.monotonic()
+        if self._resize_timer is None:
+            self._resize_requested = now
+        else:
+            self._resize_timer.cancel()
+
+        self._requested_size = (rows, cols)
+        delay = max(0, min(self._resize_delay, self._resize_requested + self._max_resize_delay - now))
+        self._resize_timer = asyncio.get_event_loop().call_later(delay, self._apply_window_size)
 
-    async def _change_pty_size(self, rows: int, cols: int):
+    def _apply_window_size(self):
+        self._resize_timer = None
+        rows, cols = self._requested_size
+        if not self._is_process_alive() or (rows, cols) == (self.rows, self.cols):
+            return
+
+        # the compressed screen was serialized for the old size
+        self._thaw()
+        self._change_pty_size(rows, cols)
+        if self.recorder is not None:
+            self.recorder.record_resize(rows, cols)
+
+    def _change_pty_size(self, rows: int, cols: int):
         self.rows = rows
         self.cols = cols
+        if self._update_screen() is not None:
+            self.screen.resize(rows, cols)
 
+        # master and slave share the window size, and the kernel sends SIGWINCH
+        # to the foreground process group when it changes
         try:
             import fcntl
             if self.master_fd is not None:
                 new_size = struct.pack("HHHH", rows, cols, 0, 0)
-                await Common._run_async(
-                    fcntl.ioctl, self.master_fd, termios.TIOCSWINSZ, new_size
-                )
-
-            if self.slave_fd is not None:
-                new_size = struct.pack("HHHH", rows, cols, 0, 0)
-                await Common._run_async(
-                    fcntl.ioctl, self.slave_fd, termios.TIOCSWINSZ, new_size
-                )
+                fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, new_size)
         except Exception as e:
             # Windows? Maybe not a tty?
             pass
 
-    # WORKERS ==============================================
-    async def _process_subscriber(self):
-        while self._is_process_alive():
-            while len(self.stdin_buffer) > 0:
-                try:
-                    # pop the buffers and flush into the process
-                    await self._write_stdin(self.stdin_buffer.popleft())
-                except Exception as e:
-                    decky.logger.exception("[terminal][EXCEPTION][%s] Exception during process subscriber: %s", self.id, e)
-            
-            try:
-                await asyncio.sleep(0.01)
-            except:
-                pass
-
     # PROCESS CONTROL =======================================
     def get_terminal_env(self):
         result = dict(os.environ)
@@ -180,37 +718,142 @@ class Terminal:
     async def _start_process(self):
         self.master_fd, self.slave_fd = pty.openpty()
 
-        await self._change_pty_size(self.rows, self.cols)
-        self.process = await asyncio.create_subprocess_exec(
-            self.cmdline,
-            preexec_fn=self._handle_preexec_fn,
-            stdout=self.slave_fd,
-            stderr=self.slave_fd,
-            stdin=self.slave_fd,
-            env=self.get_terminal_env(),
-            cwd=os.getenv("HOME"),
-        )
+        self._change_pty_size(self.rows, self.cols)
+        if self.holder is not None and self.holder.connected:
+            try:
+                self.process = await self.holder.spawn(
+                    self.id,
+                    [self.cmdline],
+                    self.get_terminal_env(),
+                    os.getenv("HOME"),
+                    self.master_fd,
+                    self.slave_fd,
+                    self.flags.get("scrollback_size", self._scrollback_size),
+                )
+                self.held = True
+            except (ConnectionError, RuntimeError) as e:
+                decky.logger.error("[terminal][ERROR][%s] Holder unable to spawn, starting locally: %s", self.id, e)
+
+        if self.process is None:
+            self.process = await asyncio.create_subprocess_exec(
+                self.cmdline,
+                preexec_fn=self._handle_preexec_fn,
+                stdout=self.slave_fd,
+                stderr=self.slave_fd,
+                stdin=self.slave_fd,
+                env=self.get_terminal_env(),
+                cwd=os.getenv("HOME"),
+            )
+
+        self._changed()
+        if not self._start_output_reader():
+            asyncio.ensure_future(self._read_output_loop())
+        asyncio.ensure_future(self._watch_process())
 
-        asyncio.ensure_future(self._read_output_loop())
-        asyncio.ensure_future(self._process_subscriber())
+    async def _watch_process(self):
+        await self.process.wait()
+        self._changed()
+
+        # collect whatever the process wrote right before exiting
+        if self._output_reader_registered:
+            self._on_output_ready()
+            self._stop_output_reader()
+        self._stop_input_writer()
 
     def _kill_process(self):
         if self._is_process_alive():
             self.process.kill()
 
+        self._stop_output_reader()
+        self._stop_input_writer()
+        self._close_pty()
+
+    def _close_pty(self):
         try:
             os.close(self.master_fd)
-            os.close(self.slave_fd)
+            # a reattached session only got the master back
+            if self.slave_fd is not None:
+                os.close(self.slave_fd)
         except Exception as e:
             decky.logger.exception("[terminal][EXCEPTION][%s] Exception during kill process: %s", self.id, e)
 
     # BROADCAST =============================================
-    async def broadcast_subscribers(self, data: bytes):
-        if self.is_subscribed:
-            await decky.emit("terminal_output#"+self.id, data.decode())
+    async def broadcast_subscribers(self, data: bytes, seq: Optional[int] = None):
+        if seq is None:
+            seq = self.output_seq
+
+        if len(self.subscribers) == 0:
+            return
+
+        # decoded once for all of them. a subscriber whose own decoder is in a different
+        # state (e.g. after a snapshot) decodes the chunk itself instead
+        state = self._output_decoder.getstate()
+        decoded = (state, self._output_decoder.decode(data), self._output_decoder.getstate())
+
+        # never waits on delivery: slow subscribers queue up or fall back to a snapshot
+        for subscriber in self.subscribers.values():
+            subscriber.push(data, seq, decoded)
 
-    async def send_current_buffer(self):
-        await self.broadcast_subscribers(bytes(self.buffer))
+    async def send_current_buffer(self, handle: Optional[str] = None):
+        subscriber = self.subscribers.get(handle or "")
+        if subscriber is not None:
+            subscriber.request_snapshot()
+
+    def _snapshot(self) -> Tuple[bytes, int]:
+        data = self._current_buffer()
+        if self._update_screen() is not None:
+            # the model is behind by what it couldn't apply yet, append it so the snapshot
+            # ends exactly at output_seq and the next chunk continues seamlessly
+            data += self.screen.pending_bytes()
+
+        return data, self.output_seq
+
+    def _current_buffer(self) -> bytes:
+        self._thaw()
+        if self._update_screen() is not None:
+            # the screen model bounds the replay by screen size + scrollback lines,
+            # no matter how much has been printed (or redrawn) so far.
+            return self.screen.serialize().encode(self.encoding)
+
+        return self.buffer.snapshot()
+
+    # SCREEN MODEL ==========================================
+    def _new_screen(self) -> Screen:
+        return Screen(self.rows, self.cols, self.flags.get("scrollback_lines", self._scrollback_lines))
+
+    def _update_screen(self) -> Optional[Screen]:
+        # feed the model what it hasn't seen yet, straight from the ring buffer
+        if self.screen is None or self.buffer is None or self._screen_seq == self.output_seq:
+            return self.screen
+
+        try:
+            buffer_start = self.output_seq - len(self.buffer)
+            if self._screen_seq >= buffer_start:
+                self.screen.feed(self.buffer.snapshot(self._screen_seq - buffer_start))
+            else:
+                self._rebuild_screen()
+        except Exception as e:
+            decky.logger.exception("[terminal][EXCEPTION][%s] Exception during screen update, replaying the buffer instead: %s", self.id, e)
+            self.screen = None
+
+        self._screen_seq = self.output_seq
+        return self.screen
+
+    def _rebuild_screen(self):
+        # the model fell behind by more than the ring buffer holds (or a clear dropped
+        # the rest), start over from what is left. modes set before that are lost,
+        # except for the ones the scanner keeps track of anyway.
+        data = self.buffer.snapshot()
+        if len(data) == self.buffer.capacity:
+            # wrapped around, the oldest line is most likely cut off
+            data = data[data.find(b"\n") + 1:]
+
+        self.screen = self._new_screen()
+        if self.alt_screen:
+            self.screen.feed(b"\x1b[?1049h")
+        if self.bracketed_paste:
+            self.screen.feed(b"\x1b[?2004h")
+        self.screen.feed(data)
 
     # IS ALIVE ==============================================
     def _is_process_started(self):
@@ -222,32 +865,80 @@ class Terminal:
     def _is_process_completed(self):
         return self._is_process_started() and self.process.returncode is not None
 
-    # OPTIMIZATION ==========================================
-    def _detect_ansi_clear_and_remove_prepends(self, chars: bytes) -> bytes:
-        clear_sequences = [
-            b"\x1b[H\x1b[2J",  # Cursor home + clear screen
-            b"\x1b[2J",        # Clear screen
-            b"\x1b[3J",        # Clear scrollback
-        ]
+    # EVENT DRIVEN INPUT ==================================
+    def _flush_stdin(self):
+        # adjacent chunks are already coalesced in _stdin_pending,
+        # so a single os.write flushes everything the pty accepts.
+        try:
+            written = os.write(self.master_fd, self._stdin_pending)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            decky.logger.error("[terminal][ERROR][%s] Unable to write to process: %s", self.id, e)
+            self._stop_input_writer()
+            return
 
-        last_index = -1
-        matched_seq = None
+        if written > 0:
+            self.stats.record_write(written)
+            del self._stdin_pending[:written]
+            self._stdin_drained.set()
 
-        for seq in clear_sequences:
-            idx = chars.rfind(seq)
-            if idx > last_index:
-                last_index = idx
-                matched_seq = seq
+        if len(self._stdin_pending) > 0:
+            if not self._stdin_writer_registered:
+                asyncio.get_event_loop().add_writer(self.master_fd, self._on_input_ready)
+                self._stdin_writer_registered = True
+        elif self._stdin_writer_registered:
+            asyncio.get_event_loop().remove_writer(self.master_fd)
+            self._stdin_writer_registered = False
 
-        if last_index != -1:
-            self.buffer.clear()
-            return chars[last_index:]  # Return data from the last clear sequence
+    def _on_input_ready(self):
+        self._flush_stdin()
+
+    def _stop_input_writer(self):
+        if self._stdin_writer_registered:
+            self._stdin_writer_registered = False
+            try:
+                asyncio.get_event_loop().remove_writer(self.master_fd)
+            except Exception as e:
+                decky.logger.exception("[terminal][EXCEPTION][%s] Exception during writer removal: %s", self.id, e)
+
+        if len(self._stdin_pending) > 0:
+            self.stats.record_dropped_input(len(self._stdin_pending))
+            self._stdin_pending.clear()
+        if self._stdin_drained is not None:
+            self._stdin_drained.set()
 
-        return chars
+    async def _drain_stdin(self, limit: int = 0):
+        while len(self._stdin_pending) > limit:
+            self._stdin_drained.clear()
+            await self._stdin_drained.wait()
 
     # PROCESS CONTROL =======================================
     async def _write_stdin(self, input: bytes):
-        await Common._run_async(os.write, self.master_fd, input)
+        self.last_activity = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.record_input_data(input)
+        if not self._nonblocking_io:
+            await self._write_stdin_blocking(input)
+            return
+
+        self._stdin_pending += input
+        if not self._stdin_writer_registered:
+            self._flush_stdin()
+
+        if len(self._stdin_pending) > self._stdin_high_water:
+            await self._drain_stdin(self._stdin_high_water)
+
+    async def _write_stdin_blocking(self, input: bytes):
+        if self._stdin_lock is None:
+            self._stdin_lock = asyncio.Lock()
+
+        async with self._stdin_lock:
+            view = memoryview(input)
+            while len(view) > 0:
+                written = await Common._run_async(os.write, self.master_fd, view)
+                self.stats.record_write(written)
+                view = view[written:]
 
     async def _read_output(self) -> bytes:
         output = await Common._run_async(
@@ -255,9 +946,168 @@ class Terminal:
         )
         if len(output) > 0:
             self._put_buffer(output)
+            self.stats.record_read(len(output), self.output_seq)
+            self.stats.record_batch(len(output))
+            self._emitted_seq = self.output_seq
             await self.broadcast_subscribers(output)
             return output
 
+    # EVENT DRIVEN OUTPUT =================================
+    def _start_output_reader(self) -> bool:
+        loop = asyncio.get_event_loop()
+        try:
+            os.set_blocking(self.master_fd, False)
+            loop.add_reader(self.master_fd, self._on_output_ready)
+        except (NotImplementedError, OSError) as e:
+            # event loop without reader support (e.g. Proactor on Windows), fall back to polling
+            decky.logger.info("[terminal][INFO][%s] Readiness based reader unavailable, polling instead: %s", self.id, e)
+            os.set_blocking(self.master_fd, True)
+            return False
+
+        self._output_pending = bytearray()
+        if self._read_buffer is None:
+            self._read_buffer = bytearray(self._read_buffer_size)
+            self._read_view = memoryview(self._read_buffer)
+        self._output_event = asyncio.Event()
+        self._output_closed = False
+        self._output_reader_registered = True
+
+        self._stdin_drained = asyncio.Event()
+        self._nonblocking_io = True
+
+        asyncio.ensure_future(self._broadcast_output_loop())
+        return True
+
+    def _stop_output_reader(self):
+        if not self._output_reader_registered:
+            return
+
+        self._output_reader_registered = False
+        self._output_closed = True
+        if self._throttle_timer is not None:
+            self._throttle_timer.cancel()
+            self._throttle_timer = None
+
+        try:
+            asyncio.get_event_loop().remove_reader(self.master_fd)
+        except Exception as e:
+            decky.logger.exception("[terminal][EXCEPTION][%s] Exception during reader removal: %s", self.id, e)
+
+        self._output_event.set()
+
+    def _on_output_ready(self):
+        # drain what is available, but cap the amount per wakeup so a flooding
+        # process can't starve the event loop. the fd stays readable, so we
+        # will be called again on the next iteration.
+        remaining = self._max_read_per_wakeup
+        while remaining > 0 and self._output_reader_registered:
+            try:
+                size = os.readv(self.master_fd, (self._read_view[:min(remaining, self._read_buffer_size)],))
+            except BlockingIOError:
+                break
+            except OSError:
+                # EIO: every slave side handle has been closed
+                self._stop_output_reader()
+                break
+
+            if size == 0:
+                # EOF
+                self._stop_output_reader()
+                break
+
+            # only valid until the next read, every stage copies what it keeps
+            output = self._read_view[:size]
+            remaining -= size
+            self._output_budget_tokens -= size
+            self._put_buffer(output)
+            self.stats.record_read(size, self.output_seq)
+            self._output_pending += output
+            self._output_batcher.record(size)
+            output.release()
+
+        if len(self._output_pending) > 0:
+            self._output_event.set()
+
+        self._update_throttle()
+
+    # FLOW CONTROL ==========================================
+    def _update_throttle(self):
+        if not self._output_reader_registered:
+            return
+
+        # token bucket: output_budget bytes per second, bursts of up to one interval worth
+        now = time.monotonic()
+        self._output_budget_tokens = min(
+            self._output_budget_tokens + (now - self._output_budget_updated) * self._output_budget,
+            self._output_budget * self._output_budget_interval,
+        )
+        self._output_budget_updated = now
+
+        reason = None
+        if self._output_budget > 0 and self._output_budget_tokens < 0:
+            reason = "budget"
+        elif self._is_downstream_saturated():
+            reason = "consumers"
+
+        if reason is not None and self.throttled is None:
+            asyncio.get_event_loop().remove_reader(self.master_fd)
+        elif reason is None and self.throttled is not None:
+            asyncio.get_event_loop().add_reader(self.master_fd, self._on_output_ready)
+
+        if reason != self.throttled:
+            self.throttled = reason
+            self._changed()
+
+        if reason == "budget" and self._throttle_timer is None:
+            delay = -self._output_budget_tokens / self._output_budget
+            self._throttle_timer = asyncio.get_event_loop().call_later(delay, self._on_throttle_timer)
+
+    def _on_throttle_timer(self):
+        self._throttle_timer = None
+        self._update_throttle()
+
+    def _is_downstream_saturated(self) -> bool:
+        if len(self._output_pending) >= self._output_high_water:
+            return True
+
+        # a single slow view falls back to snapshots instead, only throttle if all of them lag behind
+        if len(self.subscribers) == 0:
+            return False
+        return all(subscriber.is_saturated for subscriber in self.subscribers.values())
+
+    async def _broadcast_output_loop(self):
+        while True:
+            await self._output_event.wait()
+            self._output_event.clear()
+
+            # in bulk mode, keep collecting until the batch interval elapsed or the batch is full
+            delay = self._output_batcher.flush_delay(len(self._output_pending))
+            while delay > 0 and not self._output_closed:
+                try:
+                    await asyncio.wait_for(self._output_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._output_event.clear()
+                delay = self._output_batcher.flush_delay(len(self._output_pending))
+
+            while len(self._output_pending) > 0:
+                # hand the whole buffer over instead of copying it, subscribers only read from it
+                output = self._output_pending
+                self._output_pending = bytearray()
+                self._output_batcher.flushed()
+                self.stats.record_batch(len(output))
+                self._emitted_seq = self.output_seq
+                try:
+                    await self.broadcast_subscribers(output, self._emitted_seq)
+                except Exception as e:
+                    decky.logger.exception("[terminal][EXCEPTION][%s] Exception during output broadcast: %s", self.id, e)
+
+            self._update_throttle()
+
+            if self._output_closed:
+                break
+
+    # POLLING OUTPUT ========================================
     async def _read_output_loop(self):
         while self._is_process_alive():
             try:
@@ -271,26 +1121,60 @@ class Terminal:
             await asyncio.sleep(0.01)
 
     def _put_buffer(self, chars: bytes):
-        self._process_title(chars)
+        self.output_seq += len(chars)
+        self.last_output = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.record_output(chars)
 
-        if self._optimize_clears:
-            chars = self._detect_ansi_clear_and_remove_prepends(chars)
-        
-        for i in chars:
-            self.buffer.append(i)
+        if self.scrollback is not None:
+            try:
+                self.scrollback.append(chars)
+            except OSError as e:
+                decky.logger.error("[terminal][ERROR][%s] Disk scrollback failed, disabling it: %s", self.id, e)
+                self.scrollback.close()
+                self.scrollback = None
+
+        if self._hibernation is not None:
+            # parsing waits until somebody looks again, unless too much piles up.
+            # title and modes are kept up to date, serialize() reports them meanwhile
+            self._apply_scan(self._hibernation.append(chars))
+            if self._hibernation.is_tail_full:
+                self._thaw()
+            return
 
-    def _process_title(self, chars: bytes):
         try:
-            idx = chars.rindex(b"\x21]")
+            self._store_output(chars)
+        except Exception as e:
+            # the subscribers still get the output, only the server side state misses it
+            decky.logger.exception("[terminal][EXCEPTION][%s] Exception during output store: %s", self.id, e)
 
-            validity_check = (48 <= chars[idx + 2] <= 50) and (chars[idx + 3] == 59)
-            if not validity_check:
-                return
+    def _store_output(self, chars: bytes):
+        # single pass over the chunk for everything the buffer and serialize() need
+        scan = self._scanner.scan(chars)
+        if self.line_index is not None and not (self.alt_screen and scan.alt_screen is not False):
+            # full screen apps on the alternate screen don't leave history behind
+            self.line_index.feed(chars)
+        self._apply_scan(scan)
 
-            try:
-                final_idx = chars.rindex(b"\x07", idx + 4)
-                self.title = str(chars[idx + 4 : final_idx])
-            except:
-                pass
-        except:
-            pass
+        if self._optimize_clears and scan.clear_index != -1:
+            # everything before the last clear is gone on the client as well.
+            # the clear may have started in the carried over bytes of the previous read.
+            if self.screen is not None:
+                # the screen model sees it all first, the history it keeps survives a clear
+                self.buffer.append(chars)
+                self._update_screen()
+            self.buffer.clear()
+            chars = scan.data[scan.clear_index:]
+
+        self.buffer.append(chars)
+
+    def _apply_scan(self, scan: ScanResult):
+        if scan.title is not None:
+            self.title = scan.title
+
+        if scan.bracketed_paste is not None:
+            self.bracketed_paste = scan.bracketed_paste
+
+        if scan.alt_screen is not None and scan.alt_screen != self.alt_screen:
+            self.alt_screen = scan.alt_screen
+            self._changed()
@@ -0,0 +1,138 @@
+# Behaviour of the screen model: whatever it holds has to come back identical when its
+# serialize() output is fed into a fresh Screen, that is what a client gets on reattach.
+# Run with `python -m unittest discover tests` from the repository root.
+import random
+import unittest
+
+from benchmarks import stub
+
+stub.install()
+
+from benchmarks.corpora import CORPORA, chunked  # noqa: E402
+from decky_terminal.screen import Screen  # noqa: E402
+
+
+def state(screen: Screen):
+    lines = [(line.chars, line.attrs, line.wrapped) for line in list(screen.scrollback) + (screen._main_lines or []) + screen._lines]
+
+    # the bottom line has nothing below to wrap into, a wrap (and the cell a wide
+    # character skipped to get there) can't be replayed on it
+    chars, attrs, _ = lines[-1]
+    if screen._ends_in_padding(screen._lines[-1]):
+        chars, attrs = chars[:-1] + [" "], attrs[:-1] + [""]
+    lines[-1] = (chars, attrs)
+
+    return lines, screen.x, screen.y, screen.alt_screen, screen._attr, sorted(screen._modes), screen._top, screen._bottom
+
+
+def replay(screen: Screen) -> Screen:
+    copy = Screen(screen.rows, screen.cols, screen.scrollback.maxlen)
+    copy.feed(screen.serialize().encode())
+    return copy
+
+
+def feed(rows: int, cols: int, data: bytes, scrollback_lines: int = 1000) -> Screen:
+    screen = Screen(rows, cols, scrollback_lines)
+    for chunk in chunked(data):
+        screen.feed(chunk)
+    return screen
+
+
+class RoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, screen: Screen):
+        self.assertEqual(state(replay(screen)), state(screen), repr(screen.serialize()))
+
+    def test_corpora(self):
+        for name, make in CORPORA.items():
+            data = make(200000)
+            for rows, cols in ((10, 30), (24, 80), (40, 120)):
+                with self.subTest(corpus=name, rows=rows, cols=cols):
+                    self.assertRoundTrip(feed(rows, cols, data))
+
+    def test_wide_characters(self):
+        cases = [
+            "漢字かな混じり",
+            # doesn't fit into the last column, the cell stays empty and it wraps
+            "abcdefgh漢字xyz",
+            "abcdefgh\x1b[44m漢\x1b[0m字",
+            # overwriting either half of one erases the other half as well
+            "漢字\x1b[2Gx",
+            "漢字\x1b[3Gx",
+            "漢字漢字\x1b[3G\x1b[K",
+            "漢字漢字\x1b[2G\x1b[2X",
+            "漢字漢字\x1b[2G\x1b[@",
+            "漢字漢字\x1b[2G\x1b[P",
+            "abcdefgh漢字\x1b[A\x1b[1G\x1b[P",
+            # combining characters stay with the cell before them
+            "éx́漢́",
+        ]
+        for text in cases:
+            for cols in (3, 9, 10):
+                with self.subTest(text=text, cols=cols):
+                    self.assertRoundTrip(feed(4, cols, text.encode()))
+
+    def test_background_color_erase(self):
+        cases = [
+            "\x1b[41mab\x1b[K\r\n\x1b[0mx",
+            "\x1b[1;44m\x1b[2J\x1b[Hhi",
+            "\x1b[42m\x1b[3X\x1b[43mabc\x1b[2@\x1b[45m\x1b[L",
+            "\x1b[38;5;200;48;2;1;2;3mq\x1b[K\x1b[0m",
+            "\x1b[7;41m\tabcdefghijklmnop\x1b[0m",
+            # lines scrolled in by a wrap get the background of what is printed next
+            "\r\n\r\n\r\n\x1b[41mabcdefghijkl\x1b[0m\r\n\x1b[44mmnopqrst\x1b[0m",
+            "\x1b[48;5;33m\x1b[S\x1b[T\x1b[2J\x1b[3;1H漢字abcdefgh",
+        ]
+        for text in cases:
+            with self.subTest(text=text):
+                self.assertRoundTrip(feed(4, 10, text.encode()))
+
+    def test_alternate_screen(self):
+        self.assertRoundTrip(feed(5, 20, b"$ ls\r\nfile\r\n$ vim\x1b[?1049h\x1b[2;5r\x1b[44mtext\x1b[?25l"))
+        self.assertRoundTrip(feed(5, 20, b"$ vim\x1b[?1049hnot kept\x1b[?1049l\r\n$ "))
+
+    def test_random_sequences(self):
+        pieces = [
+            "abc", "hello world ", "漢字", "é", "x́", "\r\n", "\n", "\r", "\t", "\b",
+            "\x1b[K", "\x1b[1K", "\x1b[2K", "\x1b[J", "\x1b[1J", "\x1b[2J",
+            "\x1b[41m", "\x1b[44;1m", "\x1b[0m", "\x1b[7m", "\x1b[48;5;33m",
+            "\x1b[3X", "\x1b[2@", "\x1b[2P", "\x1b[L", "\x1b[M", "\x1b[S", "\x1b[T",
+            "\x1b[5;3H", "\x1b[H", "\x1b[3A", "\x1b[4C", "\x1b[10G", "\x1bM", "\x1bD", "\x1bE",
+            "\x1b7", "\x1b8", "\x1b[?25l",
+        ]
+        generator = random.Random(5)
+        for _ in range(2000):
+            rows, cols = generator.randint(2, 6), generator.randint(3, 12)
+            text = "".join(generator.choice(pieces) for _ in range(generator.randint(1, 30)))
+            with self.subTest(text=text, rows=rows, cols=cols):
+                self.assertRoundTrip(feed(rows, cols, text.encode(), 50))
+
+
+class ReflowTest(unittest.TestCase):
+    def test_same_as_output_at_new_width(self):
+        # plain output rewrapped to another width looks like it was printed at that width
+        for name in ("utf8", "ls-R"):
+            data = CORPORA[name](100000)
+            for before, after in ((80, 53), (53, 80), (80, 31), (31, 127), (80, 3)):
+                with self.subTest(corpus=name, before=before, after=after):
+                    screen = feed(24, before, data, 100000)
+                    screen.resize(24, after)
+                    self.assertEqual(state(screen), state(feed(24, after, data, 100000)))
+
+    def test_wide_character_padding_is_not_text(self):
+        screen = feed(5, 9, "abcdefgh漢字xyz\r\n$ ".encode())
+        screen.resize(5, 14)
+        self.assertEqual("abcdefgh漢字xy", screen._lines[0].render())
+        self.assertEqual(screen._lines[0].render(), feed(5, 14, "abcdefgh漢字xyz\r\n$ ".encode())._lines[0].render())
+        self.assertEqual((2, 2), (screen.x, screen.y))
+
+    def test_alternate_screen_is_not_reflowed(self):
+        screen = feed(5, 10, "abcdefgh漢字xyz\r\n$ \x1b[?1049h0123456789ABCDEF".encode())
+        screen.resize(5, 6)
+        self.assertEqual(["", "", "  0123", "89ABCD", ""], [line.render() for line in screen._lines])
+
+        screen.feed(b"\x1b[?1049l")
+        self.assertEqual(["abcdef", "gh漢字", "xyz", "$", ""], [line.render() for line in screen._lines])
+
+
+if __name__ == "__main__":
+    unittest.main()